@@ -43,7 +43,7 @@ def run():
     userconfig = {d.customerid: d for d in data['CustomerConfig']}
 
     taskid = int(args.taskid)
-    task_details = paypal_export_config(**taskconfig[taskid].__dict__)
+    task_details = paypal_export_config(**taskconfig[taskid])
 
     openDb('sqlite://:memory:')
 
@@ -66,7 +66,7 @@ if __name__ == '__main__':
             t = tables[table]
             if isinstance(table_data, dict):
                 table_data = table_data.values()
-            objects.extend([t(**d.__dict__) for d in table_data])
+            objects.extend([t(**d) for d in table_data])
 
     if args.query:
         s = open(args.query).read()
@@ -2,8 +2,17 @@
 
 from datetime import datetime, date, timedelta
 import dataclasses as dc
-from typing import Union, List
+from typing import Union, List, Callable, Any
+from concurrent.futures import ThreadPoolExecutor
+from inspect import iscoroutinefunction
+import itertools
+import functools
+import operator
+import builtins
+import calendar
 import threading
+import asyncio
+import heapq
 import logging
 import time
 
@@ -18,109 +27,117 @@ class Range:
 range_set = Union[int, Range, List[Union[int, Range]]]
 
 
-def fits_in_range(range, value):
-    """ Return true if a value fits in the range. """
+def range_mask(range, minimum, maximum):
+    """ Return an integer with the bits set for the values in a range. """
     if range is None:
-        return True
-    if isinstance(range, Range):
-        return (value - range.start) % range.step == 0
-    if isinstance(range, list):
-        return any(fits_in_range(r, value) for r in range)
-
-
-def find_next_in_range(range, start, limit, minimum=0):
-    """ Returns an integer as the next in the sequence, and a bool to indicate if
-        the sequence wrapped around.
-    """
-    wrap = False
-    if range is None:
-        # Just increment the item by one and wrap around if necessary
-        n = start + 1
-        if n >= limit:
-            n -= limit
-            wrap = True
-        return n, wrap
+        return (1 << (maximum + 1)) - (1 << minimum)
     if isinstance(range, int):
-        return range, range <= start
+        if not minimum <= range <= maximum:
+            raise ValueError(f'Value {range} not in {minimum}-{maximum}')
+        return 1 << range
     if isinstance(range, Range):
-        if start < range.start:
-            return range.start, False
-        index = (start - range.start) // range.step
-        n = range.step * (index + 1) + range.start
-        if (range.end and n > range.end) or \
-                n >= (limit + minimum):
-            n = range.start or minimum
-            wrap = True
-        return n, wrap
+        start = minimum if range.start is None else range.start
+        end = maximum if range.end is None else range.end
+        if not minimum <= start <= maximum or end > maximum or range.step < 1:
+            raise ValueError(f'Range {range} not in {minimum}-{maximum}')
+        mask = 0
+        for value in builtins.range(start, end + 1, range.step):
+            mask |= 1 << value
+        return mask
     if isinstance(range, list):
-        # Keep track of which item in the list is the closest next entry
-        options = [find_next_in_range(r, start, limit)[0] for r in range]
-        options = sorted(options)
-        if options[-1] <= start:
-            return options[0], True
-        if options[0] > start:
-            return options[0], False
-        for r in options:
-            if r > start:
-                return r, False
+        return functools.reduce(operator.or_, [range_mask(r, minimum, maximum) for r in range], 0)
     raise RuntimeError(f"Unsupported type for range: {type(range)}")
 
 
+def next_bit(mask, value):
+    """ Return the lowest value >= `value` that has its bit set in the mask, or None. """
+    m = mask >> value
+    if not m:
+        return None
+    return value + (m & -m).bit_length() - 1
+
+
+# How far ahead to look for a matching date. The calendar repeats every 400 years.
+MAX_YEARS = 400
+
+
 @dc.dataclass
 class CronSchedule:
     minute: range_set = None  # Minute count, 0-59
     hour: range_set = None  # Hour count, 0-23
-    dom: range_set = None  # Day of Month, 1-32 (depending on month)
+    dom: range_set = None  # Day of Month, 1-31 (depending on month)
     month: range_set = None  # Month number, 1-12
-    dow: range_set = None  # Day of Week, 0-6
-    wdom: range_set = None  # Week of Month, 0-4
-    
+    dow: range_set = None  # Day of Week, 0-6 (Monday is 0)
+    wdom: range_set = None  # Week of Month, 0-4 (day of the month // 7)
+
+    # The compiled form of the schedule: for each field a mask with a bit set for each allowed value.
+    minutes: int = dc.field(init=False, repr=False, compare=False)
+    hours: int = dc.field(init=False, repr=False, compare=False)
+    months: int = dc.field(init=False, repr=False, compare=False)
+    # The allowed days of the month, for each weekday the month can start on.
+    days: List[int] = dc.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.minutes = range_mask(self.minute, 0, 59)
+        self.hours = range_mask(self.hour, 0, 23)
+        self.months = range_mask(self.month, 1, 12)
+        dom = range_mask(self.dom, 1, 31)
+        weekdays = range_mask(self.dow, 0, 6)
+        weeks = range_mask(self.wdom, 0, 4)
+        self.days = []
+        for first in builtins.range(7):
+            mask = dom
+            for day in builtins.range(1, 32):
+                if not (weekdays >> ((first + day - 1) % 7)) & 1 or not (weeks >> (day // 7)) & 1:
+                    mask &= ~(1 << day)
+            self.days.append(mask)
+
+    def days_in(self, year, month):
+        """ Return the mask of allowed days in a month. """
+        first, length = calendar.monthrange(year, month)
+        return self.days[first] & ((1 << (length + 1)) - 2)
+
     def next_action(self, start: datetime = None):
-        start = start or datetime.now()
-        hour = start.hour
-        day = start.day
-        month = start.month
-        year = start.year
-        minute, wrap = find_next_in_range(self.minute, start.minute, 60)
-        # See if we went to the next hour
-        if wrap:
-            hour, wrap = find_next_in_range(self.hour, start.hour, 24)
-        
-        # We enter a loop to find a day that matches all criteria that apply to days
-        # There are 4: day range, month range, dow range, wdom range.
-        # It is hard to find a solution in one go, so we try the brute force approach.
-        valid = False
-        while not valid:
-            # See if we went to the next day
-            if wrap:
-                # The simple case: look for a valid day in the current month
-                days_in_month = 30 if month in [4, 6, 9, 11] else 31
-                if month == 2:
-                    # Calculate leap years according to the gregorian calendar
-                    days_in_month = 29 if ((year % 4 == 0) and not (year % 100 == 0)) or (
-                                year % 400 == 0) else 28
-                day, wrap = find_next_in_range(self.dom, start.day, days_in_month, minimum=1)
-            
-            # See if we went to the next month
-            if wrap:
-                month, wrap = find_next_in_range(self.month, start.month, 12, minimum=1)
-            
-            # Finally, increment the year if necessary.
-            if wrap:
-                year += 1
-            
-            # Now we need to be careful: check on dow and wdom.
-            # We need to find a date that matches both, if applicable.
-            valid = True
-            d = date(year, month, day)
-            if self.dow is not None:
-                valid = fits_in_range(range.dow, d.weekday())
-            
-            # First check the situation where a wdom is set.
-            if self.wdom is not None:
-                valid = valid and fits_in_range(range.wdom, d.day // 7)
-        
-        return datetime(year, month, day, hour, minute, 0)
+        """ Return the first time after start that matches the schedule.
+            Instead of trying each minute, the search jumps to the next allowed month,
+            day, hour and minute in turn.
+        """
+        start = (start or datetime.now()).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        year, month, day, hour, minute = start.year, start.month, start.day, start.hour, start.minute
+        while year <= start.year + MAX_YEARS:
+            m = next_bit(self.months, month)
+            if m is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if m != month:
+                month, day, hour, minute = m, 1, 0, 0
+            d = next_bit(self.days_in(year, month), day)
+            if d is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if d != day:
+                day, hour, minute = d, 0, 0
+            h = next_bit(self.hours, hour)
+            if h is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if h != hour:
+                hour, minute = h, 0
+            mi = next_bit(self.minutes, minute)
+            if mi is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime(year, month, day, hour, mi)
+        raise ValueError(f'The schedule {self} never matches')
+
+    def next_n(self, start: datetime = None, n: int = 10):
+        """ Return the next n times that match the schedule, e.g. for a preview. """
+        result = []
+        t = start or datetime.now()
+        for _ in builtins.range(n):
+            t = self.next_action(t)
+            result.append(t)
+        return result
     
     @staticmethod
     def parse(s):
@@ -134,60 +151,229 @@ class CronSchedule:
                 A comma-separated list of specific values
                 A range indicated by two integers separated by a dash,
                 with optionally a step after a slash
+                An astrix with a step after a slash, for steps from the first value.
             
             For example: 0 */4 * * 0-4 *
             
             Will trigger every four hours at the hour, for all working days.
+            Raises a ValueError if the string is not a valid schedule.
         """
         def parse_part(s):
             if ',' in s:
                 result = [parse_part(i) for i in s.split(',')]
                 return result
             if '-' in s:
-                parts = s.split('-', maxsplit=1)
-                if '/' in parts[1]:
-                    end, step = parts[1].split('/', maxsplit=1)
-                    return Range(int(parts[0]), int(end), int(step))
+                start, end = s.split('-', maxsplit=1)
+                step = 1
+                if '/' in end:
+                    end, step = end.split('/', maxsplit=1)
+                return Range(int(start), int(end), int(step))
             elif '/' in s:
                 # Now the only other part must be an astrix
                 parts = s.split('/', maxsplit=1)
-                assert parts[0] == '*'
-                return Range(0, None, int(parts[1]))
-            elif s.startswith('*'):
+                if parts[0] != '*':
+                    raise ValueError(f'Invalid range {s}')
+                return Range(None, None, int(parts[1]))
+            elif s == '*':
                 return None
             return int(s)
         
         parts = s.split()
+        if len(parts) > 6:
+            raise ValueError(f'Too many fields in schedule {s}')
         ranges = [parse_part(p) for p in parts]
         return CronSchedule(*ranges)
 
 
+# The scheduler wakes up at least this often (in seconds), to notice changes in the system time.
+MAX_SLEEP = 60
+
+
+@dc.dataclass(eq=False)
+class ScheduledJob:
+    """ An action that is run according to a schedule, with statistics on its runs. """
+    schedule: CronSchedule
+    action: Callable
+    name: str = None
+    deadline: datetime = None
+    runs: int = 0
+    missed: int = 0
+    failures: int = 0
+    last_duration: float = None
+    total_duration: float = 0.0
+    running: Any = dc.field(default=None, repr=False)
+    cancelled: bool = False
+
+    def finished(self, start, failed):
+        self.last_duration = time.monotonic() - start
+        self.total_duration += self.last_duration
+        self.runs += 1
+        self.failures += failed
+        logging.debug('Scheduled action %s took %.3f seconds' % (self.name, self.last_duration))
+
+
+class Scheduler:
+    """ Runs actions according to their CronSchedule.
+
+        The deadlines of all jobs are kept in a heap, and the scheduler sleeps until the
+        first one. Due actions are run in a bounded thread pool, so that many jobs do not
+        need many threads. Runs that could not be done in time, because the scheduler
+        was late or the previous run had not finished, are counted as missed.
+
+        The scheduler runs either in a thread of its own (`start`) or as an asyncio task
+        (`run_async`). In the latter case, coroutine functions are awaited in the event loop.
+    """
+    def __init__(self, max_workers=4, now=datetime.now):
+        self.heap = []
+        self.counter = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='scheduler')
+        self.condition = threading.Condition()
+        self.changed = False
+        self.stopped = False
+        self.thread = None
+        self.loop = self.wakeup = None
+        self.now = now
+
+    def add(self, schedule, action, name=None) -> ScheduledJob:
+        """ Add an action, with a schedule that is either a CronSchedule or a string for CronSchedule.parse. """
+        if isinstance(schedule, str):
+            schedule = CronSchedule.parse(schedule)
+        job = ScheduledJob(schedule, action, name or getattr(action, '__name__', str(action)))
+        with self.condition:
+            self.push(job, schedule.next_action(self.now()))
+        return job
+
+    def remove(self, job):
+        job.cancelled = True
+
+    def clear(self):
+        with self.condition:
+            for _, _, job in self.heap:
+                job.cancelled = True
+            self.heap = []
+
+    def jobs(self):
+        return sorted((job for _, _, job in self.heap if not job.cancelled), key=lambda j: j.deadline)
+
+    def status(self):
+        """ Return the details of the jobs, e.g. for a status query. """
+        return [dict(name=j.name, next=j.deadline.isoformat(), runs=j.runs, missed=j.missed,
+                     failures=j.failures, last_duration=j.last_duration,
+                     mean_duration=j.total_duration / j.runs if j.runs else None)
+                for j in self.jobs()]
+
+    def push(self, job, deadline):
+        """ Put a job on the heap, and let the scheduler know. Call with the condition locked. """
+        job.deadline = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), job))
+        self.changed = True
+        self.condition.notify()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def due(self):
+        """ Take the jobs that are due from the heap, and schedule their next run.
+            Returns the jobs to run now, and the number of seconds until the next deadline.
+        """
+        now = self.now()
+        jobs = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, job = heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+                deadline = job.schedule.next_action(deadline)
+                missed = 0
+                while deadline <= now:
+                    missed += 1
+                    deadline = job.schedule.next_action(deadline)
+                if job.running is not None and not job.running.done():
+                    missed += 1
+                else:
+                    jobs.append(job)
+                if missed:
+                    job.missed += missed
+                    logging.warning('Scheduled action %s missed %d runs' % (job.name, missed))
+                heapq.heappush(self.heap, (deadline, next(self.counter), job))
+                job.deadline = deadline
+            self.changed = False
+            delay = (self.heap[0][0] - now).total_seconds() if self.heap else MAX_SLEEP
+        return jobs, min(delay, MAX_SLEEP)
+
+    def execute(self, job):
+        start = time.monotonic()
+        try:
+            job.action()
+        except Exception:
+            logging.exception('Error executing scheduled action %s' % job.name)
+            job.finished(start, True)
+        else:
+            job.finished(start, False)
+
+    async def execute_async(self, job):
+        start = time.monotonic()
+        try:
+            await job.action()
+        except Exception:
+            logging.exception('Error executing scheduled action %s' % job.name)
+            job.finished(start, True)
+        else:
+            job.finished(start, False)
+
+    def run(self):
+        """ Run the scheduler in the current thread, until it is stopped. """
+        while not self.stopped:
+            jobs, delay = self.due()
+            for job in jobs:
+                job.running = self.executor.submit(self.execute, job)
+            with self.condition:
+                if not self.changed and not self.stopped:
+                    self.condition.wait(delay)
+
+    def start(self):
+        """ Run the scheduler in a thread of its own. """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+            self.thread.start()
+
+    async def run_async(self):
+        """ Run the scheduler as an asyncio task, until it is stopped. """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        try:
+            while not self.stopped:
+                jobs, delay = self.due()
+                for job in jobs:
+                    if iscoroutinefunction(job.action):
+                        job.running = asyncio.ensure_future(self.execute_async(job))
+                    else:
+                        job.running = self.loop.run_in_executor(self.executor, self.execute, job)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        finally:
+            self.loop = self.wakeup = None
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            if self.loop:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+
+
+# The scheduler used for the scheduled_action decorator.
+default_scheduler = Scheduler()
+
+
 def scheduled_action(cron_schedule):
     """ Decorator that makes an action run periodically. """
     def wrap(action):
-        def run():
-            cron = CronSchedule.parse(cron_schedule)
-            while True:
-                # Calculate when to activate
-                next_action = cron.next_action()
-                activate_ts = next_action.timestamp()
-                
-                # Wait to activate. Work in 1-minute steps
-                # to avoid problems with a change in system time.
-                while (t := time.time()) < activate_ts:
-                    # Ensure synchronisation on a whole minute.
-                    n = 60 - (t % 60)
-                    time.sleep(n)
-                
-                # Trigger the action
-                try:
-                    action()
-                except:
-                    logging.exception('Error executing scheduled action!')
         def start():
-            th = threading.Thread(target=run)
-            th.daemon = True
-            th.start()
+            default_scheduler.add(cron_schedule, action)
+            default_scheduler.start()
         
         return start
     return wrap
@@ -215,7 +401,9 @@ def tests():
         [1, 9, 9, 9, 9, 9, 9, 9, 9, 11, 11, 1, 1, 1, 1]
     ]
     for r, e in zip(ranges, expecteds):
-        l = [find_next_in_range(r, i, 14)[0] for i in range(15)]
+        mask = range_mask(r, 0, 13)
+        l = [next_bit(mask, i + 1) if next_bit(mask, i + 1) is not None else next_bit(mask, 0)
+             for i in range(15)]
         assert l == e
 
 if __name__ == '__main__':
@@ -9,16 +9,28 @@ from enum import Enum
 import logging
 import re
 import codecs
+import array
+import itertools
+import functools
+import keyword
+import operator
+import io
+import dataclasses
 import bcrypt
 import os.path
 from admingen.util import isoweekno2day
 from yaml import load, dump
-from collections.abc import Mapping
+from collections.abc import Mapping, MutableMapping
 from typing import Dict, List, Union, Type
 from dataclasses import is_dataclass, asdict
 from .db_api import db_api, Record
+from .data_type_base import record_json
 
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
@@ -57,7 +69,8 @@ def enrich(values, func=None, **kwargs):
     for r in values:
         if callable(func):
             update = func(r)
-            r.__dict__.update(update)
+            for key, value in update.items():
+                setattr(r, key, value)
         else:
             for key, getter in kwargs.items():
                 if callable(getter):
@@ -67,9 +80,18 @@ def enrich(values, func=None, **kwargs):
                 setattr(r, key, value)
     return values
 
+def fields(r):
+    """ Return the fields of a record as a mapping, e.g. for use as the locals in `eval`. """
+    return r if isinstance(r, Mapping) else r.__dict__
+
+
+def eval_condition(expression):
+    return lambda r: eval(expression, None, fields(r))
+
+
 def enrich_condition(values, condition, true=None, false=None):
     if isinstance(condition, str):
-        condition = lambda r: eval(condition, None, r.__dict__)
+        condition = eval_condition(condition)
     for r in values:
         update = {}
         if condition(r):
@@ -147,7 +169,7 @@ class dataset:
             can be used.
         """
         if isinstance(condition, str):
-            condition = lambda r: eval(condition, None, r.__dict__)
+            condition = eval_condition(condition)
         return dataset(r for r in self.data.values() if condition(r))
 
 
@@ -204,10 +226,22 @@ def read_header(stream, delimiter):
             #types = [supported_types[t] for t in types]
             return headers, types
 
-class dataline(Mapping):
+class dataline(MutableMapping):
+    """ A row of a table, with the values as attributes.
+        The rows read from CSV files are instances of a subclass made by `row_class`, that
+        stores the fields of the table in slots. Other attributes, and fields that are not
+        identifiers, are kept in the `__dict__` of the row, that is only created when needed.
+        The fields of a row hide the methods of the mapping with the same name.
+    """
+    __slots__ = ('__dict__',)
+    _fields = ()
+    _slots = frozenset()
+    # The fields that are stored in the dictionary.
+    _unslotted = frozenset()
+
     @staticmethod
     def create_instance(headers, types, values):
-        result = dataline()
+        converted = []
         for h, t, p in zip(headers, types, values):
             try:
                 p = p.strip()
@@ -215,12 +249,14 @@ class dataline(Mapping):
                     value = p and p.lower()[0] in 'ty1'
                 else:
                     value = t(p)
-                setattr(result, h, value)
+                converted.append(value)
             except Exception as e:
                 msg = 'Error when converting parameter %s value %s to %s'
                 logging.exception('Error converting value')
                 raise RuntimeError(msg%(h, p, t.__name__))
-        return result
+        # The fields missing from a short line are None.
+        converted.extend([None] * (len(headers) - len(converted)))
+        return row_class(tuple(headers))(*converted)
 
     @staticmethod
     def getConstructor(headers, types):
@@ -230,24 +266,63 @@ class dataline(Mapping):
             return dl
         return constructor
 
+    def __getstate__(self):
+        return {k: self[k] for k in self}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
     # Implement the Mapping protocol
     def __getitem__(self, key):
         try:
-            return getattr(self, key)
-        except AttributeError:
+            if key in self._slots:
+                return getattr(self, key)
+            return self.__dict__[key]
+        except (AttributeError, KeyError):
             raise KeyError(f'{key} not found in dataitem')
     def __setitem__(self, key, value):
         setattr(self, key, value)
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(f'{key} not found in dataitem')
     def __iter__(self):
-        return iter(self.__dict__)
+        extra = self.__dict__
+        if self._unslotted:
+            extra = [k for k in extra if k not in self._unslotted]
+        return itertools.chain(self._fields, extra)
     def __len__(self):
-        return len(self.__dict__)
+        return len(self._fields) + len(self.__dict__) - len(self._unslotted)
     def values(self):
-        return self.__dict__.values()
+        return [self[k] for k in self]
     def __str__(self):
-        return str(self.__dict__)
+        return str({k: self[k] for k in self})
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self)
+
+
+@functools.lru_cache(maxsize=None)
+def row_class(headers: tuple):
+    """ Return the dataline class for the rows of a table with the given headers.
+        Each field gets a slot, except fields that are not identifiers or that start with
+        an underscore: these are stored in the __dict__ of the row, like other attributes.
+        Instances are created with the values of the fields in order.
+    """
+    fields = tuple(dict.fromkeys(headers))
+    slots = tuple(f for f in fields if f.isidentifier() and not f.startswith('_'))
+    cls = type('dataline', (dataline,), {'__slots__': slots, '_fields': fields, '_slots': frozenset(slots),
+                                         '_unslotted': frozenset(fields) - frozenset(slots)})
+    # The values are stored through the slot descriptors directly.
+    namespace = {f'set_{i}': cls.__dict__[f].__set__ for i, f in enumerate(slots)}
+    args = ', '.join(f'v{i}' for i in range(len(headers)))
+    body = [f'    set_{slots.index(f)}(self, v{i})' if f in slots else f'    self.__dict__[{f!r}] = v{i}'
+            for i, f in enumerate(headers)]
+    code = f'def __init__(self, {args}):\n' + ('\n'.join(body) or '    pass') + '\n'
+    exec(code, namespace)
+    cls.__init__ = namespace['__init__']
+    return cls
 
 
 class ExtendibleJsonEncoder(json.JSONEncoder):
@@ -264,45 +339,167 @@ class ExtendibleJsonEncoder(json.JSONEncoder):
             return result
         return str(o)
 
+json_encoder = ExtendibleJsonEncoder()
+json_backend = 'json'
+# The functions used for (de)serialising records, see set_json_backend.
+record_loads = json.loads
+
+# The types that JSON encodes without help, including their subclasses.
+json_native = (str, int, float, bool, list, tuple, dict, type(None))
+
+
+def set_json_backend(name):
+    """ Select the library used for (de)serialising records: 'json' or 'orjson'.
+        The orjson output is more compact, but is read back in the same way.
+    """
+    global json_backend, record_loads
+    if name not in ['json', 'orjson']:
+        raise ValueError(f'Unknown JSON backend {name}')
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('The orjson library is not installed')
+    json_backend = name
+    record_loads = orjson.loads if name == 'orjson' else json.loads
+
+
+def record_dumps(data):
+    """ Encode data like `json.dumps(data, cls=ExtendibleJsonEncoder)` does. """
+    if json_backend == 'orjson':
+        # Leave the types that orjson would encode differently to ExtendibleJsonEncoder.
+        return orjson.dumps(data, default=json_encoder.default,
+                            option=orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME).decode('utf8')
+    return json_encoder.encode(data)
+
+
+def stringified(t):
+    """ Return True if values of exactly type t are serialised as str(value). """
+    return isinstance(t, type) and not issubclass(t, json_native) and not is_dataclass(t) \
+        and not hasattr(t, '__json__')
+
+
+@functools.lru_cache(maxsize=None)
+def record_encoder(cls):
+    """ Generate a function that returns the JSON compatible dict for a record of class cls.
+        Only the values that ExtendibleJsonEncoder.default would turn into strings are
+        converted here, other values are left to the JSON encoder.
+    """
+    annotations = getattr(cls, '__annotations__', {})
+    namespace = {}
+    items = []
+    for i, f in enumerate(dataclasses.fields(cls)):
+        t = annotations.get(f.name)
+        if stringified(t):
+            namespace[f't{i}'] = t
+            items.append(f'{f.name!r}: (str(v) if (v := r.{f.name}).__class__ is t{i} else v)')
+        else:
+            items.append(f'{f.name!r}: r.{f.name}')
+    code = 'def encode(r):\n    return {' + ', '.join(items) + '}\n'
+    exec(code, namespace)
+    return namespace['encode']
+
+
+def json_value(o):
+    """ Return o with the records replaced by their dicts.
+        Records with their own __json__, like the results of a join, are left to that method.
+    """
+    cls = o.__class__
+    if getattr(cls, '__json__', record_json) is record_json and is_dataclass(cls) \
+            and '__json__' not in getattr(o, '__dict__', ()):
+        return record_encoder(cls)(o)
+    return o
+
+
 def serialiseDataclass(data):
     """ Convert a dataclass to a JSON string """
-    result = json.dumps(data, cls=ExtendibleJsonEncoder)
-    return result
+    return record_dumps(json_value(data))
 
 def serialiseDataclass_old(data):
     """ Convert a dataclass to a JSON string """
     ddict = {k: str(v) for k, v in asdict(data).items()}
     return json.dumps(ddict)
 
+
+@functools.lru_cache(maxsize=None)
+def record_decoder(cls):
+    """ Generate a function that creates a record of class cls from a decoded JSON dict.
+        Missing fields and the values None, 'None' and '' become None, other values are
+        converted to the annotated type. Records of a `mydataclass` are filled in directly,
+        as their constructor would do, other classes are called with the converted values.
+    """
+    direct = vars(cls).get('_record_init') is cls.__init__ and cls.__setattr__ is object.__setattr__
+    namespace = {'cls': cls, 'new': object.__new__, 'missing': object(),
+                 'convert': getattr(cls, 'convert_field', None)}
+    lines = ['def decode(d):', '    get = d.get']
+    lines.append('    r = new(cls)\n    values = r.__dict__' if direct else '    values = {}')
+    for i, (k, t) in enumerate(cls.__annotations__.items()):
+        namespace[f't{i}'] = t
+        if t in (str, int, float):
+            convert = f'v if v.__class__ is t{i} else t{i}(v)'
+        else:
+            convert = f't{i}(v)'
+        if direct and k != 'id':
+            # The constructor sets missing fields to None.
+            lines.append(f'    v = get({k!r})')
+        else:
+            lines.append(f'    v = get({k!r}, missing)\n    if v is not missing:')
+        indent = '' if lines[-1].endswith(')') else '    '
+        lines.append(f'{indent}    v = None if v is None or v == "None" or v == "" else {convert}')
+        if direct and t not in (str, int, float):
+            # The constructor converts values that are not of the annotated type once more.
+            lines.append(f'{indent}    if v is not None and v.__class__ is not t{i}:\n'
+                         f'{indent}        v = convert({k!r}, v)')
+        lines.append(f'{indent}    values[{k!r}] = v')
+    lines.append('    return r' if direct else '    return cls(**values)')
+    exec('\n'.join(lines) + '\n', namespace)
+    return namespace['decode']
+
+
 def deserialiseDataclass(cls, s):
     """ Read the dataclass from a JSON string """
     if hasattr(cls, 'from_string'):
         return cls.from_string(s)
-    ddict = json.loads(s)
-    result = cls(**{k: (None if ddict[k] in [None, 'None', ''] else t(ddict[k])) for k, t in cls.__annotations__.items()
-                    if k in ddict})
-    return result
+    return record_decoder(cls)(record_loads(s))
 
 def serialiseDataclasses(data):
     """ Serialize a list of data items """
     # We need to convert all simple types to strings, but not lists or dictionaries.
-    result = json.dumps(data, cls=ExtendibleJsonEncoder)
-    return result
-    
+    if isinstance(data, (list, tuple)):
+        data = [json_value(d) for d in data]
+    return record_dumps(data)
+
+
+def split_simple(line, delimiter):
+    """ Split a line of a multi-table CSV file, where quotes are simply removed. """
+    parts = line.split(delimiter)
+    if '"' in line:
+        parts = [p.strip('"') for p in parts]
+    if '\\' in line:
+        parts = [unescape_simple(p, delimiter) for p in parts]
+    return parts
+
+
+def unescape_simple(p, delimiter):
+    return p.replace(r'\d', delimiter).replace(r'\n', '\n')
+
+
+def str2bool(p):
+    return p and p.lower()[0] in 'ty1'
+
 
 def read_lines(stream, headers, types, delimiter):
     constructor = dataline.getConstructor(headers, types)
-    for line in stream:
-        line = line.strip()
-        # Ignore comment lines.
-        if line.startswith('#'):
+    converters = [str2bool if t is bool else t for t in (supported_types[t] for t in types)]
+    row = row_class(tuple(headers))
+    converter = TableConverter(headers, converters, delimiter, escaped=False, strip=True)
+    for lines in read_batches(stream):
+        try:
+            values = converter.rows(lines)
+        except Exception:
+            # Let the constructor report the offending value.
+            for line in lines:
+                yield constructor(split_simple(line, delimiter))
             continue
-        # If we see an empty line, the table is ended.
-        if not line:
-            return
-        parts = line.split(delimiter)
-        parts = [p.strip('"').replace('\d', delimiter).replace(r'\n', '\n') for p in parts]
-        yield constructor(parts)
+        for v in values:
+            yield row(*v)
 
 
 def read_lines_id(stream, headers, types, delimiter):
@@ -340,12 +537,15 @@ quote_splitter = re.compile(r'("[^"]*")')
 
 
 
-def mk_object_constructor(cls, types=None):
+def mk_part_constructors(cls, types=None):
     lookup = basic_types.copy()
     if types:
         lookup.update(types)
-    names, types = list(cls.__annotations__.keys()), list(cls.__annotations__.values())
-    part_constructors = [(lookup[t] if t in lookup else t) for t in types]
+    return [(lookup[t] if t in lookup else t) for t in cls.__annotations__.values()]
+
+
+def mk_object_constructor(cls, types=None):
+    part_constructors = mk_part_constructors(cls, types)
 
     def constr(*parts):
         parts = [c(v) for c, v in zip(part_constructors, parts)]
@@ -383,6 +583,9 @@ def decode_escapes(s, delimiter):
     return ESCAPE_SEQUENCE_RE.sub(decode_match, s)
 
 def encode_escapes(s, delimiter):
+    # Most strings need no escaping at all.
+    if s.isascii() and s.isprintable() and '\\' not in s and delimiter not in s:
+        return s
     return codecs.encode(s, 'unicode-escape').decode('utf-8').replace(delimiter, r'\d')
 
 
@@ -437,6 +640,147 @@ def date_or_dash(fmt):
 ###############################################################################
 ## CSV table reader and writer.
 
+# The number of lines that is converted at a time.
+BATCH_SIZE = 4096
+
+
+def split_quoted(line, delimiter):
+    """ Take care quoted parts are handled properly: delimiters in them are escaped. """
+    # Split in parts without the quotes
+    quoted_parts = quote_splitter.split(line)
+    for i, p in enumerate(quoted_parts):
+        if p.startswith('"'):
+            quoted_parts[i] = p.replace(delimiter, r'\d')[1:-1]
+    return ''.join(quoted_parts).split(delimiter)
+
+
+def split_escaped(line, delimiter):
+    """ Split a line in the CSV dialect with quotes and C-style escapes. """
+    parts = split_quoted(line, delimiter) if '"' in line else line.split(delimiter)
+    # Un-escape delimiters in strings
+    if '\\' in line:
+        parts = [decode_escapes(p, delimiter) if '\\' in p else p for p in parts]
+    return parts
+
+
+def read_batches(stream, batch_size=BATCH_SIZE):
+    """ Read the lines of a table in batches of up to `batch_size` lines, without comments.
+        The table ends at an empty line or the end of the stream. Lines are read one by one,
+        so the lines after the table are left in the stream.
+    """
+    batch = []
+    for line in stream:
+        line = line.strip()
+        # If we see an empty line, the table is ended.
+        if not line:
+            break
+        # Ignore comment lines.
+        if line[0] == '#':
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Columns of dates and times in these formats are converted with fromisoformat, which gives
+# the same values as mkdate and mkdatetime, but is many times faster than strptime.
+iso_dates = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}(?:\n[0-9]{4}-[0-9]{2}-[0-9]{2})*')
+iso_datetimes = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}'
+                           r'(?:\n[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2})*')
+
+
+def date_column(column):
+    if iso_dates.fullmatch('\n'.join(column)):
+        return list(map(date.fromisoformat, column))
+    return list(map(mkdate, column))
+
+
+def datetime_column(column):
+    if iso_datetimes.fullmatch('\n'.join(column)):
+        return list(map(datetime.fromisoformat, column))
+    return list(map(mkdatetime, column))
+
+
+# Functions that convert a whole column at once, for the converters that have one.
+column_converters = {mkdate: date_column, mkdatetime: datetime_column}
+
+
+class TableConverter:
+    """ Converts batches of lines of a table to values, a column at a time.
+        The lines are split without any per-line function calls, and escapes are only
+        decoded in columns that contain them. Mapping a converter over a column avoids
+        most of the overhead of converting each value separately, and columns of strings
+        are not converted at all.
+        With `escaped` set, the dialect with quotes and C-style escapes is used, otherwise
+        the simpler dialect of the multi-table files.
+    """
+    def __init__(self, names, converters, delimiter, escaped=True, strip=False):
+        self.names = names
+        self.converters = [None if c is str else c for c in converters]
+        self.delimiter = delimiter
+        self.escaped = escaped
+        self.strip = strip
+
+    def columns(self, lines):
+        """ Return the converted values for a batch of lines, as a list of columns.
+            Raises an exception if a line has the wrong number of values, or if a value
+            can not be converted.
+        """
+        d = self.delimiter
+        n = len(self.converters)
+        text = d.join(lines)
+        if '"' not in text:
+            # Split the whole batch at once, and take every n-th part for each column.
+            if set(map(str.count, lines, itertools.repeat(d))) != {n - 1}:
+                raise ValueError(f'Expected {n} values in each line')
+            parts = text.split(d)
+            columns = [parts[i::n] for i in range(n)]
+        else:
+            if self.escaped:
+                rows = [l.split(d) if '"' not in l else split_quoted(l, d) for l in lines]
+            else:
+                rows = [l.split(d) if '"' not in l else [p.strip('"') for p in l.split(d)] for l in lines]
+            if any(len(r) != n for r in rows):
+                raise ValueError(f'Expected {n} values in each line')
+            columns = list(zip(*rows)) or [()] * n
+        result = []
+        for conv, c in zip(self.converters, columns):
+            if '\\' in ''.join(c):
+                if self.escaped:
+                    c = [decode_escapes(p, d) if '\\' in p else p for p in c]
+                else:
+                    c = [unescape_simple(p, d) for p in c]
+            if self.strip:
+                c = list(map(str.strip, c))
+            if conv is None:
+                result.append(c)
+            elif conv in column_converters:
+                result.append(column_converters[conv](c))
+            else:
+                result.append(list(map(conv, c)))
+        return result
+
+    def rows(self, lines):
+        """ Return the converted values for a batch of lines, as a list of tuples. """
+        return list(zip(*self.columns(lines)))
+
+    def arrays(self, lines):
+        """ Return the converted values as a dictionary of columns. Integers and floats are
+            stored in arrays, the other values in lists.
+        """
+        result = {}
+        for name, conv, column in zip(self.names, self.converters, self.columns(lines)):
+            if conv in (int, id_type):
+                column = array.array('q', column)
+            elif conv is float:
+                column = array.array('d', column)
+            result[name] = column
+        return result
+
+
 def CsvTableReader(stream: typing.TextIO, targettype, delimiter=',', types=None, header=True):
     if header:
         h = read_header(stream, delimiter)
@@ -444,29 +788,50 @@ def CsvTableReader(stream: typing.TextIO, targettype, delimiter=',', types=None,
             return
         names, types = h
     constr = mk_object_constructor(targettype)
-    for line in stream:
-        line = line.strip()
-        # Ignore comment lines.
-        if line.startswith('#'):
-            continue
-        # If we see an empty line, the table is ended.
-        if not line:
-            return
-        # Take care quoted parts are handled properly.
-        # Split in parts without the quotes
-        quoted_parts = quote_splitter.split(line)
-        for i, p in enumerate(quoted_parts):
-            if p.startswith('"'):
-                quoted_parts[i] = p.replace(delimiter, '\d')[1:-1]
-        line = ''.join(quoted_parts)
-
-        parts = line.split(delimiter)
-        # Un-escape delimiters in strings
-        parts = [decode_escapes(p, delimiter) for p in parts]
+    converter = TableConverter(list(targettype.__annotations__), mk_part_constructors(targettype), delimiter)
+    for lines in read_batches(stream):
         try:
-            yield constr(*parts)
-        except:
-            logging.exception("Problem converting data from CSV file")
+            values = converter.rows(lines)
+        except Exception:
+            values = None
+        if values is None:
+            # Convert line by line, skipping the lines that can not be converted.
+            for line in lines:
+                try:
+                    yield constr(*split_escaped(line, delimiter))
+                except:
+                    logging.exception("Problem converting data from CSV file")
+            continue
+        for v in values:
+            try:
+                yield targettype(*v)
+            except:
+                logging.exception("Problem converting data from CSV file")
+
+
+def CsvBatchReader(stream: typing.TextIO, delimiter=',', types=None, targettype=None,
+                   batch_size=BATCH_SIZE, columns=False):
+    """ Read a table with a `name:type` header in batches, for processing large files.
+        The values are converted using the types in the header, looked up in `types` and the
+        basic types, or using the annotations of `targettype`.
+        Yields lists of tuples, or with `columns` set dictionaries of columns.
+    """
+    h = read_header(stream, delimiter)
+    if not h:
+        return
+    names, type_names = h
+    if targettype is not None:
+        converters = mk_part_constructors(targettype, types)
+    else:
+        lookup = basic_types.copy()
+        lookup.update(types or {})
+        unknown = [t for t in type_names if t not in lookup]
+        if unknown:
+            raise RuntimeError(f'Unknown types in CSV header: {unknown}')
+        converters = [lookup[t] for t in type_names]
+    converter = TableConverter(names, converters, delimiter)
+    for lines in read_batches(stream, batch_size):
+        yield converter.arrays(lines) if columns else converter.rows(lines)
 
 
 def getConstructor(annotation):
@@ -474,57 +839,108 @@ def getConstructor(annotation):
         return annotation.__name__
     return annotation.annotation
 
+def mk_formatter(constr, delimiter):
+    """ Return a function that formats the values of a column. The values are first passed
+        through the constructor of the column, so that e.g. dates get the right format.
+    """
+    if constr is str:
+        return lambda v: encode_escapes(str(v), delimiter)
+    if constr in (int, float, Decimal):
+        return lambda v: encode_escapes(str(v if type(v) is constr else constr(v)), delimiter)
+    return lambda v: encode_escapes(str(constr(v)), delimiter)
+
+
+class BufferedLines:
+    """ Collects lines and writes them to a stream in batches. """
+    def __init__(self, stream, size=BATCH_SIZE):
+        self.stream = stream
+        self.size = size
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.stream.write('\n'.join(self.lines))
+            self.lines = []
+
+
 def CsvTableWriter(stream: typing.TextIO, records, delimiter=',', formatters=None):
-    records = list(records)
-    if not records:
+    """ Write records to a stream, one at a time. `formatters` can override the formatting
+        of columns, with a function that returns the text for a value.
+    """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
         return
     # Write the table header
-    parts = [f'{a[0]}:{getConstructor(a[1])}' for a in records[0].__annotations__.items()]
+    annotations = first.__annotations__
+    parts = [f'{k}:{getConstructor(a)}' for k, a in annotations.items()]
     stream.write('%s\n' % delimiter.join(parts))
-    keys = list(records[0].__annotations__.keys())
 
     # For all dates in the records, ensure the correct format is used.
-    constructors = {k:v for k, v in records[0].__annotations__.items()}
-    for record in records:
-        for k, constr in constructors.items():
-            setattr(record, k, constr(getattr(record, k)))
+    # Escape special characters and the delimiter
+    formatters = formatters or {}
+    columns = [(operator.attrgetter(k), formatters.get(k) or mk_formatter(a, delimiter))
+               for k, a in annotations.items()]
 
     # Write the table data
-    for line in records:
-        parts = [getattr(line, k) for k in keys]
-        # Escape special characters and the delimiter
-        parts = [encode_escapes(str(p), delimiter) for p in parts]
-        stream.write('%s\n' % delimiter.join(parts))
+    out = BufferedLines(stream)
+    for line in itertools.chain([first], records):
+        out.write(delimiter.join([f(get(line)) for get, f in columns]))
+    out.flush()
 
 
 def CsvWriter(stream: typing.TextIO, collection: Dict[str, Union[List[Any], Dict[str, Any]]], delimiter=';'):
+    """ Write a collection of tables. The tables are lists or dictionaries of records, or
+        iterators over records, and are written one record at a time.
+    """
+    def escape(v):
+        return str(v).replace(delimiter, r'\d').replace('\n', r'\n')
+
     for table, columns in collection.items():
+        lines = iter(columns.values() if isinstance(columns, Mapping) else columns)
+        first = next(lines, None)
+        if first is None and not hasattr(collection, '__annotations__'):
+            # Without records, the header is not known.
+            continue
+        lines = itertools.chain([first], lines) if first is not None else lines
+
         # Write the table name
         stream.write('%s\n'%table)
 
         # Write the table header
         if hasattr(collection, '__annotations__'):
             annotations = zip(*collection.__annotations__[table])
-        elif is_dataclass(columns[0]):
-            names = [k for k, v in columns[0].__dict__.items() if not callable(v)]
-            annotations = [(k, type(v).__name__) for k, v in columns[0].__dict__.items() if not callable(v)]
-            columns = [{k: getattr(c, k) for k in names} for c in columns]
-        elif isinstance(columns[0], dict):
-            annotations = [(k, type(v).__name__) for k, v in columns[0].items()]
+        elif is_dataclass(first):
+            names = [k for k, v in first.__dict__.items() if not callable(v)]
+            annotations = [(k, type(v).__name__) for k, v in first.__dict__.items() if not callable(v)]
+            getter = operator.attrgetter(*names)
+            lines = (getter(c) for c in lines)
+            if len(names) == 1:
+                lines = ((v,) for v in lines)
+        elif isinstance(first, dict):
+            annotations = [(k, type(v).__name__) for k, v in first.items()]
         else:
-            max_cols = max([len(r) for r in columns])
+            max_cols = max([len(r) for r in columns]) if isinstance(columns, list) else len(first)
             annotations = [(i+1, 'str') for i in range(max_cols)]
         parts = ['%s:%s'%(n, t) for n, t in annotations]
         stream.write('%s\n'%delimiter.join(parts))
 
         # Write the table data
-        for line in (columns if isinstance(columns, list) else columns.values()):
+        out = BufferedLines(stream)
+        for line in lines:
             values = line.values() if isinstance(line, Mapping) else line
             if values:
-                stream.write('%s\n'%delimiter.join([str(v).replace(delimiter, r'\d').replace('\n', r'\n') for v in values]))
+                out.write(delimiter.join([escape(v) for v in values]))
             else:
                 # Lines can not be empty: simply write a single delimiter.
-                stream.write(delimiter+'\n')
+                out.write(delimiter)
+        out.flush()
 
         # Write an empty line to signal the end of the table
         stream.write('\n')
@@ -560,30 +976,129 @@ def filter(instream: typing.TextIO, script: str, outstream: typing.TextIO, defin
     dump(result, outstream)
 
 
+# The names of the types used when a table is created from a dataclass.
+csv_type_names = {int: 'int', str: 'str', float: 'float', bool: 'bool', Decimal: 'Decimal',
+                  date: 'date', datetime: 'datetime'}
+
+
+def csv_type_name(t):
+    """ The name of a type in the header of a table, for a type used in a dataclass. """
+    if t in csv_type_names:
+        return csv_type_names[t]
+    # References to other tables use the name of the table.
+    name = getattr(t, '__name__', None)
+    return name if name in supported_types else 'str'
+
+
+def index_tables(stream):
+    """ Find the tables in a binary stream with a multi-table CSV file.
+        Returns a dictionary with the start and end offsets of the section of each table,
+        from the line with its name up to and including the empty line that ends it.
+    """
+    sections = {}
+    offset = 0
+    state = 'name'
+    for line in stream:
+        stripped = line.strip()
+        if state == 'name':
+            if stripped and not stripped.startswith(b'#'):
+                name, start, state = stripped.decode('utf-8'), offset, 'header'
+        elif state == 'header':
+            if stripped and not stripped.startswith(b'#'):
+                state = 'lines'
+        elif not stripped:
+            sections[name] = (start, offset + len(line))
+            state = 'name'
+        offset += len(line)
+    if state != 'name':
+        sections[name] = (start, offset)
+    return sections
+
+
 class CsvDb(db_api):
     """ A wrapper that makes CSV database usable from the generated applications.
         The biggest issue is that the CSV db stores stuff as dicts, while the
         API works in dataclass records.
+
+        When opened, the file is only indexed: each table is parsed when it is first used.
+        When saving, the sections of the tables that were not changed are copied as they are,
+        and the new file replaces the old one in one step. The file is indexed again when it
+        was replaced by another instance.
     """
     def __init__(self, fname, delimiter=','):
         self.filename = fname
         self.delimiter = delimiter
-        with open(fname) as inp:
-            self.data = CsvReader(inp, delimiter)
+        # The tables that were read, by name. Tables with an id are dictionaries keyed by the id.
+        self.data = AnnotatedDict()
+        self.changed = set()
+        self.sections = {}
+        self.stamp = None
+        inp = self.open_file()
+        if inp:
+            inp.close()
+
+    def open_file(self):
+        """ Open the file, indexing it again if it was replaced or changed since it was indexed.
+            Returns None if the file does not exist.
+        """
+        try:
+            inp = open(self.filename, 'rb')
+        except FileNotFoundError:
+            self.sections, self.stamp = {}, None
+            return None
+        st = os.fstat(inp.fileno())
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stamp != self.stamp:
+            self.sections = index_tables(inp)
+            self.stamp = stamp
+            # Table names can be used as types, for references between tables.
+            for name in self.sections:
+                supported_types[name] = int
+        return inp
 
     def __del__(self):
         """ Save the database """
-        self.save()
+        if getattr(self, 'changed', None):
+            self.save()
+
+    def table(self, name, cls=None):
+        """ Return the records of a table, reading it if necessary.
+            If the table does not exist yet, it is created for dataclass `cls`.
+        """
+        if name not in self.data:
+            inp = self.open_file()
+            if inp and name in self.sections:
+                start, end = self.sections[name]
+                with inp:
+                    inp.seek(start)
+                    text = inp.read(end - start).decode('utf-8')
+                collection = CsvReader(io.StringIO(text), self.delimiter)
+                self.data[name] = collection[name]
+                self.data.__annotations__[name] = collection.__annotations__[name]
+            else:
+                if inp:
+                    inp.close()
+                if cls is None:
+                    raise KeyError(f'No table {name} in {self.filename}')
+                fields = dataclasses.fields(cls)
+                self.data[name] = {}
+                self.data.__annotations__[name] = [[f.name for f in fields], [csv_type_name(f.type) for f in fields]]
+                supported_types[name] = int
+        return self.data[name]
+
+    def values(self, name, record):
+        """ The values of a record, in the order of the columns of its table. """
+        values = asdict(record)
+        return {k: values.get(k) for k in self.data.__annotations__[name][0]}
 
     def get(self, table: Type[Record], index: int) -> Record:
         if not isinstance(table, str):
-            tablename = table.__name__
-            data = self.data[tablename][index]
+            data = self.table(table.__name__)[index]
             return table(**data)
         raise RuntimeError("We need to know the type of the data")
 
     def get_many(self, table: Type[Record], indices: List[int]=None) -> List[Record]:
-        indices = indices or list(self.data[table.__name__].keys())
+        indices = indices or list(self.table(table.__name__).keys())
         records = [self.get(table, i) for i in indices]
         records = [r for r in records if r]
         return records
@@ -591,40 +1106,83 @@ class CsvDb(db_api):
     def add(self, table: Union[Type[Record], Record], record: Record=None) -> Record:
         if not record:
             record = table
-            table = type(table).__name__
-        elif not isinstance(table, str):
-            table = table.__name__
-        current = max(self.data[table].keys())
+            table = type(table)
+        name = table if isinstance(table, str) else table.__name__
+        records = self.table(name, type(record))
+        current = max(records.keys(), default=0)
         record.id = current+1
-        self.data[table][record.id] = asdict(record)
+        records[record.id] = self.values(name, record)
+        self.changed.add(name)
         self.save()
         return record
 
     def set(self, record: Record) -> None:
         table = type(record).__name__
-        self.data[table][record.id] = asdict(record)
+        records = self.table(table, type(record))
+        records[record.id] = self.values(table, record)
+        self.changed.add(table)
         return record
 
     def update(self, table: Union[Type[Record], dict], record: dict=None) -> None:
         if not record:
             record = table
-            table = type(table).__name__
-        elif not isinstance(table, str):
-            table = table.__name__
-        current = self.data[table][int(record['id'])]
+            table = type(table)
+        name = table if isinstance(table, str) else table.__name__
+        current = self.table(name)[int(record['id'])]
         for k, v in record.items():
             current[k] = v
+        self.changed.add(name)
         self.save()
-        return table(**current)
+        return current if isinstance(table, str) else table(**current)
 
     def delete(self, table:Type[Record], index: int) -> None:
         if not isinstance(table, str):
             table = table.__name__
-        del self.data[table][index]
+        del self.table(table)[index]
+        self.changed.add(table)
 
     def save(self):
-        with open(self.filename, 'w') as out:
-            CsvWriter(out, self.data, self.delimiter)
+        """ Write the changed tables. The other tables are copied from the current file. """
+        if not self.changed:
+            return
+        # Unchanged tables are copied from the current file, which may have been saved by others.
+        inp = self.open_file()
+        names = list(self.sections) + [n for n in self.data if n not in self.sections]
+        tmp = f'{self.filename}.{os.getpid()}.tmp'
+        sections = {}
+        try:
+            with open(tmp, 'wb') as out:
+                for name in names:
+                    start = out.tell()
+                    if name in self.changed or name not in self.sections:
+                        tables = AnnotatedDict({name: self.table(name)})
+                        tables.__annotations__[name] = self.data.__annotations__[name]
+                        text = io.StringIO()
+                        CsvWriter(text, tables, self.delimiter)
+                        out.write(text.getvalue().encode('utf-8'))
+                    else:
+                        begin, end = self.sections[name]
+                        inp.seek(begin)
+                        data = inp.read(end - begin)
+                        out.write(data)
+                        if not data.endswith(b'\n\n'):
+                            # The last table in the file need not end with an empty line.
+                            out.write(b'\n' if data.endswith(b'\n') else b'\n\n')
+                    sections[name] = (start, out.tell())
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp, self.filename)
+            st = os.stat(self.filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            if inp:
+                inp.close()
+        self.sections = sections
+        self.stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.changed.clear()
 
 
 class SplitCsvDb(db_api):
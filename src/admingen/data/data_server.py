@@ -12,7 +12,8 @@ import operator
 from dataclasses import is_dataclass, asdict
 from werkzeug.exceptions import BadRequest, NotFound
 from admingen.data import serialiseDataclasses, serialiseDataclass, deserialiseDataclass
-from admingen.data.file_db import filter_context, multi_sort, do_leftjoin
+from admingen.data.file_db import filter_context, multi_sort, do_leftjoin, allocate_id
+from admingen.data.expressions import compile_condition, ExpressionError
 
 # Define the key for the data element that is added to indicate limited queries have reached the end
 IS_FINAL_KEY = '__is_last_record'
@@ -20,6 +21,22 @@ IS_FINAL_KEY = '__is_last_record'
 
 root_path = os.getcwd()
 db = None
+# The database and class of each table, by name, as configured by the application.
+table_dbs = {}
+table_types = {}
+
+
+def set_databases(databases, datamodel):
+    """ Let the record helpers below use the databases of the application. """
+    for name, tables in datamodel.items():
+        for t in tables:
+            table_dbs[t.__name__] = databases[name]
+            table_types[t.__name__] = t
+
+
+def table_db(name):
+    """ The database that holds a table, or None if the records are plain files. """
+    return table_dbs.get(name, db)
 
 
 def mk_response(reply):
@@ -30,6 +47,15 @@ def mk_response(reply):
 def read_records(fullpath, cls=None, raw=False):
     """ Reads all records in a table and returns them as dictionaries. """
     # TODO: Make me return record objects instead of dictionaries.
+    name = os.path.basename(fullpath.rstrip('/'))
+    database = table_db(name)
+    if database is not None and (cls or name in table_types):
+        data = database.get_many(cls or table_types[name])
+        if name == 'User' and not raw:
+            for d in data:
+                d.password = '****'
+        return data if cls else [asdict(d) for d in data]
+
     if fullpath[0] != '/':
         fullpath = os.path.join(root_path, fullpath)
 
@@ -103,12 +129,18 @@ def update_record(tablecls, index, db, data, update=True, mk_response=True):
 
 
 def add_record(table, tablecls, data, mk_response=True):
+    database = table_db(table)
+    if database is not None:
+        data_str = serialiseDataclass(database.add(tablecls(**data)))
+        if mk_response:
+            return flask.make_response(data_str, 201)
+        return data_str
+
     fullpath = mk_fullpath(table)
 
 
     # There is no ID field, create one.
-    ids = [int(f) for f in os.listdir(fullpath) if f.isnumeric()]
-    my_id = max(ids) + 1 if ids else 1
+    my_id = allocate_id(fullpath)
     data['id'] = my_id
     fullpath = f'{fullpath}/{my_id}'
     print('Created ID', str(my_id))
@@ -122,81 +154,83 @@ def add_record(table, tablecls, data, mk_response=True):
     return data_str
 
 
-filter_context = {
-    'isIn': operator.contains,
-    'isTrue': lambda x: x.lower()=='true',
-    'isFalse': lambda x: x.lower()!='true',
-    'and_': operator.and_,
-    'eq': operator.eq,
-    'neq': operator.ne,
-    'lt': operator.lt,
-    'gt': operator.gt,
-    'le': operator.le,
-    'ge': operator.ge
-}
-
 def register_db_handlers(db_name, app, prefix, db, table_classes):
     # We need to use a custom "Blueprint" to register multiple handlers
     # that use the same function name.
     bp = flask.Blueprint(prefix, 'db_api')
 
+    @bp.before_request
+    def begin_unit_of_work():
+        # Within a request, each record is read from the database only once.
+        flask.g.unit_of_work = db.unit_of_work()
+        flask.g.unit_of_work.__enter__()
+
+    @bp.teardown_request
+    def end_unit_of_work(exc):
+        if unit_of_work := flask.g.pop('unit_of_work', None):
+            unit_of_work.__exit__(None, None, None)
+
     @bp.route('/<path:table>', methods=['GET'])
     def get_table(table):
         if not table:
             return
         tablecls = table_classes[table]
+        # The value of resolve_fk can be the number of levels of foreign keys to resolve.
+        resolve_fk = flask.request.args.get('resolve_fk')
         details = {
-            'resolve_fk': 'resolve_fk' in flask.request.args
+            'resolve_fk': int(resolve_fk) if resolve_fk and resolve_fk.isdigit() else resolve_fk is not None
         }
 
+        # The password hashes of users must not be revealed, not even through filtering, joining or sorting.
+        hidden = {'password': '****'} if table == 'User' else {}
+        secret = set(hidden)
+
+        b_table = None
         if 'join' in flask.request.args:
             b_table, condition = flask.request.args['join'].split(',', maxsplit=1)
-            def condition_func(rec_a, rec_b):
-                """ Function returns true if d2 is to be joined to d1 """
-                a_dict = asdict(rec_a)
-                b_dict = asdict(rec_b)
-                local_context = {table: a_dict, b_table: b_dict}
-                local_context.update(b_dict)
-                local_context.update(a_dict)
-                return bool(eval(condition, filter_context, local_context))
-            details['join'] = (table_classes[b_table], condition_func)
-
-        data = db.query(tablecls, **details)
-        # For the User class, replace the password with asterixes.
-        if table == 'User':
-            for d in data:
-                d.password = '****'
-        # First perform any joins
+            if b_table == 'User':
+                secret.add('password')
+            try:
+                condition = compile_condition(condition, (table, b_table))
+            except ExpressionError as e:
+                raise BadRequest(str(e))
+            if condition.names & secret:
+                raise BadRequest(f'Can not join on {", ".join(condition.names & secret)}')
+            details['join'] = (table_classes[b_table], condition)
 
         # Apply the filter
         if 'filter' in flask.request.args:
-            def func(item, condition):
-                d = item.asdict() if hasattr(item, 'asdict') else asdict(item) if is_dataclass(item) else item
-                try:
-                    return bool(eval(condition, filter_context, d))
-                except:
-                    logging.exception(f"Error in evaluating {condition} with variables {d}")
-                    raise
-
-            condition = flask.request.args['filter']
-            data = [item for item in data if func(item, condition)]
+            try:
+                condition = compile_condition(flask.request.args['filter'])
+            except ExpressionError as e:
+                raise BadRequest(str(e))
+            if condition.names & secret:
+                raise BadRequest(f'Can not filter on {", ".join(condition.names & secret)}')
+            details['filter'] = condition
 
         # Sort the results
-        if 'sort' in flask.request.args:
-            data = multi_sort(flask.request.args['sort'], data)
-        elif data:
-            if isinstance(data[0], dict):
-                data = sorted(data, key=lambda d: d['id'])
-            else:
-                data = sorted(data, key=lambda d: d.id)
-
-        # Apply limit and offset
-        is_final = True
+        sort = flask.request.args.get('sort', 'id')
+        details['sort'] = ','.join(k for k in sort.split(',') if k.split(':')[0] not in hidden) or 'id'
+
+        # Apply limit and offset. One extra record is requested to determine if the end is reached.
+        limit = None
         if 'limit' in flask.request.args:
-            offset = int(flask.request.args.get('offset', 0))
             limit = int(flask.request.args['limit'])
-            is_final = len(data) < offset + limit
-            data = data[offset:offset + limit]
+            details['offset'] = int(flask.request.args.get('offset', 0))
+            details['limit'] = limit + 1
+
+        data = db.query(tablecls, **details)
+        # For the User class, replace the password with asterixes.
+        for d in data:
+            for k, v in hidden.items():
+                setattr(d, k, v)
+            if b_table == 'User' and getattr(d, 'User', None) is not None:
+                d.User.password = '****'
+
+        is_final = True
+        if limit is not None:
+            is_final = len(data) <= limit
+            data = data[:limit]
 
         # Check for the single argument
         if flask.request.args.get('single', False):
@@ -167,6 +167,11 @@ def date_or_dash(fmt):
     return MyDate
 
 
+def record_json(self):
+    """ Return the fields of a record as a dictionary, for serialisation. """
+    return asdict(self)
+
+
 def mydataclass(cls):
     """ Returns a standard Python dataclass with one additional field: id.
         The constructor assures that the keys of the object have the correct type.
@@ -223,9 +228,6 @@ def mydataclass(cls):
             v = convert_field(cls, k, data.get(k, None))
             setattr(self, k, v)
 
-    def __json__(self):
-        return asdict(self)
-
     def __hash__(self):
         return self.id
 
@@ -241,7 +243,9 @@ def mydataclass(cls):
 
 
     cls.__init__ = __init__
-    cls.__json__ = __json__
+    # Marks the constructor, so that records can be decoded without calling it.
+    cls._record_init = __init__
+    cls.__json__ = record_json
     cls.__hash__ = __hash__
     cls.set_attr = my_setattr
     cls.get_fks = classmethod(get_fks)
@@ -1,8 +1,12 @@
 
 import enum
+import heapq
+import threading
 import operator
+import functools
+from itertools import islice
 from typing import List, Type, Union, Callable
-from dataclasses import asdict
+from dataclasses import asdict, is_dataclass
 from contextlib import contextmanager
 import logging
 
@@ -20,10 +24,121 @@ filter_context = {
     'ge': operator.ge
 }
 
+# The number of records that is read and processed at once by a query.
+QUERY_BATCH_SIZE = 100
+
 # A base class to be used in typeing.
 class Record: pass
 
 
+@functools.lru_cache(maxsize=256)
+def parse_sort(descriptor):
+    """ Split a sort descriptor like "a,b:desc,c" into a tuple of (key, descending) tuples. """
+    result = []
+    for key in descriptor.split(','):
+        key, _, direction = key.strip().partition(':')
+        result.append((key, direction == 'desc'))
+    return tuple(result)
+
+
+def none_safe(getter):
+    """ Wrap a key function so that None values are smaller than any other value. """
+    def key(item):
+        v = getter(item)
+        return (v is not None, v)
+    return key
+
+
+def multi_sort(descriptor, data, limit=None):
+    """ A function to sort a list of data (dictionaries or records).
+        The sort descriptor is a comma-separated string of keys into the dicts.
+        Optionally, the key is followed by the word ":desc", for example
+            "a,b:desc,c"
+        When a limit is given, only the first `limit` items of the sorted data are returned.
+        None values are smaller than any other value, like NULL in SQLite: they come
+        first when sorting ascending, and last when sorting descending.
+    """
+    data = list(data)
+    if not data:
+        return data
+    getter = operator.itemgetter if isinstance(data[0], dict) else operator.attrgetter
+
+    # Consecutive keys with the same direction are sorted on in a single pass.
+    passes = []
+    for key, desc in parse_sort(descriptor):
+        if passes and passes[-1][1] == desc:
+            passes[-1][0].append(key)
+        else:
+            passes.append(([key], desc))
+
+    def sort(keyfunc):
+        if len(passes) == 1:
+            keys, desc = passes[0]
+            key = keyfunc(keys)
+            if limit is not None and limit < len(data) // 4:
+                # A partial sort is cheaper when only a few items are needed.
+                return (heapq.nlargest if desc else heapq.nsmallest)(limit, data, key=key)
+            return sorted(data, key=key, reverse=desc)[:limit]
+        # Python's sort is stable: sort on the least significant keys first.
+        result = data
+        for keys, desc in reversed(passes):
+            result = sorted(result, key=keyfunc(keys), reverse=desc)
+        return result[:limit]
+
+    try:
+        return sort(lambda keys: getter(*keys))
+    except TypeError:
+        # Some values can not be compared, most likely because they are None.
+        def safe_key(keys):
+            getters = [none_safe(getter(k)) for k in keys]
+            if len(getters) == 1:
+                return getters[0]
+            return lambda item: tuple(g(item) for g in getters)
+        return sort(safe_key)
+
+
+def batched(iterable, size):
+    """ Yield lists of at most `size` items from an iterable. """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def join_matches(condition, b_records):
+    """ Return a function that yields, in order, the records from b_records that match
+        a record according to a join condition.
+        Conditions that can supply keys for an equality (see Condition.equi_join_keys)
+        are run as a hash join. Other conditions are tried on every record in b_records.
+    """
+    b_records = list(b_records)
+    index = None
+    left_key = None
+
+    def matches(record):
+        nonlocal index, left_key
+        if index is None:
+            # The first record is used to see if a hash join can be used.
+            index = False
+            keys = b_records and getattr(condition, 'equi_join_keys', None) \
+                   and condition.equi_join_keys(record, b_records[0])
+            if keys:
+                left_key, right_key = keys
+                try:
+                    index = {}
+                    for b in b_records:
+                        index.setdefault(right_key(b), []).append(b)
+                except TypeError:
+                    # The keys can not be hashed.
+                    index = False
+        candidates = b_records
+        if index is not False:
+            try:
+                candidates = index.get(left_key(record), [])
+            except TypeError:
+                pass
+        return (b for b in candidates if condition(record, b))
+    return matches
+
 
 def getJsonJoined(a_cls, b_cls):
     """ Return an function that returns something that is jsonified """
@@ -34,6 +149,28 @@ def getJsonJoined(a_cls, b_cls):
     return jsonify
 
 
+def update_fields(table, data, changes: dict):
+    """ Update a record with the values in a dictionary, converting them to the right type.
+        The id and any keys that are not fields of the table are ignored.
+    """
+    for k, v in changes.items():
+        if k not in table.__annotations__.keys():
+            # This is not an actual attribute of this table.
+            # This is not an error: clients are free to enrich their objects.
+            continue
+        if k == 'id':
+            # The ID attribute can not be changed.
+            continue
+        if v is None or (isinstance(v, str) and v in ['None', 'null', '']):
+            value = None
+        else:
+            if not v or type(v) != data.__annotations__[k]:
+                value = data.__annotations__[k](v)
+            else:
+                value = v
+        setattr(data, k, value)
+
+
 class DbActions(enum.IntEnum):
     add    = 1
     update = 3
@@ -56,6 +193,7 @@ class db_api:
         self.active_hooks = set()
         self.current_transaction = None
         self.queue = []
+        self.local = threading.local()
     def get(self, table: Type[Record], index: int) -> Record:
         raise NotImplementedError()
     def add(self, table: Union[Type[Record], Record], record: Record=None) -> Record:
@@ -69,6 +207,13 @@ class db_api:
         raise NotImplementedError()
     def delete(self, table:Type[Record], index:int) -> None:
         raise NotImplementedError()
+    def add_many(self, table: Type[Record], records: List[Record]) -> List[Record]:
+        """ Add a number of records at once. Backends can override this to do it more efficiently. """
+        return [self.add(table, r) if isinstance(r, dict) else self.add(r) for r in records]
+    def update_many(self, table: Type[Record], records: List[dict]) -> None:
+        """ Update a number of records at once. Each record is a dictionary with an id. """
+        for r in records:
+            self.update(table, r)
 
 
     def define_hook(self, table, action):
@@ -101,42 +246,119 @@ class db_api:
         """
         raise NotImplementedError()
 
+    def iter_records(self, table: Type[Record], reverse=False):
+        """ Iterate over all records in a table, in order of their ID.
+            Backends that can read records lazily should override this, so that queries
+            with a limit stop reading as soon as they have enough records.
+        """
+        return iter(sorted(self.get_many(table), key=lambda r: r.id, reverse=reverse))
+
+    @contextmanager
+    def unit_of_work(self):
+        """ Within a unit of work (e.g. a request), each record is read from the database only once.
+            The records read are kept in an identity map for the current thread. Backends that
+            support it return copies of these records, so callers can still change the records
+            they receive. Nested units of work share the map of the outermost one.
+        """
+        if self.identity_map() is not None:
+            yield self
+            return
+        self.local.identity_map = {}
+        try:
+            yield self
+        finally:
+            self.local.identity_map = None
+
+    def identity_map(self):
+        """ The records read in the current unit of work, by (table name, id); None outside a unit of work. """
+        return getattr(self.local, 'identity_map', None)
+
+    def forget(self, table: Type[Record], index: int):
+        """ Remove a changed record from the identity map. """
+        identities = self.identity_map()
+        if identities is not None:
+            identities.pop((table.__name__, int(index)), None)
+
+    def resolve_foreign_keys(self, table: Type[Record], records: List[Record], depth=1):
+        """ Replace the foreign keys in a list of records by the records they refer to.
+            With a depth larger than 1, the foreign keys in those records are resolved as well.
+            The keys are resolved breadth-first: each level takes one `get_many` per table.
+        """
+        level = {table: list(records)}
+        for _ in range(int(depth)):
+            # Collect the foreign keys to be resolved for each foreign table.
+            wanted = {}
+            for tbl, recs in level.items():
+                for member, ftable in tbl.get_fks().items():
+                    ids = wanted.setdefault(ftable, set())
+                    ids.update(i for r in recs if isinstance(i := getattr(r, member), int))
+            foreigns = {ftable: {r.id: r for r in self.get_many(ftable, sorted(ids)) if r} if ids else {}
+                        for ftable, ids in wanted.items()}
+            for tbl, recs in level.items():
+                for member, ftable in tbl.get_fks().items():
+                    lookup = foreigns[ftable]
+                    for r in recs:
+                        if not is_dataclass(value := getattr(r, member)):
+                            setattr(r, member, lookup.get(value, None))
+            level = {ftable: list(recs.values()) for ftable, recs in foreigns.items() if recs}
+            if not level:
+                break
+
+    def join_records(self, table: Type[Record], records: List[Record], join, b_records):
+        """ Add the first record from b_records that matches the join condition to each record.
+            Instead of a list of records, b_records can be a function as returned by `join_matches`.
+        """
+        tname = join[0]
+        if not isinstance(tname, str):
+            tname = tname.__name__
+        matches = b_records if callable(b_records) else join_matches(join[1], b_records)
+        for rec in records:
+            b = next(matches(rec), None)
+            setattr(rec, tname, b)
+            if b is not None:
+                rec.__json__ = getJsonJoined(table, join[0]).__get__(rec, rec.__class__)
+
+    def refine(self, table: Type[Record], records, filter=None, join=None, resolve_fk=None):
+        """ Resolve foreign keys, join and filter a stream of records, one batch at a time.
+            This is a generator, so it stops reading records as soon as the caller has enough.
+        """
+        matches = join_matches(join[1], self.query(join[0])) if join else None
+        for batch in batched(records, QUERY_BATCH_SIZE):
+            if resolve_fk:
+                self.resolve_foreign_keys(table, batch, resolve_fk)
+            if join:
+                self.join_records(table, batch, join, matches)
+            if filter:
+                batch = [rec for rec in batch if filter(rec)]
+            yield from batch
+
     def query(self, table:Type[Record], filter=None, join=None, resolve_fk=None,
-              sort=None, limit=None) -> List[Record]:
+              sort=None, limit=None, offset=0) -> List[Record]:
         """ A simple query function that uses in-memory filtering.
             A join can be defined by supplying a tuple with a Table name and
             a lambda function expecting two arguments that returns True if they match.
             The first argument is the original table, the second the table being joined.
             A filter can be supplied as a lambda function that receives
             a record as argument.
+            With resolve_fk, foreign keys are replaced by the records they refer to. It can be
+            set to a number of levels of foreign keys to be resolved.
+            The sort argument is a sort descriptor as used by `multi_sort`.
+            Of the sorted results, `limit` records are returned starting at `offset`.
+            Without a sort, the records are returned in order of their ID.
         """
-        # We need to make an object of the whole contents of a directory
-        records = self.get_many(table)
-
-        if resolve_fk:
-            for member, ftable in table.get_fks().items():
-                ids = [getattr(r, member) for r in records]
-                ids_set = list(set(ids))
-                foreigns = {(r and r.id): r for r in self.get_many(ftable, ids_set)}
-                for r in records:
-                    setattr(r, member, foreigns.get(getattr(r, member), None))
-
-        if join:
-            b_records = self.query(join[0])
-            for rec in records:
-                tname = join[0]
-                if not isinstance(tname, str):
-                    tname = tname.__name__
-                setattr(rec, tname, None)
-                for b in b_records:
-                    if join[1](rec, b):
-                        setattr(rec, tname, b)
-                        rec.__json__ = getJsonJoined(table, join[0]).__get__(rec, rec.__class__)
-                        break
-
-        if filter:
-            records = [rec for rec in records if filter(rec)]
-        return records
+        if sort in [None, 'id', 'id:desc']:
+            # The records are read in order, so reading can stop as soon as the limit is reached.
+            records = self.iter_records(table, reverse=(sort == 'id:desc'))
+            sort = None
+        else:
+            records = self.get_many(table)
+
+        records = self.refine(table, records, filter, join, resolve_fk)
+
+        end = None if limit is None else offset + limit
+        if sort:
+            records = multi_sort(sort, records, limit=end)
+        return list(islice(records, offset, end))
     def count(self, table: Type[Record], filter=None):
         return len(self.query(table, filter))
     def undoDelete(self, data):
@@ -170,7 +392,8 @@ class db_api:
             logging.error("Exception during transaction: rolling back!")
             self.transactionRollback()
             raise
-        self.transactionEnd()
+        finally:
+            self.transactionEnd()
 
 def update_unique(db, table, new_data, pk=['id']):
     """ Update a table in the database.
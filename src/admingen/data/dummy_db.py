@@ -6,7 +6,7 @@ import enum
 from dataclasses import is_dataclass, asdict, fields
 from typing import Union, Type, Callable, List
 from admingen.data import serialiseDataclass, deserialiseDataclass
-from .db_api import db_api, filter_context, Record
+from .db_api import db_api, filter_context, Record, QUERY_BATCH_SIZE
 
 
 class UnknownRecord(RuntimeError): pass
@@ -139,5 +139,8 @@ class DummyDatabase(db_api):
             return [data[i] for i in indices if i in data]
         return list(data.values())
 
-
-
+    def iter_records(self, table: Type[Record], reverse=False):
+        """ Retrieve the records in a table lazily, in order of their ID. """
+        ids = sorted(self.data[table.__name__], reverse=reverse)
+        for i in range(0, len(ids), QUERY_BATCH_SIZE):
+            yield from self.get_many(table, ids[i:i + QUERY_BATCH_SIZE])
@@ -0,0 +1,368 @@
+""" Compiler for the filter and join conditions used in queries.
+
+The conditions are Python expressions like "eq(questionaire['id'], 3)" or
+"ingevuld is not None", as used in the REST interface of the data server.
+Instead of calling `eval` for every record, a condition is parsed once and checked
+to contain only safe constructs. It is then turned into a tree of closures that
+read the attributes of the records directly.
+
+Compiled conditions are cached, so the same query string is parsed only once.
+"""
+
+import ast
+import functools
+import numbers
+import operator
+from typing import Callable, Tuple
+
+from .db_api import filter_context
+
+
+class ExpressionError(RuntimeError): pass
+
+
+# The builtin functions that can be used in conditions, next to the filter_context.
+safe_builtins = {f.__name__: f for f in [int, float, str, bool, len, abs, min, max, round]}
+
+binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+unary_operators = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+compare_operators = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+# The functions that compare like an operator in SQL.
+sql_compare_functions = {
+    'eq': ast.Eq,
+    'neq': ast.NotEq,
+    'lt': ast.Lt,
+    'gt': ast.Gt,
+    'le': ast.LtE,
+    'ge': ast.GtE,
+}
+
+
+class NotSQL(Exception):
+    """ Raised internally when a condition can not be expressed in SQL. """
+
+
+def lookup(container, key):
+    """ Subscripts on records retrieve attributes, so that e.g. "questionaire['id']"
+        works on records with resolved foreign keys.
+    """
+    if isinstance(container, (dict, list, tuple, str)):
+        return container[key]
+    if not isinstance(key, str) or key.startswith('_'):
+        raise ExpressionError(f'Private or invalid attribute {key!r} not allowed')
+    return getattr(container, key)
+
+
+def has_field(record, name):
+    return name in record if isinstance(record, dict) else hasattr(record, name)
+
+
+class Condition:
+    """ A compiled condition. Call it with one record for each table it was compiled for
+        (just one for a filter), and it returns True if the records satisfy the condition.
+    """
+    def __init__(self, text: str, tables: Tuple[str, ...]=()):
+        self.text = text
+        self.tables = tables
+        # The names of the fields and attributes used in the condition.
+        self.names = set()
+        try:
+            self.tree = ast.parse(text.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ExpressionError(f'Could not parse condition {text}: {e}')
+        self.func = self.compile(self.tree)
+
+    def __call__(self, *records) -> bool:
+        return bool(self.func(records))
+
+    def __repr__(self):
+        return f'Condition({self.text!r})'
+
+    def compile(self, node) -> Callable:
+        """ Turn an AST node into a function that takes a tuple of records. """
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda records: value
+
+        if isinstance(node, ast.Name):
+            return self.compile_name(node.id)
+
+        if isinstance(node, (ast.Tuple, ast.List)):
+            items = [self.compile(n) for n in node.elts]
+            return lambda records: tuple(f(records) for f in items)
+
+        if isinstance(node, ast.BoolOp):
+            items = [self.compile(n) for n in node.values]
+            if isinstance(node.op, ast.And):
+                def and_(records):
+                    result = True
+                    for f in items:
+                        result = f(records)
+                        if not result:
+                            break
+                    return result
+                return and_
+            def or_(records):
+                result = False
+                for f in items:
+                    result = f(records)
+                    if result:
+                        break
+                return result
+            return or_
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in unary_operators:
+            op = unary_operators[type(node.op)]
+            operand = self.compile(node.operand)
+            return lambda records: op(operand(records))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in binary_operators:
+            op = binary_operators[type(node.op)]
+            left, right = self.compile(node.left), self.compile(node.right)
+            return lambda records: op(left(records), right(records))
+
+        if isinstance(node, ast.Compare):
+            ops = [compare_operators[type(op)] for op in node.ops]
+            left = self.compile(node.left)
+            comparators = [self.compile(n) for n in node.comparators]
+            if len(ops) == 1:
+                op, right = ops[0], comparators[0]
+                return lambda records: op(left(records), right(records))
+            def compare(records):
+                a = left(records)
+                for op, f in zip(ops, comparators):
+                    b = f(records)
+                    if not op(a, b):
+                        return False
+                    a = b
+                return True
+            return compare
+
+        if isinstance(node, ast.IfExp):
+            test, body, orelse = [self.compile(n) for n in [node.test, node.body, node.orelse]]
+            return lambda records: body(records) if test(records) else orelse(records)
+
+        if isinstance(node, ast.Subscript):
+            container, key = self.compile(node.value), self.compile(node.slice)
+            if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                self.names.add(node.slice.value)
+            return lambda records: lookup(container(records), key(records))
+
+        if isinstance(node, ast.Slice):
+            parts = [self.compile(n) if n else (lambda records: None) for n in [node.lower, node.upper, node.step]]
+            return lambda records: slice(*[f(records) for f in parts])
+
+        if isinstance(node, ast.Attribute):
+            if node.attr.startswith('_'):
+                raise ExpressionError(f'Private attribute {node.attr} not allowed in {self.text}')
+            self.names.add(node.attr)
+            container, attr = self.compile(node.value), node.attr
+            return lambda records: getattr(container(records), attr)
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.keywords:
+                raise ExpressionError(f'Unsupported function call in {self.text}')
+            name = node.func.id
+            func = filter_context.get(name) or safe_builtins.get(name)
+            if func is None:
+                raise ExpressionError(f'Unknown function {name} in {self.text}')
+            args = [self.compile(n) for n in node.args]
+            if len(args) == 1:
+                arg = args[0]
+                return lambda records: func(arg(records))
+            if len(args) == 2:
+                a, b = args
+                return lambda records: func(a(records), b(records))
+            return lambda records: func(*[f(records) for f in args])
+
+        raise ExpressionError(f'Unsupported construct {type(node).__name__} in {self.text}')
+
+    def compile_name(self, name):
+        """ A name refers to a table (i.e. the record for that table) or a field.
+            Fields are looked up in the records in order.
+        """
+        if name in self.tables:
+            i = self.tables.index(name)
+            return lambda records: records[i]
+        if name.startswith('_'):
+            raise ExpressionError(f'Private name {name} not allowed in {self.text}')
+        self.names.add(name)
+
+        def field(records):
+            if len(records) == 1:
+                r = records[0]
+                return r[name] if isinstance(r, dict) else getattr(r, name)
+            for r in records:
+                if isinstance(r, dict):
+                    if name in r:
+                        return r[name]
+                elif hasattr(r, name):
+                    return getattr(r, name)
+            raise ExpressionError(f'Unknown field {name} in {self.text}')
+        return field
+
+    def equi_join_keys(self, left, right):
+        """ For a join condition that requires an expression on the first table to equal an
+            expression on the second (e.g. "eq(customer, Customer['id'])"), return two functions
+            that calculate these expressions for a record of the first and second table.
+            `left` and `right` are example records, used to find the table for each field.
+            Returns None if the condition contains no such equalities.
+        """
+        if len(self.tables) != 2:
+            return None
+        conjuncts = self.tree.values if isinstance(self.tree, ast.BoolOp) and isinstance(self.tree.op, ast.And) \
+            else [self.tree]
+        lefts, rights = [], []
+        for node in conjuncts:
+            if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], ast.Eq):
+                operands = [node.left, node.comparators[0]]
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'eq' \
+                    and len(node.args) == 2 and not node.keywords:
+                operands = node.args
+            else:
+                continue
+            sides = [self.side(n, left, right) for n in operands]
+            if sides == [1, 0]:
+                operands = operands[::-1]
+            elif sides != [0, 1]:
+                continue
+            lefts.append(self.compile(operands[0]))
+            rights.append(self.compile(operands[1]))
+        if not lefts:
+            return None
+
+        def left_key(record):
+            records = (record, None)
+            return tuple(f(records) for f in lefts)
+
+        def right_key(record):
+            records = (None, record)
+            return tuple(f(records) for f in rights)
+        return left_key, right_key
+
+    def side(self, node, left, right):
+        """ Return the index of the table an expression depends on, or None if it depends
+            on both or neither.
+        """
+        functions = {id(n.func) for n in ast.walk(node) if isinstance(n, ast.Call)}
+        sides = set()
+        for n in ast.walk(node):
+            if not isinstance(n, ast.Name) or id(n) in functions:
+                continue
+            if n.id in self.tables:
+                sides.add(self.tables.index(n.id))
+            elif has_field(left, n.id):
+                sides.add(0)
+            elif has_field(right, n.id):
+                sides.add(1)
+            else:
+                return None
+        return sides.pop() if len(sides) == 1 else None
+
+    def to_sql(self, column: Callable[[str], object]):
+        """ Translate the condition into an SQLAlchemy clause, for conditions with one table.
+            `column` returns the column for a field name, or None if there is no such column.
+            SQL differs from Python in its truthiness and in how it compares NULL, so only
+            conditions that select exactly the same records are translated: comparisons,
+            combined with `and`, of columns that can not be NULL and constants of the same type.
+            Any column can be tested with `is None`.
+            Returns None if the condition can not be expressed in SQL.
+        """
+        try:
+            return self.sql(self.tree, column)
+        except NotSQL:
+            return None
+
+    def sql(self, node, column):
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            return functools.reduce(operator.and_, [self.sql(n, column) for n in node.values])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and len(node.args) == 2 \
+                and not node.keywords:
+            if node.func.id == 'and_':
+                return operator.and_(*[self.sql(n, column) for n in node.args])
+            if node.func.id in sql_compare_functions:
+                return self.sql_compare(sql_compare_functions[node.func.id], *node.args, column)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            return self.sql_compare(type(node.ops[0]), node.left, node.comparators[0], column)
+        raise NotSQL()
+
+    def sql_compare(self, op, left, right, column):
+        if op in (ast.Is, ast.IsNot):
+            if not isinstance(left, ast.Name) or not isinstance(right, ast.Constant) or right.value is not None:
+                raise NotSQL()
+            c = column(left.id)
+            if c is None:
+                raise NotSQL()
+            return c.is_(None) if op == ast.Is else c.is_not(None)
+        if op in (ast.In, ast.NotIn):
+            if not isinstance(right, (ast.Tuple, ast.List)) or not isinstance(left, ast.Name):
+                raise NotSQL()
+            c = self.sql_operand(left, column)
+            values = [self.sql_operand(n, column) for n in right.elts]
+            if any(hasattr(v, 'type') or sql_kind(v) is not sql_kind(c) for v in values):
+                raise NotSQL()
+            return c.in_(values) if op == ast.In else c.not_in(values)
+        a, b = self.sql_operand(left, column), self.sql_operand(right, column)
+        if sql_kind(a) is not sql_kind(b):
+            raise NotSQL()
+        result = compare_operators[op](a, b)
+        if isinstance(result, bool):
+            # Two constants.
+            raise NotSQL()
+        return result
+
+    def sql_operand(self, node, column):
+        """ A column that can not be NULL, or a constant that is not None. """
+        if isinstance(node, ast.Name):
+            c = column(node.id)
+            if c is not None and not c.nullable:
+                return c
+        elif isinstance(node, ast.Constant) and node.value is not None:
+            return node.value
+        raise NotSQL()
+
+
+def sql_kind(operand):
+    """ The type of the values of an SQL operand. All numbers compare alike. """
+    if hasattr(operand, 'type'):
+        try:
+            t = operand.type.python_type
+        except NotImplementedError:
+            raise NotSQL()
+    else:
+        t = type(operand)
+    return numbers.Number if issubclass(t, numbers.Number) else t
+
+
+@functools.lru_cache(maxsize=256)
+def compile_condition(text: str, tables: Tuple[str, ...]=()) -> Condition:
+    """ Compile a condition for records from the given tables.
+        For a filter, no tables are given and the condition is called with one record.
+        Raises ExpressionError if the condition is invalid or unsafe.
+    """
+    return Condition(text, tuple(tables))
@@ -12,14 +12,21 @@ This module defines a simple class that is the API to this database.
 
 import os, os.path
 import enum
+import json
+import time
+import logging
+import fcntl
+import threading
 import shutil
-import functools
 from copy import copy
+from contextlib import contextmanager, ExitStack
 from urllib.parse import unquote
 from dataclasses import is_dataclass, asdict, fields
 from typing import Union, Type, Callable, List
 from admingen.data import serialiseDataclass, deserialiseDataclass
-from .db_api import db_api, filter_context, Record, DbActions
+from .db_api import db_api, filter_context, Record, DbActions, multi_sort, join_matches, update_fields, \
+    QUERY_BATCH_SIZE
+from .expressions import compile_condition
 
 
 class UnknownRecord(RuntimeError): pass
@@ -27,74 +34,109 @@ class UnknownRecord(RuntimeError): pass
 
 the_db = None
 
-def multi_sort(descriptor, data):
-    """ A function to sort a list of data (dictionaries).
-        The sort descriptor is a comma-separated string of keys into the dicts.
-        Optionally, the key is followed by the word ":desc", for example
-            "a,b:desc,c"
+# The name of the file in each table directory that holds the last ID that was handed out.
+SEQUENCE_FILE = '.sequence'
+# The file in each table directory that is locked while records in the table are changed.
+LOCK_FILE = '.lock'
+
+# Directory time stamps that are less than this many nanoseconds old when a table is loaded,
+# are not trusted: the directory could be modified again within the resolution of the stamp.
+RACY_STAMP_NS = 2_000_000_000
+
+# The journal of the transaction being committed, in the root directory of the database.
+JOURNAL_FILE = '.journal'
+# The last line of a complete journal.
+JOURNAL_COMMIT = 'COMMIT'
+# The extension of the files that contain records written in a transaction, until it is committed.
+STAGE_EXTENSION = '.stage'
+
+
+def sync_dir(dirname):
+    """ Ensure the changes to the entries in a directory are written to disk. """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_file(path):
+    """ Ensure the contents of a file are written to disk. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file(fullpath, data, sync=False):
+    """ Replace the contents of a file atomically, by writing a temporary file and
+        renaming it. Readers never see a half-written record, and the rename
+        updates the time stamp of the directory.
+        With `sync`, the file is on disk when this function returns.
     """
-    sorts = descriptor.split(',')
-
-    def sort_predicate_dict(it1: dict, it2: dict):
-        for key in sorts:
-            sort_desc = False
-            sort_desc = key.endswith(':desc')
-            if sort_desc:
-                key = key.split(':')[0]
-            # Retrieve the values to be sorted on now.
-            v1, v2 = [i[key] for i in [it1, it2]]
-            # Do the actual comparison
-            if sort_desc:
-                result = (v2 > v1) - (v2 < v1)
-            else:
-                result = (v1 > v2) - (v1 < v2)
-            # If there is a difference based on the current key, return the value
-            if result != 0:
-                return result
-        # There was no difference in any of the keys, return 0.
-        return 0
-
-    def sort_predicate_cls(it1, it2):
-        for key in sorts:
-            sort_desc = False
-            sort_desc = key.endswith(':desc')
-            if sort_desc:
-                key = key.split(':')[0]
-            # Retrieve the values to be sorted on now.
-            v1, v2 = [getattr(i, key) for i in [it1, it2]]
-            # Do the actual comparison
-            if sort_desc:
-                result = (v2 > v1) - (v2 < v1)
-            else:
-                result = (v1 > v2) - (v1 < v2)
-            # If there is a difference based on the current key, return the value
-            if result != 0:
-                return result
-        # There was no difference in any of the keys, return 0.
-        return 0
-
-    if data and isinstance(data[0], dict):
-        return sorted(data, key=functools.cmp_to_key(sort_predicate_dict))
-    return sorted(data, key=functools.cmp_to_key(sort_predicate_cls))
-
+    dirname, fname = os.path.split(fullpath)
+    tmp_path = f"{dirname}/.{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as dest_file:
+        dest_file.write(data)
+        if sync:
+            dest_file.flush()
+            os.fsync(dest_file.fileno())
+    os.replace(tmp_path, fullpath)
+    if sync:
+        sync_dir(dirname)
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def allocate_id(dirname, archive_dir='archived', index=None):
+    """ Allocate a new ID for a record in a table directory, or reserve a specific one.
+        The last ID handed out is kept in a sequence file in the directory. This file is
+        locked while it is updated, so several processes can safely add records at once.
+        Only when the sequence file does not exist yet, the table and its archive are
+        scanned for the highest ID in use.
+    """
+    def highest_id():
+        ids = [int(f) for d in [dirname, f"{dirname}/{archive_dir}"] if os.path.exists(d)
+               for f in os.listdir(d) if f.isnumeric()]
+        return max(ids, default=0)
+
+    fd = os.open(f"{dirname}/{SEQUENCE_FILE}", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        current = os.read(fd, 32).strip()
+        current = int(current) if current.isdigit() else highest_id()
+        if index is None:
+            index = current + 1
+            if os.path.exists(f"{dirname}/{index}"):
+                # Records were written without using the sequence.
+                index = highest_id() + 1
+        if index > current:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(index).encode('ascii'), 0)
+        return index
+    finally:
+        # Closing the file releases the lock.
+        os.close(fd)
 
 def do_leftjoin(tabl1, tabl2, data1, data2, condition):
-    condition = unquote(condition)
+    condition = compile_condition(unquote(condition), (tabl1, tabl2))
     # Make the association.
+    matches = join_matches(condition, data2)
     results = []
     for d1 in data1:
+        d2s = list(matches(d1))
+        assert len(d2s) <= 1, "Join condition %s didn't result in a unique match" % condition.text
         if is_dataclass(d1):
             d1 = asdict(d1)
-
-        def eval_cond(d2):
-            """ Function returns true if d2 is to be joined to d1 """
-            local_context = {tabl1: d1, tabl2: d2}
-            local_context.update(d2)
-            local_context.update(d1)
-            return bool(eval(condition, filter_context, local_context))
-
-        d2s = list(filter(eval_cond, data2))
-        assert len(d2s) <= 1, "Join condition %s didn't result in a unique match" % condition
         result = {}
         if d2s:
             result.update(d2s[0])
@@ -106,11 +148,26 @@ def do_leftjoin(tabl1, tabl2, data1, data2, condition):
 
 
 class FileDatabase(db_api):
-    def __init__(self, path, tables):
+    def __init__(self, path, tables, cached=False, journaled=False):
+        """ When `cached` is set, each table is read from disk only once and its records
+            are kept in memory. All changes are written through to disk immediately.
+            Changes made by other processes are noticed through the time stamp of the
+            table directory, which changes whenever a record is created, replaced or archived.
+            Records are changed while holding a lock on the table, and each change moves the
+            time stamp forward, so the cache only has to be reloaded for the changes of others.
+
+            When `journaled` is set, each change is on disk before the call returns, and
+            transactions are atomic: the changes made in a transaction are staged until
+            it is committed, and written to a journal that is replayed if the commit is
+            interrupted. A transaction is durable as soon as the journal is synced; the
+            journal is only removed when the records it contains are on disk as well.
+        """
         db_api.__init__(self)
         self.archive_dir = 'archived'
         self.path = path
         self.tables = tables
+        self.cached = cached
+        self.journaled = journaled
         self.create()
 
     def create(self):
@@ -126,14 +183,95 @@ class FileDatabase(db_api):
             ad = os.path.join(tp, self.archive_dir)
             if not os.path.exists(ad):
                 os.mkdir(ad)
+        self.cache = {}
         self.transactionEnd()
+        self.recover()
                 
     def clear(self):
         """ Delete the whole structure and build anew, without any records """
         shutil.rmtree(self.path)
         self.create()
-        
-    
+
+    def table_stamp(self, table):
+        return os.stat(f"{self.path}/{table.__name__}").st_mtime_ns
+
+    def cached_table(self, table):
+        """ Return the in-memory copy of a table: a dictionary of records by ID.
+            The table is (re)loaded when its directory was changed since it was last read.
+        """
+        name = table.__name__
+        stamp = self.table_stamp(table)
+        entry = self.cache.get(name)
+        if entry is None or entry[0] != stamp:
+            dirname = f"{self.path}/{name}"
+            records = {int(f): deserialiseDataclass(table, open(f"{dirname}/{f}").read())
+                       for f in os.listdir(dirname) if f.isnumeric()}
+            if time.time_ns() - stamp < RACY_STAMP_NS:
+                # Too recent to be trusted, check again at the next access.
+                stamp = None
+            entry = self.cache[name] = (stamp, records)
+        return entry[1]
+
+    @contextmanager
+    def table_change(self, table):
+        """ Change the records of a table while holding its lock.
+            When cached, the up to date records of the table are yielded so the change can be
+            written through, and the new time stamp of the directory is recorded afterwards:
+            a change made by the cache itself does not cause the table to be reloaded.
+            If the change left the time stamp as it was, e.g. because it happened within the
+            resolution of the stamp, the stamp is moved forward so other processes notice it.
+        """
+        dirname = f"{self.path}/{table.__name__}"
+        fd = os.open(f"{dirname}/{LOCK_FILE}", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            records = self.cached_table(table) if self.cached else None
+            before = self.table_stamp(table)
+            yield records
+            st = os.stat(dirname)
+            if st.st_mtime_ns <= before:
+                os.utime(dirname, ns=(st.st_atime_ns, before + 1))
+            if self.cached:
+                self.cache[table.__name__] = (self.table_stamp(table), records)
+        finally:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+    def write_record(self, table, record):
+        fullpath = f"{self.path}/{table.__name__}/{record.id}"
+        self.forget(table, record.id)
+        if self.staged is not None:
+            # Within a journaled transaction, the record is staged until the commit.
+            stage_path = f"{self.path}/{table.__name__}/.{record.id}.{os.getpid()}.{len(self.journal)}{STAGE_EXTENSION}"
+            data = serialiseDataclass(record)
+            with open(stage_path, 'w') as out:
+                out.write(data)
+            self.journal.append({'op': 'write', 'path': f"{table.__name__}/{record.id}",
+                                 'stage': stage_path, 'data': data})
+            self.staged[(table.__name__, int(record.id))] = (copy(record), False)
+            return
+        with self.table_change(table) as records:
+            write_file(fullpath, serialiseDataclass(record), sync=self.journaled)
+            if records is not None:
+                records[int(record.id)] = copy(record)
+
+    def read_record(self, table, index):
+        """ Read a record that is not archived. """
+        if self.staged and (staged := self.staged.get((table.__name__, int(index)))):
+            record, archived = staged
+            if archived:
+                raise UnknownRecord()
+            return copy(record)
+        if self.cached:
+            record = self.cached_table(table).get(int(index))
+            if record is None:
+                raise UnknownRecord()
+            return copy(record)
+        fullpath = f"{self.path}/{table.__name__}/{index}"
+        if not os.path.exists(fullpath):
+            raise(UnknownRecord())
+        return deserialiseDataclass(table, open(fullpath).read())
+
     def add(self, table: Union[Type[Record], Record], record: Record=None) -> Record:
         """ Add a record to the database. The name of the type of the record must be the name of
             the table. The record is assumed to have the dictionary interface.
@@ -148,34 +286,25 @@ class FileDatabase(db_api):
 
         fullpath = os.path.join(self.path, table.__name__)
         if not getattr(record, 'id', None):
-            # We need to know the highest current ID in the database
-            ids = [int(f) for f in os.listdir(fullpath) if f.isnumeric()]
-            record.id = max(ids) + 1 if ids else 1
-            archived = [int(f) for f in os.listdir(f"{fullpath}/{self.archive_dir}") if f.isnumeric()]
-            if archived and (i:=max(archived)) >= record.id:
-                    record.id = i+1
+            record.id = allocate_id(fullpath, self.archive_dir)
         else:
             # Ensure the object does not already exist
-            if str(record.id) in os.listdir(fullpath):
+            staged = self.staged and self.staged.get((table.__name__, int(record.id)))
+            if (staged and not staged[1]) or (not staged and os.path.exists(f"{fullpath}/{record.id}")):
                 raise RuntimeError('Record ID already exists', 400)
-        fullpath = f'{fullpath}/{record.id}'
-        data_str = serialiseDataclass(record)
-        with open(fullpath, "w") as dest_file:
-            dest_file.write(data_str)
+            # Ensure the sequence does not hand out this ID later on.
+            allocate_id(fullpath, self.archive_dir, int(record.id))
+        self.write_record(table, record)
         self.transactionLog(DbActions.delete, {'table': table, 'id': record.id})
         self.call_hooks(type(record), self.actions.post_add, record)
         return record
     
     def set(self, record: Record) -> Record:
-
-        fullpath = f"{self.path}/{type(record).__name__}/{record.id}"
         # Retrieve and store the old value for logging
         current = self.get(type(record), record.id)
         self.call_hooks(type(record), self.actions.pre_update, record, current)
         self.transactionLog(DbActions.update, current)
-        data_str = serialiseDataclass(record)
-        with open(fullpath, "w") as dest_file:
-            dest_file.write(data_str)
+        self.write_record(type(record), record)
         self.call_hooks(type(record), self.actions.post_update, record)
         return record
 
@@ -190,12 +319,8 @@ class FileDatabase(db_api):
         if record is None:
             record = asdict(table)
             table = type(table)
-        fullpath = f"{self.path}/{table.__name__}/{record['id']}"
-        if not os.path.exists(fullpath):
-            raise(UnknownRecord())
-
         # Make an initial data object for merging old and new data
-        data = deserialiseDataclass(table, open(fullpath).read())
+        data = self.read_record(table, record['id'])
 
         if checker:
             if not checker(record, data):
@@ -205,52 +330,157 @@ class FileDatabase(db_api):
         self.transactionLog(DbActions.update, current)
 
         # Update with the new data
-        for k, v in record.items():
-            if k not in table.__annotations__.keys():
-                # This is not an actual attribute of this table.
-                # This is not an error: clients are free to enrich their objects.
-                continue
-            if k == 'id':
-                # The ID attribute can not be changed.
-                continue
-            if v is None or (isinstance(v, str) and v in ['None', 'null', '']):
-                value = None
-            else:
-                if not v or type(v) != data.__annotations__[k]:
-                    value = data.__annotations__[k](v)
-                else:
-                    value = v
-            setattr(data, k, value)
+        update_fields(table, data, record)
 
         self.call_hooks(table, self.actions.pre_update, data, current)
 
         # Now serialize
-        data_str = serialiseDataclass(data)
-        with open(fullpath, "w") as dest_file:
-            dest_file.write(data_str)
+        self.write_record(table, data)
         self.call_hooks(table, self.actions.post_update, data)
         return data
             
     def delete(self, table:Type[Record], index:int) -> None:
         """ Delete an existing record. """
         fullpath = f"{self.path}/{table.__name__}/{index}"
-        if not os.path.exists(fullpath):
-            raise(UnknownRecord())
-        data = deserialiseDataclass(table, open(fullpath).read())
+        data = self.read_record(table, index)
         self.call_hooks(table, self.actions.pre_delete, data)
 
         # Don't actually delete the record, move it to the "archived" directory
         ad = f"{self.path}/{table.__name__}/{self.archive_dir}"
         if not os.path.exists(ad):
             os.mkdir(ad)
-        newpath = f"{ad}/index"
-        os.rename(fullpath, newpath)
+        newpath = f"{ad}/{index}"
+        self.forget(table, index)
+        if self.staged is not None:
+            self.journal.append({'op': 'archive', 'path': f"{table.__name__}/{index}",
+                                 'target': f"{table.__name__}/{self.archive_dir}/{index}"})
+            self.staged[(table.__name__, int(index))] = (data, True)
+            self.call_hooks(table, self.actions.post_delete, index)
+            return
+        with self.table_change(table) as records:
+            os.rename(fullpath, newpath)
+            if self.journaled:
+                sync_dir(ad)
+                sync_dir(os.path.dirname(fullpath))
+            if records is not None:
+                records.pop(int(index), None)
         self.call_hooks(table, self.actions.post_delete, index)
     def undoDelete(self, data):
+        table, index = type(data), data.id
         fullpath = f"{self.path}/{table.__name__}/{index}"
         ad = f"{self.path}/{table.__name__}/{self.archive_dir}"
-        newpath = f"{ad}/index"
-        os.rename(newpath, fullpath)
+        newpath = f"{ad}/{index}"
+        self.forget(table, index)
+        with self.table_change(table) as records:
+            os.rename(newpath, fullpath)
+            if records is not None:
+                records[int(index)] = deserialiseDataclass(table, open(fullpath).read())
+
+    @contextmanager
+    def journal_lock(self):
+        """ Only one process at a time can commit or recover a journal. """
+        fd = os.open(f"{self.path}/{JOURNAL_FILE}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def transactionBegin(self):
+        db_api.transactionBegin(self)
+        if self.journaled:
+            # The staged records by (table name, id), with a flag if they are archived.
+            self.staged = {}
+            self.journal = []
+
+    def transactionEnd(self):
+        db_api.transactionEnd(self)
+        self.staged = self.journal = None
+
+    def transactionCommit(self):
+        if self.journal:
+            self.commit_journal(self.journal)
+        db_api.transactionCommit(self)
+
+    def transactionRollback(self):
+        if not self.journaled:
+            return db_api.transactionRollback(self)
+        # Nothing was written to the records yet: just forget the staged ones.
+        # If the commit itself failed, the journal is completed by `recover`.
+        for op in self.journal or []:
+            if op['op'] == 'write' and os.path.exists(op['stage']):
+                os.remove(op['stage'])
+        if (identities := self.identity_map()) is not None:
+            for key in self.staged or {}:
+                identities.pop(key, None)
+        self.staged, self.journal = {}, []
+
+    def commit_journal(self, journal):
+        """ Write and sync the journal, then move the staged records in place.
+            The journal is removed when the records and the directories are synced.
+        """
+        self.staged = self.journal = None
+        journal_path = f"{self.path}/{JOURNAL_FILE}"
+        tables = {t.__name__: t for t in self.tables}
+        with self.journal_lock(), ExitStack() as stack:
+            # Lock the tables in a fixed order, so concurrent commits can not deadlock.
+            changes = {name: stack.enter_context(self.table_change(tables[name]))
+                       for name in sorted({op['path'].split('/')[0] for op in journal})}
+            with open(journal_path, 'w') as out:
+                for op in journal:
+                    out.write(json.dumps({k: v for k, v in op.items() if k != 'stage'}) + '\n')
+                out.write(JOURNAL_COMMIT + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+            sync_dir(self.path)
+            # From here on, the transaction will be completed even if this process stops.
+            for op in journal:
+                if op['op'] == 'write':
+                    sync_file(op['stage'])
+            dirs = set()
+            for op in journal:
+                path = f"{self.path}/{op['path']}"
+                name, index = op['path'].split('/')
+                records = changes[name]
+                if op['op'] == 'write':
+                    os.replace(op['stage'], path)
+                    if records is not None:
+                        records[int(index)] = deserialiseDataclass(tables[name], op['data'])
+                else:
+                    os.rename(path, f"{self.path}/{op['target']}")
+                    dirs.add(os.path.dirname(f"{self.path}/{op['target']}"))
+                    if records is not None:
+                        records.pop(int(index), None)
+                dirs.add(os.path.dirname(path))
+            for d in dirs:
+                sync_dir(d)
+            os.remove(journal_path)
+
+    def recover(self):
+        """ Complete a transaction of which the commit was interrupted, and remove records
+            that were staged by transactions that will never be committed.
+        """
+        journal_path = f"{self.path}/{JOURNAL_FILE}"
+        with self.journal_lock():
+            if os.path.exists(journal_path):
+                lines = open(journal_path).read().splitlines()
+                if lines and lines[-1] == JOURNAL_COMMIT:
+                    logging.warning('Completing an interrupted transaction')
+                    for line in lines[:-1]:
+                        op = json.loads(line)
+                        path = f"{self.path}/{op['path']}"
+                        if op['op'] == 'write':
+                            write_file(path, op['data'], sync=True)
+                        elif os.path.exists(path):
+                            os.rename(path, f"{self.path}/{op['target']}")
+                            sync_dir(os.path.dirname(path))
+                            sync_dir(os.path.dirname(f"{self.path}/{op['target']}"))
+                os.remove(journal_path)
+            for table in self.tables:
+                dirname = f"{self.path}/{table.__name__}"
+                for f in os.listdir(dirname):
+                    if f.endswith(STAGE_EXTENSION) and not pid_exists(int(f.split('.')[2])):
+                        os.remove(f"{dirname}/{f}")
     def ll_get(self, table, index):
         """ Low-level getter that is used by both `get` and `get_many`.
             The low-level getter is not overridden by e.g. the ACM wrapper, so this can
@@ -258,15 +488,27 @@ class FileDatabase(db_api):
         """
         if not index:
             return None
-        fullpath = f"{self.path}/{table.__name__}/{index}"
-        #print('Retrieving', fullpath)
-        if not os.path.exists(fullpath):
-            # See if that object was archived.
-            fullpath = f"{self.path}/{table.__name__}/{self.archive_dir}/{index}"
+        if self.staged and (staged := self.staged.get((table.__name__, int(index)))):
+            return copy(staged[0])
+        identities = self.identity_map()
+        key = (table.__name__, int(index))
+        if identities is not None and key in identities:
+            return copy(identities[key])
+        if self.cached and (record := self.cached_table(table).get(int(index))):
+            record = copy(record)
+        else:
+            fullpath = f"{self.path}/{table.__name__}/{index}"
+            #print('Retrieving', fullpath)
             if not os.path.exists(fullpath):
-                raise(UnknownRecord(fullpath))
-        data = open(fullpath).read()
-        return deserialiseDataclass(table, data)
+                # See if that object was archived.
+                fullpath = f"{self.path}/{table.__name__}/{self.archive_dir}/{index}"
+                if not os.path.exists(fullpath):
+                    raise(UnknownRecord(fullpath))
+            data = open(fullpath).read()
+            record = deserialiseDataclass(table, data)
+        if identities is not None:
+            identities[key] = copy(record)
+        return record
 
 
     def get(self, table: Type[Record], index: int) -> Record:
@@ -277,11 +519,39 @@ class FileDatabase(db_api):
         """
         return self.ll_get(table, index)
 
+    def table_ids(self, table: Type[Record]):
+        """ The IDs of the records in a table that are not archived. """
+        if self.cached:
+            ids = set(self.cached_table(table))
+        else:
+            ids = {int(f) for f in os.listdir(f"{self.path}/{table.__name__}") if f.isnumeric()}
+        for (name, index), (record, archived) in (self.staged or {}).items():
+            if name == table.__name__:
+                if archived:
+                    ids.discard(index)
+                else:
+                    ids.add(index)
+        return list(ids)
+
+    def iter_records(self, table: Type[Record], reverse=False):
+        """ Read the records in a table lazily, in order of their ID.
+            The records are retrieved through `get_many`, so wrappers (e.g. for ACM) still
+            get to see them.
+        """
+        ids = sorted(self.table_ids(table), reverse=reverse)
+        for i in range(0, len(ids), QUERY_BATCH_SIZE):
+            yield from self.get_many(table, ids[i:i + QUERY_BATCH_SIZE])
+
     def get_many(self, table:Type[Record], indices:List[int]=None) -> List[Record]:
         """ Retrieve a (large) set of records at once. There are returned as a list.
             If indices is not specified, empty or None, ALL records from the table are read.
         """
-        indices = indices or [int(f) for f in os.listdir(f"{self.path}/{table.__name__}") if f.isnumeric()]
+        if self.cached and not self.staged:
+            records = self.cached_table(table)
+            if not indices:
+                return [copy(r) for r in records.values()]
+            return [copy(records[i]) if i in records else self.ll_get(table, i) for i in indices]
+        indices = indices or self.table_ids(table)
         records = [self.ll_get(table, i) for i in indices]
         records = [r for r in records if r]
         return records
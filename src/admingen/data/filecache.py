@@ -1,30 +1,168 @@
-from threading import Timer
-from time import time
-
-OPEN_FILE_TIMEOUT = 20.0
-
-files = {}
-
-def open_file(path):
-    f = files.get(path)
-    if f is None:
-        f = {'file' : open(path, 'rb'), 'time' : time()}
-        files[path] = f
-    else:
-        f['time'] = time()
-    return f['file']
-
-def clear_cache():
-    to_close = []
-    for path in files:
-        f = files[path]
-        if (time() - f['time']) > OPEN_FILE_TIMEOUT:
-            f['file'].close()
-            to_close.append(path)
-    for path in to_close:
-        files.pop(path)
-    timer = Timer(10.0, clear_cache)
-    timer.daemon = True
-    timer.start()
-
-clear_cache()
\ No newline at end of file
+""" Caches for serving static files.
+
+The metadata of a file (size, modification time, ETag and MIME type) is kept in a
+bounded LRU cache, keyed by the path and the stat of the file, so that a changed
+file is noticed and its MIME type is determined only once per version.
+
+Open file descriptors are kept in a second bounded cache. They are read with
+`os.pread`, which does not use the file offset, so one descriptor can be shared by
+the threads serving the same file. A descriptor is closed when it is evicted and no
+longer in use.
+"""
+
+import os
+import threading
+import dataclasses as dc
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+MAX_FILE_INFO = 4096
+MAX_OPEN_FILES = 64
+CHUNK_SIZE = 256 * 1024
+
+
+class LRUCache:
+    """ A thread-safe dictionary that holds at most `size` items.
+        `on_evict` is called with the value of each item that is pushed out.
+    """
+    def __init__(self, size, on_evict=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.get(key, default)
+            if key in self.items:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            evicted = []
+            while len(self.items) > self.size:
+                evicted.append(self.items.popitem(last=False)[1])
+        if self.on_evict:
+            for v in evicted:
+                self.on_evict(v)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            evicted = list(self.items.values())
+            self.items.clear()
+        if self.on_evict:
+            for v in evicted:
+                self.on_evict(v)
+
+    def __len__(self):
+        return len(self.items)
+
+
+@dc.dataclass(frozen=True)
+class FileInfo:
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    mime: str
+
+    @property
+    def key(self):
+        return (self.path, self.inode, self.mtime_ns, self.size)
+
+    @property
+    def etag(self):
+        return f'{self.inode:x}-{self.mtime_ns:x}-{self.size:x}'
+
+    @property
+    def last_modified(self):
+        return datetime.fromtimestamp(self.mtime_ns // 1000000000, timezone.utc)
+
+
+info_cache = LRUCache(MAX_FILE_INFO)
+
+
+def file_info(path, get_mime, st=None) -> FileInfo:
+    """ Return the metadata of a file, using `get_mime(path)` for new or changed files. """
+    st = st or os.stat(path)
+    key = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+    info = info_cache.get(key)
+    if info is None:
+        info = FileInfo(path, st.st_size, st.st_mtime_ns, st.st_ino, get_mime(path))
+        info_cache.put(key, info)
+    return info
+
+
+class OpenFile:
+    """ A shared file descriptor, with a count of its current users. """
+    def __init__(self, key):
+        self.key = key
+        self.fd = os.open(key[0], os.O_RDONLY)
+        self.users = 0
+        self.evicted = False
+
+    def close(self):
+        os.close(self.fd)
+
+
+class OpenFiles:
+    """ A bounded cache of open files, for serving the same files over and over. """
+    def __init__(self, size=MAX_OPEN_FILES):
+        self.lock = threading.Lock()
+        self.files = LRUCache(size, on_evict=self.evict)
+
+    def acquire(self, info: FileInfo) -> OpenFile:
+        """ Return an open file for a version of a file. Call `release` when done. """
+        with self.lock:
+            f = self.files.get(info.path)
+            if f is not None and f.key != info.key:
+                # The file was changed since it was opened.
+                self.files.pop(info.path)
+                self.evict(f)
+                f = None
+            if f is None:
+                f = OpenFile(info.key)
+                self.files.put(info.path, f)
+            f.users += 1
+            return f
+
+    def release(self, f: OpenFile):
+        with self.lock:
+            f.users -= 1
+            if f.evicted and f.users == 0:
+                f.close()
+
+    def evict(self, f: OpenFile):
+        # Only called with the lock held.
+        f.evicted = True
+        if f.users == 0:
+            f.close()
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+
+
+open_files = OpenFiles()
+
+
+def read_file(info: FileInfo, offset=0, length=None, chunk_size=CHUNK_SIZE):
+    """ Generate the contents of (part of) a file, read from a shared descriptor. """
+    end = info.size if length is None else offset + length
+    f = open_files.acquire(info)
+    try:
+        while offset < end:
+            data = os.pread(f.fd, min(chunk_size, end - offset), offset)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+    finally:
+        open_files.release(f)
@@ -0,0 +1,381 @@
+""" Log Database
+
+An alternative for the file database that stores each table in a single file,
+instead of one file per record.
+
+Each table is an append-only log of lines, in a file named after the table (e.g. `User.jsonl`).
+Every line starts with an operation and a record ID:
+
+    S <id> <JSON record>     Store a (new version of a) record.
+    A <id>                   Archive a record.
+    R <id>                   Restore an archived record.
+
+An in-memory index holds the location of the latest version of each record, so that
+a record is read with a single `pread`. Just like in the file database, archived records
+can still be retrieved by their ID. When most of a log consists of old versions,
+it is compacted: replaced by a log with only the latest version of each record.
+
+Several processes can use the same database. Writes take an exclusive lock on the log,
+and the index is brought up to date whenever the log has grown or was replaced.
+The appended lines are on disk before the lock is released. A line that was only partly
+written, e.g. because a process was killed, is removed by the next writer.
+"""
+
+import os, os.path
+import json
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+from copy import copy
+from dataclasses import asdict
+from typing import Union, Type, Callable, List
+from admingen.data import serialiseDataclass, deserialiseDataclass
+from .db_api import db_api, Record, DbActions, update_fields, QUERY_BATCH_SIZE
+from .file_db import UnknownRecord, sync_dir
+
+
+# Logs are compacted when they are larger than this, and less than half of them is in use.
+COMPACT_MIN_SIZE = 1 << 20
+
+
+class TableLog:
+    """ The log file of a single table, with an index of the records in it. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.fd = None
+        self.ino = None
+        # The number of bytes of the log that were indexed.
+        self.size = 0
+        # Set when lines were appended that are not synced to disk yet.
+        self.dirty = False
+        # The locations (offset, length) of the latest version of the live and archived records.
+        self.live = {}
+        self.archived = {}
+        # The number of bytes used by the latest versions of the records.
+        self.used = 0
+        self.max_id = 0
+
+    def open(self):
+        """ (Re)open the log and clear the index. """
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.ino = os.fstat(self.fd).st_ino
+        self.size = self.used = self.max_id = 0
+        self.live, self.archived = {}, {}
+
+    def refresh(self):
+        """ Bring the index up to date with changes made to the log (by any process). """
+        with self.lock:
+            if self.fd is None:
+                self.open()
+            stat = os.stat(self.path)
+            if stat.st_ino != self.ino or stat.st_size < self.size:
+                # The log was replaced, e.g. by compaction.
+                self.open()
+                stat = os.fstat(self.fd)
+            if stat.st_size > self.size:
+                self.scan(os.pread(self.fd, stat.st_size - self.size, self.size))
+
+    def scan(self, data: bytes):
+        """ Add the lines in a part of the log to the index. An incomplete last line is ignored. """
+        pos = 0
+        while (end := data.find(b'\n', pos)) >= 0:
+            op, key, *_ = data[pos:end].split(b' ', 2)
+            index = int(key)
+            if op == b'S':
+                start = pos + len(op) + len(key) + 2
+                location = (self.size + start, end - start)
+                old = self.live.get(index) or self.archived.pop(index, None)
+                self.used += location[1] - (old[1] if old else 0)
+                self.live[index] = location
+                self.max_id = max(self.max_id, index)
+            elif op == b'A' and index in self.live:
+                self.archived[index] = self.live.pop(index)
+            elif op == b'R' and index in self.archived:
+                self.live[index] = self.archived.pop(index)
+            pos = end + 1
+        self.size += pos
+
+    def read(self, location) -> str:
+        offset, length = location
+        return os.pread(self.fd, length, offset).decode('utf8')
+
+    def find(self, index, archived=True):
+        """ The location of a record, or None if it does not exist. """
+        return self.live.get(index) or (self.archived.get(index) if archived else None)
+
+    @contextmanager
+    def locked(self):
+        """ Hold an exclusive lock on the log, with the index up to date. """
+        with self.lock:
+            while True:
+                self.refresh()
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                # Another process could have replaced the log while we were waiting.
+                if os.stat(self.path).st_ino == self.ino:
+                    break
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            try:
+                self.refresh()
+                if os.fstat(self.fd).st_size > self.size:
+                    # An incomplete line left by an interrupted write: remove it, so the
+                    # next line does not get appended to it.
+                    os.ftruncate(self.fd, self.size)
+                try:
+                    yield self
+                finally:
+                    if self.dirty:
+                        os.fsync(self.fd)
+                        self.dirty = False
+                if self.size > COMPACT_MIN_SIZE and self.used < self.size // 2:
+                    self.compact()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def write(self, op, index, data=None):
+        """ Append a line to the log. Must be called while holding the lock. """
+        line = f'{op} {index} {data}\n' if data is not None else f'{op} {index}\n'
+        os.write(self.fd, line.encode('utf8'))
+        self.dirty = True
+        self.refresh()
+
+    def compact(self):
+        """ Replace the log by one with only the latest version of each record.
+            Must be called while holding the lock.
+        """
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf8') as out:
+            for index in sorted(self.live.keys() | self.archived.keys()):
+                out.write(f'S {index} {self.read(self.find(index))}\n')
+                if index in self.archived:
+                    out.write(f'A {index}\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+        sync_dir(os.path.dirname(self.path))
+        # Lock the new log before releasing the old one. Writers waiting for the old
+        # log will notice it was replaced.
+        old_fd, self.fd = self.fd, None
+        self.refresh()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        os.close(old_fd)
+
+
+class LogDatabase(db_api):
+    def __init__(self, path, tables):
+        db_api.__init__(self)
+        self.path = path
+        self.tables = tables
+        self.create()
+
+    def create(self):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        self.logs = {}
+        for table in self.tables:
+            name = table.__name__
+            log = self.logs[name] = TableLog(f"{self.path}/{name}.jsonl")
+            log.refresh()
+        self.transactionEnd()
+
+    def clear(self):
+        """ Delete the whole structure and build anew, without any records """
+        shutil.rmtree(self.path)
+        self.create()
+
+    def compact(self, table: Type[Record]):
+        """ Compact the log of a table now. """
+        with self.logs[table.__name__].locked() as log:
+            log.compact()
+
+    def read_record(self, table, index):
+        """ Read a record that is not archived. """
+        log = self.logs[table.__name__]
+        with log.lock:
+            log.refresh()
+            location = log.find(int(index), archived=False)
+            if location is None:
+                raise UnknownRecord()
+            return deserialiseDataclass(table, log.read(location))
+
+    def write_record(self, table, record, check=None):
+        """ Store a record. `check` is called with the up-to-date log before writing. """
+        with self.logs[table.__name__].locked() as log:
+            if check:
+                check(log)
+            if not getattr(record, 'id', None):
+                record.id = log.max_id + 1
+            self.forget(table, record.id)
+            log.write('S', record.id, serialiseDataclass(record))
+
+    def add(self, table: Union[Type[Record], Record], record: Record=None) -> Record:
+        """ Add a record to the database. The name of the type of the record must be the name of
+            the table. The record is assumed to have the dictionary interface.
+        """
+        if record is None:
+            record = table
+            table = type(table)
+        elif isinstance(record, dict):
+            record = table(**record)
+
+        self.call_hooks(type(record), self.actions.pre_add, record)
+
+        def check(log):
+            # Ensure the object does not already exist
+            if getattr(record, 'id', None) and log.find(int(record.id), archived=False):
+                raise RuntimeError('Record ID already exists', 400)
+        self.write_record(table, record, check)
+        self.transactionLog(DbActions.delete, {'table': table, 'id': record.id})
+        self.call_hooks(type(record), self.actions.post_add, record)
+        return record
+
+    def set(self, record: Record) -> Record:
+        # Retrieve and store the old value for logging
+        current = self.get(type(record), record.id)
+        self.call_hooks(type(record), self.actions.pre_update, record, current)
+        self.transactionLog(DbActions.update, current)
+        self.write_record(type(record), record)
+        self.call_hooks(type(record), self.actions.post_update, record)
+        return record
+
+    def update(self, table: Union[Type[Record], dict], record: dict=None, checker: Callable[[Record, dict],bool]=None) -> None:
+        """ Update the values in an existing record.
+            The record is identified by id, which can not be changed.
+            Only the values in the record are updated (apart from id).
+
+            'record' must be a dictionary. When storing a dataclass object,
+            just use the set function.
+        """
+        if record is None:
+            record = asdict(table)
+            table = type(table)
+        # Make an initial data object for merging old and new data
+        data = self.read_record(table, record['id'])
+
+        if checker:
+            if not checker(record, data):
+                return
+
+        current = copy(data)
+        self.transactionLog(DbActions.update, current)
+
+        # Update with the new data
+        update_fields(table, data, record)
+
+        self.call_hooks(table, self.actions.pre_update, data, current)
+        self.write_record(table, data)
+        self.call_hooks(table, self.actions.post_update, data)
+        return data
+
+    def delete(self, table:Type[Record], index:int) -> None:
+        """ Archive an existing record. """
+        data = self.read_record(table, index)
+        self.call_hooks(table, self.actions.pre_delete, data)
+        with self.logs[table.__name__].locked() as log:
+            if log.find(int(index), archived=False) is None:
+                raise UnknownRecord()
+            log.write('A', int(index))
+        self.forget(table, index)
+        self.call_hooks(table, self.actions.post_delete, index)
+
+    def undoDelete(self, data):
+        with self.logs[type(data).__name__].locked() as log:
+            log.write('R', int(data.id))
+        self.forget(type(data), data.id)
+
+    def ll_get(self, table, index):
+        """ Low-level getter that is used by both `get` and `get_many`.
+            The low-level getter is not overridden by e.g. the ACM wrapper, so this can
+            also be used for raw access to the database. E.g. to check login credentials.
+        """
+        if not index:
+            return None
+        return self.read_many(table, [index])[0]
+
+    def read_many(self, table, indices):
+        """ Read records, live or archived, using the identity map where possible. """
+        identities = self.identity_map()
+        name = table.__name__
+        log = self.logs[name]
+        result = []
+        with log.lock:
+            log.refresh()
+            for index in indices:
+                key = (name, int(index))
+                if identities is not None and key in identities:
+                    result.append(copy(identities[key]))
+                    continue
+                location = log.find(int(index))
+                if location is None:
+                    raise UnknownRecord(f'{name}/{index}')
+                record = deserialiseDataclass(table, log.read(location))
+                if identities is not None:
+                    identities[key] = copy(record)
+                result.append(record)
+        return result
+
+    def get(self, table: Type[Record], index: int) -> Record:
+        """ Retrieve a record identified by table name and index.
+            With this method, you can also retrieve archived records.
+        """
+        return self.ll_get(table, index)
+
+    def ids(self, table: Type[Record]):
+        """ The IDs of the records in a table that are not archived. """
+        log = self.logs[table.__name__]
+        with log.lock:
+            log.refresh()
+            return list(log.live)
+
+    def iter_records(self, table: Type[Record], reverse=False):
+        """ Read the records in a table lazily, in order of their ID.
+            The records are retrieved through `get_many`, so wrappers (e.g. for ACM) still
+            get to see them.
+        """
+        ids = sorted(self.ids(table), reverse=reverse)
+        for i in range(0, len(ids), QUERY_BATCH_SIZE):
+            yield from self.get_many(table, ids[i:i + QUERY_BATCH_SIZE])
+
+    def get_many(self, table:Type[Record], indices:List[int]=None) -> List[Record]:
+        """ Retrieve a (large) set of records at once. There are returned as a list.
+            If indices is not specified, empty or None, ALL records from the table are read.
+        """
+        indices = indices or self.ids(table)
+        return self.read_many(table, [i for i in indices if i])
+
+
+def migrate_file_db(source, destination):
+    """ Convert a database in the layout of the file database (a directory per table,
+        a file per record) into a log database. Returns the number of records per table.
+    """
+    if not os.path.exists(destination):
+        os.mkdir(destination)
+    counts = {}
+    for name in sorted(os.listdir(source)):
+        tabledir = os.path.join(source, name)
+        if not os.path.isdir(tabledir):
+            continue
+        archivedir = os.path.join(tabledir, 'archived')
+        records = {}
+        for dirname, archived in [(archivedir, True), (tabledir, False)]:
+            if os.path.isdir(dirname):
+                records.update({int(f): (os.path.join(dirname, f), archived)
+                                for f in os.listdir(dirname) if f.isnumeric()})
+        target = os.path.join(destination, f'{name}.jsonl')
+        if os.path.exists(target):
+            raise RuntimeError(f'Table {name} already exists in {destination}')
+        with open(f'{target}.tmp', 'w', encoding='utf8') as out:
+            for index in sorted(records):
+                fullpath, archived = records[index]
+                # Ensure the record is written on a single line.
+                with open(fullpath, encoding='utf8') as src:
+                    data = json.dumps(json.loads(src.read()))
+                out.write(f'S {index} {data}\n')
+                if archived:
+                    out.write(f'A {index}\n')
+        os.replace(f'{target}.tmp', target)
+        counts[name] = len(records)
+    return counts
@@ -4,8 +4,12 @@ Implementation of the simple DB API to work with the SQLite database engine.
 
 I really like SQLite because it is fast and does not have global interfaces that
 need protection. Just a file.
+
+In production mode, SQL statements are not logged and the database uses write-ahead
+logging, so that readers and a writer do not block each other.
 """
 
+import operator
 import sqlalchemy as sq
 from sqlalchemy.orm import registry
 from sqlalchemy import create_engine
@@ -13,23 +17,47 @@ from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
 from typing import List, Type, Union, Callable
+from itertools import islice, groupby
+from contextlib import contextmanager
 from dataclasses import asdict
 
-from .db_api import db_api, filter_context, Record
+from .db_api import db_api, filter_context, Record, parse_sort, QUERY_BATCH_SIZE
+from .expressions import Condition
 
 
 class UnknownRecord(RuntimeError): pass
 
 
+# The settings for each connection in production mode.
+PRODUCTION_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+]
+
+
 class SqliteDatabase(db_api):
-    def __init__(self, path, tables, registry):
+    def __init__(self, path, tables, registry, production=False, pool_size=5):
+        """ In production mode, SQL is not logged, connections use write-ahead logging
+            and are kept in a pool, and the statements they prepare are cached.
+        """
         db_api.__init__(self)
         self.tables = tables
         self.path = path + '.sqlite3'
         self.meta = registry.metadata
 
         # Instantiate the database
-        self.engine = create_engine(f"sqlite:///{self.path}", echo=True, future=True)
+        if production:
+            self.engine = create_engine(f"sqlite:///{self.path}", echo=False, future=True,
+                                        pool_size=pool_size, max_overflow=2 * pool_size,
+                                        query_cache_size=1200,
+                                        connect_args={'check_same_thread': False,
+                                                      'cached_statements': 256})
+            sq.event.listen(self.engine, 'connect', self.configure_connection)
+        else:
+            self.engine = create_engine(f"sqlite:///{self.path}", echo=True, future=True)
         self.Session = sessionmaker(bind = self.engine, expire_on_commit=False)
         self.meta.create_all(self.engine)
 
@@ -40,10 +68,44 @@ class SqliteDatabase(db_api):
             rl[m.lower()] = tables_lu[m]
         registry.reverse_lookup = rl
 
+    @staticmethod
+    def configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in PRODUCTION_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @contextmanager
+    def unit_of_work(self):
+        """ All calls within a unit of work (e.g. a request) share a single session. """
+        if getattr(self.local, 'session', None) is not None:
+            yield self
+            return
+        with db_api.unit_of_work(self), self.Session() as session:
+            self.local.session = session
+            try:
+                yield self
+            finally:
+                self.local.session = None
+
+    @contextmanager
+    def session(self):
+        """ The session of the current unit of work, or a new session. """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            with self.Session() as session:
+                yield session
+            return
+        try:
+            yield session
+        finally:
+            # The records handed out are detached, like those of a closed session, so that
+            # changes made to them by the caller are not written by a later commit.
+            session.expunge_all()
 
     def get(self, table: Type[Record], index: int) -> Record:
         try:
-            with self.Session() as session:
+            with self.session() as session:
                 result = session.query(table).filter(table.id == index).one()
                 if result:
                     return result
@@ -54,7 +116,7 @@ class SqliteDatabase(db_api):
         """ Retrieve a (large) set of records at once. There are returned as a list.
             If indices is not specified, empty or None, ALL records from the table are read.
         """
-        with self.Session() as session:
+        with self.session() as session:
             if indices:
                 result = session.query(table).filter(table.id.in_(indices)).all()
             else:
@@ -62,6 +124,47 @@ class SqliteDatabase(db_api):
 
             return result
 
+    def query(self, table:Type[Record], filter=None, join=None, resolve_fk=None,
+              sort=None, limit=None, offset=0) -> List[Record]:
+        """ Let SQLite do the sorting and pagination. Filters that are compiled conditions
+            are translated into SQL where possible. Other filters are applied while the
+            (sorted) records are being read, so reading stops when the limit is reached.
+            Foreign keys and joins are only resolved for the records that are returned.
+        """
+        if type(self).get_many is not SqliteDatabase.get_many:
+            # A wrapper (e.g. for ACM) checks the records returned by get_many:
+            # use the generic implementation that reads all records through it.
+            return db_api.query(self, table, filter, join, resolve_fk, sort, limit, offset)
+
+        end = None if limit is None else offset + limit
+        with self.session() as session:
+            q = session.query(table)
+            if isinstance(filter, Condition) and not resolve_fk:
+                # Compiled conditions on plain columns can be evaluated by SQLite itself.
+                columns = sq.inspect(table).columns
+                clause = filter.to_sql(columns.get)
+                if clause is not None:
+                    q = q.filter(clause)
+                    filter = None
+            for key, desc in parse_sort(sort or 'id'):
+                column = getattr(table, key)
+                q = q.order_by(column.desc() if desc else column)
+            if filter is None:
+                if offset:
+                    q = q.offset(offset)
+                if limit is not None:
+                    q = q.limit(limit)
+                records = q.all()
+            else:
+                records = self.refine(table, q.yield_per(QUERY_BATCH_SIZE), filter, join, resolve_fk)
+                return list(islice(records, offset, end))
+
+        if resolve_fk:
+            self.resolve_foreign_keys(table, records, resolve_fk)
+        if join:
+            self.join_records(table, records, join, self.query(join[0]))
+        return records
+
     def add(self, table: Union[Type[Record], Record], record: Record=None) -> Record:
         if record:
             # Ensure the record is of the right type
@@ -69,7 +172,7 @@ class SqliteDatabase(db_api):
         else:
             record = table
 
-        with self.Session() as session:
+        with self.session() as session:
             session.add(record)
             session.commit()
             return record
@@ -79,7 +182,7 @@ class SqliteDatabase(db_api):
         # The record was updated outside a session, so it won't commit automatically.
         update = asdict(record)
         T = type(record)
-        with self.Session() as session:
+        with self.session() as session:
             session.query(type(record)).filter(T.id == update['id']).update(update, synchronize_session = False)
             return session.commit()
 
@@ -104,15 +207,63 @@ class SqliteDatabase(db_api):
         for k, v in record.items():
             record[k] = table.convert_field(k, v)
 
-        with self.Session() as session:
+        with self.session() as session:
             session.query(table).filter(table.id == rid).update(record)
             session.commit()
             result = table(**record)
             result.id = int(rid)
             return result
 
+    def add_many(self, table: Type[Record], records: List[Record]) -> List[Record]:
+        """ Add records with an (executemany) INSERT statement per run of records with or without an ID. """
+        records = [table(**r) if isinstance(r, dict) else r for r in records]
+        t = table.__table__
+        # The values are read through the mapped attributes, by the name of their column.
+        attributes = [(prop.key, prop.columns[0].key) for prop in sq.inspect(table).column_attrs]
+        getter = operator.attrgetter(*[a for a, _ in attributes])
+        names = [c for _, c in attributes]
+        if len(names) == 1:
+            rows = [{names[0]: getter(r)} for r in records]
+        else:
+            rows = [dict(zip(names, getter(r))) for r in records]
+        ids = []
+        with self.session() as session:
+            connection = session.connection()
+            # Consecutive rows with and without an ID are inserted in order, so rows without an ID
+            # get the same IDs as when the records are added one at a time.
+            for new, group in groupby(zip(records, rows), key=lambda x: x[0].id is None):
+                group = list(group)
+                if not new:
+                    connection.execute(sq.insert(t), [row for _, row in group])
+                    continue
+                statement = sq.insert(t).returning(t.c.id)
+                result = connection.execute(statement, [{k: v for k, v in row.items() if k != 'id'}
+                                                        for _, row in group])
+                # The rows get increasing IDs in the order they are inserted.
+                ids.extend(zip([r for r, _ in group], sorted(result.scalars().all())))
+            session.commit()
+        for record, index in ids:
+            record.id = index
+        return records
+
+    def update_many(self, table: Type[Record], records: List[dict]) -> None:
+        """ Update records with a single (executemany) UPDATE statement per set of columns. """
+        groups = {}
+        for r in records:
+            row = {k: table.convert_field(k, v) for k, v in r.items() if k != 'id'}
+            row['_id'] = int(r['id'])
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        t = table.__table__
+        with self.session() as session:
+            connection = session.connection()
+            for keys, rows in groups.items():
+                statement = sq.update(t).where(t.c.id == sq.bindparam('_id')) \
+                    .values({k: sq.bindparam(k) for k in keys if k != '_id'})
+                connection.execute(statement, rows)
+            session.commit()
+
     def delete(self, table:Type[Record], index:int) -> None:
-        with self.Session() as session:
+        with self.session() as session:
             session.query(table).filter(table.id == index).delete()
             session.commit()
 
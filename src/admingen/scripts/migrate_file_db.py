@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+""" Convert a file database (a directory per table, a file per record) into a log database. """
+
+import argparse
+from admingen.data.log_db import migrate_file_db
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', help='The directory of the file database.')
+    parser.add_argument('destination', help='The directory for the log database.')
+    args = parser.parse_args()
+    counts = migrate_file_db(args.source, args.destination)
+    for table, count in counts.items():
+        print(f'{table}: {count} records')
+
+
+if __name__ == '__main__':
+    run()
@@ -11,7 +11,7 @@ import importlib.util
 from argparse import ArgumentParser
 
 from admingen.webfs import add_handlers, set_root
-from admingen.data import file_db
+from admingen.data import file_db, log_db, data_server, set_json_backend
 
 
 admingen_home = os.path.abspath(os.path.dirname(__file__) + '/../..')
@@ -41,16 +41,22 @@ def create_app(args):
     search_path = [os.getcwd(), admingen_home]
 
     if args.datamodel:
+        set_json_backend(args.json_backend)
         mod_name = os.path.basename(args.datamodel).split('.')[0]
         fname = find_file(args.datamodel, search_path)
         spec = importlib.util.spec_from_file_location(mod_name, fname)
         new_mod = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(new_mod)
 
-        databases = {k: file_db.FileDatabase(new_mod.database_urls[k], tables)
-                     for k, tables in new_mod.all_tables.items()}
+        if args.storage == 'log':
+            databases = {k: log_db.LogDatabase(new_mod.database_urls[k], tables)
+                         for k, tables in new_mod.all_tables.items()}
+        else:
+            databases = {k: file_db.FileDatabase(new_mod.database_urls[k], tables, cached=args.cached)
+                         for k, tables in new_mod.all_tables.items()}
 
         context['databases'] = databases
+        data_server.set_databases(databases, new_mod.all_tables)
         context['datamodel'] = new_mod.all_tables
         context['database_urls'] = new_mod.database_urls
 
@@ -79,6 +85,12 @@ def run():
     parser.add_argument('--filename', '-f', nargs='*', default=[],
                         help='One or more modules that are loaded as part of the web application')
     parser.add_argument('--datamodel', default=None)
+    parser.add_argument('--cached', action='store_true',
+                        help='Keep the tables of the file database in memory.')
+    parser.add_argument('--storage', choices=['files', 'log'], default='files',
+                        help='Store each record in its own file, or each table in a single log file.')
+    parser.add_argument('--json-backend', choices=['json', 'orjson'], default='json',
+                        help='The library used to (de)serialise the records in the database.')
 
     args = parser.parse_args()
 
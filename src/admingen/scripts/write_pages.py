@@ -5,7 +5,7 @@ write them to the file system as static pages.
 """
 
 import argparse
-from admingen.xml_template import processor, Tag, debug_render, Template
+from admingen.xml_template import processor, build, Tag, debug_render, Template
 import os, os.path
 import sys
 import json
@@ -163,8 +163,8 @@ ${footer}
 </html>""")
 
 
-created_pages = []
-current_page_context = dict(
+# The page settings at the start of each document.
+default_page_context = dict(
     headers='',
     title='admingen',
     heading='',
@@ -173,13 +173,22 @@ current_page_context = dict(
     dependencies=''
 )
 
-def handle_Page(args, lines):
+def page_context(context):
+    """ The page settings of the document being processed. """
+    return context.values.setdefault('page_context', dict(default_page_context))
+
+
+def handle_Page(args, lines, context):
     """ Handle a page definition by writing the HTML inside it to file. """
     url = args['url']
     assert ':' not in url
-    if url in created_pages:
+    # The pages are recorded for the whole build, so that no two documents create the same page,
+    # also when they are processed in parallel.
+    created_pages = context.values.setdefault('created_pages', [])
+    if url in created_pages or context.shared.setdefault(('Page', url), context.document) != context.document:
         raise RuntimeError('Creating page', url, 'for the second time')
-    text = page_template.render(lines=lines, **current_page_context)
+    created_pages.append(url)
+    text = page_template.render(lines=lines, **page_context(context))
     dirname, fname = os.path.split('html/'+url.strip('/'))
 
     # Expand any Mako templates inside the page.
@@ -195,12 +204,13 @@ def handle_Page(args, lines):
     return ''
 
 
-def handle_PageContextValue(args, lines):
+def handle_PageContextValue(args, lines, context):
     """ Let the user modify a value in the page context.
         This value is used for all subsequent pages.
     """
     assert 'name' in args
     name = args['name']
+    current_page_context = page_context(context)
     if name in current_page_context and args.get('action', '') == 'append':
         current_page_context[name] += lines
     else:
@@ -212,16 +222,28 @@ def handle_Markdown(args, lines):
     md = markdown.markdown(''.join(lines))
     return md
 
+generators = {'Page': Tag('Page', handle_Page, with_context=True),
+              'PageContextValue': Tag('PageContextValue', handle_PageContextValue, with_context=True),
+              'MarkDown': Tag('MarkDown', handle_Markdown)
+              }
+
+
 def run():
     parser = argparse.ArgumentParser()
     parser.add_argument('--file', '-f', default=None)
+    parser.add_argument('files', nargs='*', help='Several files to write the pages for')
+    parser.add_argument('--prelude', action='append', default=[],
+                        help='File with definitions that are shared by all files')
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--cache-dir', default=None)
     args = parser.parse_args()
+    if args.files:
+        # Each file is processed separately, starting with the page context set in the preludes.
+        failed = build([(f, None) for f in args.files], generators, preludes=args.prelude, jobs=args.jobs,
+                       cache_dir=args.cache_dir)
+        sys.exit(1 if failed else 0)
     stream = open(args.file) if args.file else sys.stdin
-    processor({'Page': Tag('Page', handle_Page),
-               'PageContextValue': Tag('PageContextValue', handle_PageContextValue),
-               'MarkDown': Tag('MarkDown', handle_Markdown)
-               },
-              stream)
+    processor(generators, stream, cache_dir=args.cache_dir)
 
 if __name__ == '__main__':
     run()
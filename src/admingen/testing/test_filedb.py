@@ -2,6 +2,7 @@
 import os
 from dataclasses import is_dataclass
 from admingen.data import serialiseDataclass, deserialiseDataclass
+from admingen.data.file_db import SEQUENCE_FILE, JOURNAL_FILE, STAGE_EXTENSION
 
 
 db_path = '../data'
@@ -65,9 +66,11 @@ class FiledbTestPlugin:
         # Simply load all objects from the database into the state
         state = []
         for table in os.listdir(db_path):
+            if not os.path.isdir(f'{db_path}/{table}'):
+                continue
             for i in os.listdir(f'{db_path}/{table}'):
                 fname = f'{db_path}/{table}/{i}'
-                if not os.path.isfile(fname):
+                if not i.isnumeric() or not os.path.isfile(fname):
                     continue
                 with open(fname) as f:
                     data = f.read()
@@ -77,10 +80,17 @@ class FiledbTestPlugin:
 
     def db_restore(self, state):
         # Simply delete all objects in the database, and store the ones from the state.
+        # The sequences are removed too, so IDs are allocated as if the test never ran,
+        # as are any left-over journal and staged records.
+        if os.path.exists(f'{db_path}/{JOURNAL_FILE}'):
+            os.remove(f'{db_path}/{JOURNAL_FILE}')
         for table in os.listdir(db_path):
+            if not os.path.isdir(f'{db_path}/{table}'):
+                continue
             for i in os.listdir(f'{db_path}/{table}'):
                 fname = f'{db_path}/{table}/{i}'
-                if not os.path.isfile(fname):
+                if not (i.isnumeric() or i == SEQUENCE_FILE or i.endswith(STAGE_EXTENSION)) \
+                        or not os.path.isfile(fname):
                     continue
                 os.remove(fname)
 
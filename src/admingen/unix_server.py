@@ -0,0 +1,624 @@
+""" Serve the exposed functions of an object on a unix socket, and call them from a client.
+
+The server (mkUnixServer) speaks three protocols on a connection: a command line interface
+for humans, JSON messages (one per line) and, if msgpack is installed, binary messages
+(msgpack payloads preceded by their length). The protocol is chosen by the client.
+Clients are made with unixproxy (blocking) and async_unixproxy (asyncio).
+
+This module only needs the standard library (and optionally msgpack), so that servers and
+clients can be used without the dependencies of admingen.servers.
+"""
+import time
+import asyncio
+import json
+import os, os.path
+import logging
+import itertools
+import concurrent.futures
+import socket
+import struct
+from inspect import getmembers, signature, isawaitable, iscoroutinefunction
+from dataclasses import fields, is_dataclass
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# TODO: implement checking the parameters in a json unix server message
+
+class UnknownMessage(RuntimeError): pass
+
+
+class FormatError(RuntimeError): pass
+
+
+class RemoteError(RuntimeError): pass
+
+
+class ServerError(RuntimeError):
+    def __init__(self, name, msg):
+        self.name = name
+        RuntimeError.__init__(self, msg)
+
+
+class MessageEncoder(json.JSONEncoder):
+    def default(self, o):
+        return o.__dict__
+
+
+def decodeUnixMsg(m):
+    # Let Python string conversions
+    decoded = m.decode("unicode_escape")
+    return json.loads(decoded)
+
+
+def encodeUnixMsg(m):
+    decoded = json.dumps(m, cls=MessageEncoder)
+    return decoded.encode("unicode_escape")
+
+
+# In the binary protocol, each message is a frame with a msgpack payload, preceded by its length.
+FRAME_HEADER = struct.Struct('>I')
+
+
+def encodeBinaryMsg(m):
+    data = msgpack.packb(m, default=MessageEncoder().default, use_bin_type=True)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decodeBinaryMsg(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise FormatError(str(e))
+
+
+async def readFrame(reader):
+    """ Read the payload of a frame in the binary protocol. """
+    header = await reader.readexactly(FRAME_HEADER.size)
+    return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+
+
+def unpackReply(reply):
+    """ Return the result from a reply of the server, or raise the error it reports. """
+    if reply[0] == 200:
+        return reply[1]
+    elif reply[0] == 500:
+        # Raise something the application can handle
+        raise ServerError(*reply[1])
+    raise RemoteError('Error when calling server: %s' % reply)
+
+
+def expose(func=None, timeout=None, concurrency=None, inline=False):
+    """ Mark a function as callable through the server.
+        Use as `@expose`, or with options as e.g. `@expose(timeout=60, concurrency=1)`:
+        timeout: seconds after which the caller gets a timeout error,
+        concurrency: the maximum number of calls that are handled at the same time,
+        inline: call a (quick) regular function in the event loop instead of the executor.
+    """
+    def decorate(func):
+        func.exposed = True
+        func.timeout = timeout
+        func.concurrency = concurrency
+        func.inline = inline
+        return func
+    return decorate(func) if func else decorate
+
+
+welcome = b'''Welcome to %s
+protocol 1.0
+Type "help" for useful information'''
+
+
+def arguments(parameters):
+    """ Generator for the arguments given to a function.
+        Recursively descends into dataclasses.
+    """
+
+    def recurse(prefix, dclass):
+        for field in fields(dclass):
+            name = '.'.join([prefix, field.name])
+            if is_dataclass(field.type):
+                yield from recurse(name, field.type)
+            yield name, field.type
+
+    for name, p in parameters.items():
+        a = p.annotation
+        if a == p.empty or a == str:
+            yield (name, None)
+        elif is_dataclass(a):
+            yield from recurse(name, a)
+        else:
+            yield name, a
+
+
+def castArguments(kwargs, parameters):
+    """ Handle arguments given through the CLI interface and cast
+        them to the proper types and objects.
+    """
+    result = {}
+    for name, p in parameters.items():
+        a = p.annotation
+        if is_dataclass(a):
+            r = {}
+            for f in fields(a):
+                value = kwargs['%s.%s' % (name, f.name)]
+                try:
+                    if f.type == str:
+                        r[f.name] = value.decode('utf8')
+                    else:
+                        r[f.name] = f.type(value)
+                except Exception as e:
+                    raise FormatError(
+                        'Could not cast value %s to type %s' % (value, f.type.__name__))
+            result[name] = a(**r)
+        else:
+            value = kwargs[name]
+            if name not in kwargs:
+                continue
+            try:
+                result[name] = a(value)
+            except Exception as e:
+                raise FormatError('Could not cast value %s to type %s' % (value, a.__name__))
+    return result
+
+
+def mkUnixServer(context, path, loop=None, executor=None):
+    """ Serve the exposed functions of the context on a unix socket.
+        Coroutine functions are awaited, regular functions are run in the executor (by
+        default a thread pool), so that slow functions do not stop other clients from being served.
+        A ProcessPoolExecutor can only be used if the functions do not change the context.
+    """
+    exports = [name for name, f in getmembers(context) if getattr(f, 'exposed', False)]
+    executor = executor or concurrent.futures.ThreadPoolExecutor()
+    semaphores = {}
+
+    async def call(func, args, kwargs):
+        """ Call an exposed function without blocking the event loop. """
+        limit = getattr(func, 'concurrency', None)
+        semaphore = semaphores.setdefault(func.__name__, asyncio.Semaphore(limit)) if limit else None
+
+        async def run():
+            if semaphore:
+                await semaphore.acquire()
+            if iscoroutinefunction(func) or getattr(func, 'inline', False):
+                try:
+                    if iscoroutinefunction(func):
+                        return await func(*args, **kwargs)
+                    return func(*args, **kwargs)
+                finally:
+                    if semaphore:
+                        semaphore.release()
+            try:
+                future = executor.submit(func, *args, **kwargs)
+            except BaseException:
+                if semaphore:
+                    semaphore.release()
+                raise
+            if semaphore:
+                # A call that timed out keeps its slot until the function has returned.
+                loop = asyncio.get_running_loop()
+                future.add_done_callback(lambda f: loop.call_soon_threadsafe(semaphore.release))
+            return await asyncio.wrap_future(future)
+
+        return await asyncio.wait_for(run(), getattr(func, 'timeout', None))
+
+    def encodeLine(m):
+        return encodeUnixMsg(m) + b'\n'
+
+    async def reply_to(data, writer, previous, decode=decodeUnixMsg, encode=encodeLine):
+        """ Handle a message and write the reply.
+            Messages without request ID are handled after the previous message,
+            so that their replies are sent in order.
+        """
+        request_id = []
+        try:
+            msg = decode(data)
+            # A message can contain a request ID, which is returned with the reply.
+            if not isinstance(msg, list) or len(msg) not in (3, 4):
+                raise FormatError()
+            request_id = msg[3:]
+            func = getattr(context, msg[0], False)
+            if not func or not getattr(func, 'exposed', False):
+                raise UnknownMessage(msg[0])
+            args = msg[1]
+            kwargs = msg[2]
+            if previous and not request_id:
+                await previous
+            reply = [200, await call(func, args, kwargs)]
+        except UnknownMessage as e:
+            reply = [404, 'Unknown message']
+        except (SyntaxError, FormatError, json.decoder.JSONDecodeError):
+            reply = [400, 'Could not decode message']
+        except asyncio.TimeoutError:
+            reply = [504, 'Timeout']
+        except Exception as e:
+            logging.exception('Server exception')
+            reply = [500, [e.__class__.__name__, str(e)]]
+
+        if previous and not request_id:
+            await previous
+        logging.debug('Writing reply: %s' % reply)
+        writer.write(encode(reply + request_id))
+
+    def printHelp(context, writer):
+        writer.write(b'The following functions are provided:\n')
+        for f in exports:
+            doc = getattr(context, f).__doc__ or ''
+            msg = (f + ': ' + doc + '\n').encode('utf8')
+            writer.write(msg)
+
+    def json_command_handler(reader, writer):
+        """ Generator for parsing data. Each message is handled in its own task,
+            so that the next message can be read while a call is in progress.
+        """
+        previous = None
+        while True:
+            data = yield None
+            logging.debug('Server read data: %s' % data)
+            previous = asyncio.ensure_future(reply_to(data, writer, previous))
+
+    async def binary_command_handler(reader, writer):
+        """ Read messages in the binary protocol, until the connection is closed.
+            As in the JSON protocol, each message is handled in its own task.
+        """
+        previous = None
+        while True:
+            try:
+                data = await readFrame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            previous = asyncio.ensure_future(reply_to(data, writer, previous, decodeBinaryMsg, encodeBinaryMsg))
+
+    def cli_command_handler(reader, writer):
+        writer.write(welcome % context.__class__.__name__.encode('utf8'))
+        while True:
+            writer.write(b'\n> ')
+            # Read a command
+            data = yield None
+            cmnd = data.strip().lower().decode('utf8')
+            # Handle the built-in command (help, json)
+            if cmnd == 'help':
+                printHelp(context, writer)
+                continue
+            if cmnd == 'json':
+                # Switch to the JSON protocol
+                writer.write(b'OK\n')
+                yield json_command_handler(reader, writer)
+            if cmnd == 'binary':
+                # Switch to the binary protocol, if msgpack is available.
+                if msgpack is None:
+                    writer.write(b'ERR: The binary protocol is not supported\n')
+                    continue
+                writer.write(b'OK\n')
+                # The binary protocol reads the connection until it is closed.
+                yield binary_command_handler(reader, writer)
+                return
+            func = getattr(context, cmnd, False)
+            if func and getattr(func, 'exposed', False):
+                sig = signature(func)
+            else:
+                writer.write(b'ERR: Unknown command %s\n' % cmnd.encode('utf8'))
+                continue
+
+            # Read the arguments for the command
+            # The escape key will break
+            escape = False
+            kwargs = {}
+            for name, paramtype in arguments(sig.parameters):
+                writer.write(b'%s: ' % name.encode('utf8'))
+                value = yield None
+                # Handle the escape key
+                if b'\x1b' in value:
+                    escape = True
+                    break
+                if value:
+                    kwargs[name] = value.rstrip(b'\n')
+
+            # Check if the escape key was pressed.
+            if escape:
+                continue
+
+            try:
+                kwargs = castArguments(kwargs, sig.parameters)
+            except FormatError as e:
+                writer.write(b'ERR: %s' % str(e).encode('utf8'))
+                continue
+
+            # The parameters have been given, now call the function
+            try:
+                result = yield call(func, (), kwargs)
+            except asyncio.TimeoutError:
+                writer.write(b'ERR timeout')
+                continue
+            except Exception:
+                logging.exception('exception occured in the server')
+                writer.write(b'ERR error occured in the server')
+                continue
+
+            if result is None:
+                result = b'OK'
+            elif isinstance(result, str):
+                result = result.encode('utf8')
+
+            writer.write(bytes(result) + b'\n')
+
+    async def handler(reader, writer):
+        print('CONNECTION')
+        logging.debug('Server got a connection')
+        # Write the welcome message
+        writer.write(welcome % context.__class__.__name__.encode('utf8'))
+        protocol = cli_command_handler(reader, writer)
+        protocol.send(None)
+        while True:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    # The client has closed the connection
+                    logging.debug('Server connection closed')
+                    writer.close()
+                    return
+                print('DATA', data)
+                logging.debug('server read data: %s' % data)
+                try:
+                    switch = protocol.send(data)
+                    # The protocol can yield an awaitable, e.g. a function call, to get its result.
+                    while isawaitable(switch):
+                        try:
+                            result = await switch
+                        except Exception as e:
+                            switch = protocol.throw(e)
+                        else:
+                            switch = protocol.send(result)
+                except StopIteration:
+                    # The protocol has ended.
+                    writer.close()
+                    return
+                if switch is not None:
+                    protocol = switch
+                    protocol.send(None)
+
+    logging.info('Starting server on %s' % os.path.abspath(path))
+    return asyncio.start_unix_server(handler, path)
+
+
+# Fool the idea's to think this function returns the cls itself, not some mystery object
+def unixproxy(cls, path):
+    exports = [name for name, f in getmembers(cls) if getattr(f, 'exposed', False)]
+
+    # Wait until the server is in the air
+    logging.info('Proxy listening on %s' % os.path.abspath(path))
+    while not os.path.exists(path):
+        time.sleep(0.1)
+    logging.info('Socket file exists')
+
+    class Proxy:
+        def __init__(self):
+            self.buf = b''
+            self.sock = None
+            self.connected = False
+            self._connect()
+
+        def __del__(self):
+            logging.debug('Closing proxy socket')
+            self.connected = False
+            self.sock.close()
+
+        def _connect(self):
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except:
+                    pass
+            self.connected = False
+            sock = socket.socket(socket.AF_UNIX)
+            while not self.connected:
+                try:
+                    sock.connect(path)
+                    self.connected = True
+                    logging.debug('Proxy connected')
+                except ConnectionRefusedError:
+                    time.sleep(0.1)
+
+            self.sock = sock
+
+            # Set the protocol to JSON mode
+            sock.send(b'json\n')
+            # Read the rubbish intended for humans...
+            while True:
+                msg = sock.recv(4096)
+                if b'OK\n' in msg:
+                    break
+
+        def _read_line(self):
+            assert self.connected
+            while True:
+                if b'\n' in self.buf:
+                    i = self.buf.index(b'\n')
+                    msg = self.buf[:i + 1]
+                    self.buf = self.buf[i + 1:] if len(self.buf) > i else b''
+                    return msg
+                d = self.sock.recv(65536)
+                logging.debug('Proxy received data: %s' % d)
+                if not d:
+                    self._connect()
+                self.buf += d
+
+        def _add_service(self, name):
+            def service(*args, **kwargs):
+                assert self.connected
+                # pack the arguments
+                data = [name, args, kwargs]
+                msg = encodeUnixMsg(data)
+                # Send the message and return the results
+                logging.debug('Proxy sending message: %s' % msg)
+                self.sock.send(msg + b'\n')
+                reply = self._read_line()
+                return unpackReply(decodeUnixMsg(reply))
+
+            setattr(self, name, service)
+
+    p = Proxy()
+    for n in exports:
+        p._add_service(n)
+    return p
+
+
+class AsyncProxy:
+    """ Client for a server made with mkUnixServer, for use with asyncio.
+        Each call carries a request ID, so many calls can be in flight on the same
+        connection. The replies are matched to the calls in whatever order they arrive.
+        The connection is made when the first call is done.
+        With `binary`, the client asks for the binary protocol (if msgpack is available),
+        and falls back to JSON if the server does not support it.
+    """
+    def __init__(self, path, binary=False):
+        self.path = path
+        self.binary = binary and msgpack is not None
+        self.framed = False
+        self.reader = self.writer = None
+        self.receiver = None
+        self.pending = {}
+        # The number of calls in progress, including those waiting for the connection.
+        self.in_flight = 0
+        self.ids = itertools.count(1)
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.writer is not None:
+                return
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path, limit=2**24)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    # Wait until the server is in the air
+                    await asyncio.sleep(0.1)
+            # Set the protocol to binary or JSON mode, and skip the rubbish intended for humans.
+            self.framed = False
+            if self.binary:
+                writer.write(b'binary\n')
+                while not (line := await reader.readline()).endswith(b'OK\n') and b'ERR' not in line:
+                    pass
+                self.framed = line.endswith(b'OK\n')
+            if not self.framed:
+                writer.write(b'json\n')
+                while not (await reader.readline()).endswith(b'OK\n'):
+                    pass
+            logging.debug('Async proxy connected to %s' % self.path)
+            self.reader, self.writer = reader, writer
+            self.receiver = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        """ Close the connection, and wait until it is closed and the replies are no longer read. """
+        if self.writer is not None:
+            writer, receiver = self.writer, self.receiver
+            writer.close()
+            receiver.cancel()
+            self._disconnected(ConnectionError('Connection closed'))
+            await asyncio.gather(receiver, writer.wait_closed(), return_exceptions=True)
+
+    def _disconnected(self, error):
+        self.reader = self.writer = self.receiver = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _receive(self):
+        """ Read the replies from the server and hand them to the callers. """
+        try:
+            while True:
+                if self.framed:
+                    reply = decodeBinaryMsg(await readFrame(self.reader))
+                elif line := await self.reader.readline():
+                    reply = decodeUnixMsg(line)
+                else:
+                    break
+                future = self.pending.pop(reply[2], None) if len(reply) > 2 else None
+                if future is None:
+                    logging.warning('Async proxy got an unexpected reply: %s' % reply)
+                elif not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug('Async proxy lost the connection: %s' % e)
+        self._disconnected(ConnectionError('Lost the connection to the server'))
+
+    async def _send(self, calls):
+        """ Send a number of (name, args, kwargs) calls, and return a future for each reply. """
+        await self.connect()
+        futures = []
+        msg = []
+        for name, args, kwargs in calls:
+            request_id = next(self.ids)
+            futures.append(asyncio.get_running_loop().create_future())
+            self.pending[request_id] = futures[-1]
+            if self.framed:
+                msg.append(encodeBinaryMsg([name, list(args), kwargs, request_id]))
+            else:
+                msg.append(encodeUnixMsg([name, list(args), kwargs, request_id]) + b'\n')
+        self.writer.write(b''.join(msg))
+        await self.writer.drain()
+        return futures
+
+    async def call(self, name, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            future, = await self._send([(name, args, kwargs)])
+            return unpackReply(await future)
+        finally:
+            self.in_flight -= 1
+
+    async def batch(self, calls, return_exceptions=False):
+        """ Do a number of (name, args, kwargs) calls, sent to the server in one go.
+            Returns the list of results.
+        """
+        async def result(future):
+            return unpackReply(await future)
+        self.in_flight += len(calls)
+        try:
+            futures = await self._send(calls)
+            return await asyncio.gather(*[result(f) for f in futures], return_exceptions=return_exceptions)
+        finally:
+            self.in_flight -= len(calls)
+
+
+class AsyncProxyPool:
+    """ A number of connections to a server made with mkUnixServer.
+        Each call uses the connection with the fewest calls in flight.
+    """
+    def __init__(self, path, size=4, binary=False):
+        self.proxies = [AsyncProxy(path, binary) for _ in range(size)]
+
+    def proxy(self):
+        return min(self.proxies, key=lambda p: p.in_flight)
+
+    async def call(self, name, *args, **kwargs):
+        return await self.proxy().call(name, *args, **kwargs)
+
+    async def batch(self, calls, return_exceptions=False):
+        return await self.proxy().batch(calls, return_exceptions)
+
+    async def close(self):
+        for p in self.proxies:
+            await p.close()
+
+
+def async_unixproxy(cls, path, connections=1, binary=False):
+    """ Return an asyncio client for the server for `cls` listening on `path`.
+        The exposed functions of cls become coroutines of the client.
+        With more than one connection, a pool of connections is used.
+    """
+    exports = [name for name, f in getmembers(cls) if getattr(f, 'exposed', False)]
+    p = AsyncProxy(path, binary) if connections == 1 else AsyncProxyPool(path, connections, binary)
+
+    def add_service(name):
+        async def service(*args, **kwargs):
+            return await p.call(name, *args, **kwargs)
+        setattr(p, name, service)
+
+    for n in exports:
+        add_service(n)
+    return p
@@ -23,11 +23,14 @@
 # SOFTWARE.
 
 import flask
+from werkzeug.http import is_resource_modified, http_date
+from werkzeug.wsgi import wrap_file
 
 import os, os.path
 from admingen.data import filecache
 import admingen.magick as magic
 import re
+import secrets
 import json
 import operator
 import logging
@@ -40,8 +43,50 @@ def set_root(path):
     global root_path
     root_path = os.path.abspath(path)
 
-def validate_ranges(ranges, content_length):
-    return all([int(r[0]) <= int(r[1]) for r in ranges]) and all([int(x) < content_length for subrange in ranges for x in subrange])
+# Requests for more ranges than this get the whole file.
+MAX_RANGES = 64
+
+
+def parse_ranges(header, size):
+    """ Parse a Range header into a list of (first, last) byte positions.
+        Returns None if the header is not understood, so that it is ignored, and
+        an empty list if none of the ranges is satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+    ranges = []
+    parts = spec.split(',')
+    if len(parts) > MAX_RANGES:
+        return None
+    for part in parts:
+        m = re.fullmatch(r'\s*(\d*)-(\d*)\s*', part)
+        if m is None or m.group(1) == m.group(2) == '':
+            return None
+        if m.group(1) == '':
+            # A suffix: the last n bytes.
+            length = int(m.group(2))
+            if length == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else size - 1
+        if m.group(2) and last < first:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def if_range_matches(info):
+    """ A Range request with an If-Range header that no longer matches gets the whole file. """
+    condition = flask.request.headers.get('If-Range')
+    if condition is None:
+        return True
+    if condition.startswith('"') or condition.startswith('W/'):
+        return condition == f'"{info.etag}"'
+    return condition == http_date(info.last_modified)
 
 
 def my_get_mime(path):
@@ -116,6 +161,11 @@ def do_leftjoin(tabl1, tabl2, data1, data2, condition):
         results.append(result)
     return results
 
+def is_data(name, fullpath):
+    """ Records in the data directory are returned as JSON, other files (e.g. exports) as files. """
+    return name.isnumeric() or name.endswith('.json') or not os.path.isfile(fullpath)
+
+
 def get_data(path, fullpath):
     if os.path.exists(fullpath):
         
@@ -126,6 +176,49 @@ def get_data(path, fullpath):
     return flask.make_response('/%s: No such file or directory.' % path, 404)
 
 
+def set_validators(res, info):
+    """ Set the headers a client uses to check if its copy of a file is still valid. """
+    res.set_etag(info.etag)
+    res.last_modified = info.last_modified
+
+
+def send_file(info):
+    """ Respond with the whole file. If the WSGI server offers a file wrapper, it sends the
+        file itself (with `sendfile` where available). Otherwise the file is read from a
+        shared descriptor in large chunks.
+    """
+    environ = flask.request.environ
+    if 'wsgi.file_wrapper' in environ:
+        body = wrap_file(environ, open(info.path, 'rb'), filecache.CHUNK_SIZE)
+    else:
+        body = filecache.read_file(info)
+    res = flask.Response(body, 200, mimetype=info.mime, direct_passthrough=True)
+    res.headers['Content-Length'] = info.size
+    set_validators(res, info)
+    return res
+
+
+def send_byteranges(info, ranges):
+    """ Respond with several parts of a file, as multipart/byteranges. """
+    boundary = secrets.token_hex(16)
+    headers = [f'\r\n--{boundary}\r\nContent-Type: {info.mime}\r\n'
+               f'Content-Range: bytes {start}-{end}/{info.size}\r\n\r\n'.encode() for start, end in ranges]
+    trailer = f'\r\n--{boundary}--\r\n'.encode()
+    length = sum(len(h) for h in headers) + sum(end - start + 1 for start, end in ranges) + len(trailer)
+
+    def stream_parts():
+        for header, (start, end) in zip(headers, ranges):
+            yield header
+            yield from filecache.read_file(info, start, end - start + 1)
+        yield trailer
+
+    res = flask.Response(stream_parts(), 206, mimetype=f'multipart/byteranges; boundary={boundary}',
+                         direct_passthrough=True)
+    res.headers['Content-Length'] = length
+    set_validators(res, info)
+    return res
+
+
 def get(path):
     """ Flask handler for get requests. """
     path_components = path.split('/')
@@ -134,7 +227,7 @@ def get(path):
 
     fullpath = mk_fullpath(path)
     
-    if path_components[0] == 'data':
+    if path_components[0] == 'data' and is_data(path_components[-1], fullpath):
         return get_data(path, fullpath)
 
     if os.path.isdir(fullpath):
@@ -150,53 +243,29 @@ def get(path):
         res.headers['Content-Type'] = 'application/json; charset=utf-8'
         return res
     else:
-        stat = os.stat(fullpath)
-        f = filecache.open_file(fullpath)
-        r = flask.request.headers.get('Range')
-        m = re.match('bytes=((\d+-\d+,)*(\d+-\d*))', r) if r is not None else None
-        if r is None or m is None:
-            f.seek(0)
-            def stream_data():
-                while True:
-                    d = f.read(8192)
-                    if len(d) > 0:
-                        yield d
-                    else:
-                        break
-
-            mime = my_get_mime(fullpath)
-            res = flask.Response(flask.stream_with_context(stream_data()), 200, mimetype=mime, direct_passthrough=True)
-            res.headers['Content-Length'] = stat.st_size
+        info = filecache.file_info(fullpath, my_get_mime)
+        if not is_resource_modified(flask.request.environ, etag=info.etag, last_modified=info.last_modified):
+            res = flask.Response(status=304)
+            set_validators(res, info)
+            return res
+        ranges = None
+        if 'Range' in flask.request.headers and if_range_matches(info):
+            ranges = parse_ranges(flask.request.headers['Range'], info.size)
+        if ranges is None:
+            res = send_file(info)
+        elif not ranges:
+            res = flask.make_response('', 416)
+            res.headers['Content-Range'] = f'bytes */{info.size}'
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            res = flask.Response(filecache.read_file(info, start, end - start + 1), 206,
+                                 mimetype=info.mime, direct_passthrough=True)
+            res.headers['Content-Length'] = end - start + 1
+            res.headers['Content-Range'] = f'bytes {start}-{end}/{info.size}'
+            set_validators(res, info)
         else:
-            ranges = [x.split('-') for x in m.group(1).split(',')]
-            if validate_ranges(ranges, stat.st_size):
-                content_length = 0
-                for rng in ranges:
-                    if rng[1] == '':
-                        content_length = content_length + stat.st_size - int(rng[0]) + 1
-                    else:
-                        content_length = content_length + int(rng[1]) - int(rng[0]) + 1
-                def stream_data():
-                    for r in ranges:
-                        f.seek(int(r[0]))
-                        if r[1] == '':
-                            while True:
-                                d = f.read(8192)
-                                if len(d) > 0:
-                                    yield d
-                                else:
-                                    break
-                        else:
-                            for s in [min(8192, int(r[1]) - i + 1) for i in range(int(r[0]), int(r[1]), 8192)]:
-                                d = f.read(s)
-                                yield d
-
-                res = flask.Response(flask.stream_with_context(flask.stream_data()), 206, mimetype=flask.mime, direct_passthrough=True)
-                res.headers['Content-Length'] = content_length
-                res.headers['Content-Range'] = 'bytes %s-%s/%d' % (ranges[0][0], ranges[0][1], stat.st_size)
-            else:
-                res = flask.make_response('', 416)
-        # res.headers['Accept-Ranges'] = 'bytes'
+            res = send_byteranges(info, ranges)
+        res.headers['Accept-Ranges'] = 'bytes'
         return res
 
 def put(path):
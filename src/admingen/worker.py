@@ -3,12 +3,14 @@ import os, os.path
 import threading
 import sys
 import asyncio
+import functools
 from . import config
 from .db_api import openDb, sessionScope, DbTable, select, delete, Required, Set, commit, orm
 from .keyring import KeyRing
 from .email import sendmail
 from .clients.rest import OAuth2
 from .servers import mkUnixServer, Message, expose, serialize, deserialize, update
+from .cron import Scheduler
 from . import logging
 
 
@@ -79,6 +81,9 @@ def Worker(workercls):
             self.tasks = {}
             self.errors = {}
             self.runs = {}
+            self.cron = Scheduler()
+            # A lock for each task, held while it runs.
+            self.running = {}
 
         @expose
         def unlock(self, password):
@@ -92,6 +97,7 @@ def Worker(workercls):
         def reload(self):
             with sessionScope():
                 task_names = {t.id: t.name for t in list(Task.select())}
+                task_schedules = {t.name: t.schedule for t in list(Task.select())}
                 task_config = {}
                 for d in select(t for t in TaskDetails):
                     task_config.setdefault(d.task.id, {})[d.component] = d.settings
@@ -124,14 +130,35 @@ def Worker(workercls):
                     else:
                         self.tasks[task_names[task_id]] = self.cls(task_id, config+optional_config, secrets)
 
-        @expose
+            # Run each task according to its own schedule.
+            self.cron.clear()
+            for name, t in self.tasks.items():
+                if task_schedules.get(name):
+                    self.cron.add(task_schedules[name], functools.partial(self.run_task, name), name)
+
+        def run_task(self, name):
+            """ Run a task, unless it is already running: the scheduler and runOnce run
+                tasks in different threads. Returns False if the task was not run.
+            """
+            lock = self.running.setdefault(name, threading.Lock())
+            if not lock.acquire(blocking=False):
+                logging.warning('Task %s is already running' % name)
+                return False
+            try:
+                self.tasks[name].run()
+            finally:
+                lock.release()
+            return True
+
+        @expose(inline=True)
         def status(self):
             return dict(keyring='unlocked' if self.keyring else 'locked',
                         tasks=[t for t in self.tasks],
                         errors=self.errors,
+                        schedule=self.cron.status(),
                         exact_online='authenticated' if self.exact_token else 'locked')
 
-        @expose
+        @expose(inline=True)
         def setauthorizationcode(self, code):
             """ The authorization is used to get the access token """
             if self.exact_token:
@@ -152,27 +179,22 @@ def Worker(workercls):
             loop = asyncio.get_event_loop()
             loop.call_later(int(token['expires_in']) - 550, self.refreshtoken)
 
-        @expose
+        @expose(concurrency=1)
         def runOnce(self):
-            for name, t in self.tasks.items():
+            for name in list(self.tasks):
                 try:
                     logging.debug('Starting task %s' % name)
-                    t.run()
+                    self.run_task(name)
                 except:
                     logging.exception('Exception when running task '+ name)
                     break
 
 
         async def scheduler(self):
-            while True:
-                # Wait one second
-                await asyncio.sleep(1)
-                print ('tick')
+            await self.cron.run_async()
 
-                self.runOnce()
 
-
-        @expose
+        @expose(inline=True)
         def exit(self):
             logging.warning('Terminating worker process')
             sys.exit(0)
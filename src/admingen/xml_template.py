@@ -26,6 +26,10 @@
             '''
             return ''
     
+    Handlers that need the definitions read from the document, or keep state of their own,
+    are declared with `Tag(<tagname>, handler, with_context=True)`. They receive the
+    TemplateContext of the document as third argument.
+
     The templates can, apart from the Mako tags, include other XML tags that are itself templates.
     
     Also, the template can contain <TemplateSlot_<name> > tags. These tags can be used to define bits
@@ -34,9 +38,14 @@
     it is inserted into the last slot.
 """
 import sys
+import os
 import io
 import re
 import enum
+import json
+import copy
+import hashlib
+import multiprocessing
 import tempfile
 import shutil
 import traceback
@@ -52,16 +61,162 @@ from mako.runtime import _render
 TAG_CLOSE_MSG = '__TAG_CLOSE__'
 
 
-data_models = {}
-queries = {}
-url_prefixes = {}
-source_2_url_prefix = {}
-table_acm = {}
-id_counter = 0
+# Increase when the format of the cached data changes.
+BUILD_CACHE_VERSION = 1
+
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
 
-data_rules = []
 
-compartiments = {}
+class BuildCache:
+    """ Persistent cache that makes rebuilding a document fast when only parts of it changed.
+
+        The cache directory holds:
+        - the Python modules that Mako compiled from the Template definitions,
+        - the pre-processed contents of included files, with the stamps of the files they depend on,
+        - the output of template expansions. An expansion is identified by the template,
+          its arguments and body, the definitions and the id counter of the TemplateContext.
+          The templates used inside
+          the expansion are stored with the output and checked when it is re-used,
+          so changing a template only re-renders the expansions that use it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.module_dir = os.path.join(path, 'modules')
+        for d in [self.module_dir, os.path.join(path, 'includes'), os.path.join(path, 'expansions')]:
+            os.makedirs(d, exist_ok=True)
+        # Count of the handlers that changed something else than the output.
+        self.side_effects = 0
+        # For each include and expansion being processed, the files or templates it uses.
+        self.dependencies = []
+        self.hits = self.misses = 0
+
+    def load(self, kind, key):
+        try:
+            with open(os.path.join(self.path, kind, key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store(self, kind, key, entry):
+        template_module_writer(json.dumps(entry).encode('utf8'), os.path.join(self.path, kind, key))
+
+    def template(self, source):
+        """ Return the Mako template for the source, compiling it only if it was not compiled before. """
+        uri = digest(BUILD_CACHE_VERSION, source) + '.mako'
+        fname = os.path.join(self.module_dir, uri)
+        if not os.path.exists(fname):
+            template_module_writer(source.encode('utf8'), fname)
+        return Template(filename=fname, uri=uri, module_directory=self.module_dir)
+
+    def record(self, dependencies):
+        if self.dependencies:
+            self.dependencies[-1].update(dependencies)
+
+    def include(self, file):
+        """ Return the pre-processed contents of an included file. """
+        path = os.path.abspath(file)
+        key = digest(BUILD_CACHE_VERSION, path)
+        entry = self.load('includes', key)
+        if entry and all(os.path.exists(f) and file_stamp(f) == s for f, s in entry['stamps'].items()):
+            self.record(entry['stamps'])
+            return entry['text']
+        self.dependencies.append({path: file_stamp(path)})
+        try:
+            text = io.StringIO()
+            with open(file) as f:
+                preProcessor(f, text, self)
+        finally:
+            stamps = self.dependencies.pop()
+        self.store('includes', key, {'stamps': stamps, 'text': text.getvalue()})
+        self.record(stamps)
+        return text.getvalue()
+
+    def handled(self, context, tag, arguments, lines, changes_state):
+        """ Called for each handler that does more than returning text. """
+        self.side_effects += 1
+        if changes_state:
+            context.cache_state = digest(context.cache_state, tag, arguments, lines)
+
+    def expand(self, context, tag, fingerprint, arguments, lines, render):
+        """ Return the expansion of a template, re-using a cached result if still valid. """
+        key = digest(BUILD_CACHE_VERSION, fingerprint, arguments, lines, context.id_counter,
+                     context.cache_state, context.tag_digest)
+        entry = self.load('expansions', key)
+        if entry and all(getattr(context.generators.get(t), 'fingerprint', None) == f
+                         for t, f in entry['uses'].items()):
+            self.hits += 1
+            context.id_counter = entry['id_counter']
+            self.record({**entry['uses'], tag: fingerprint})
+            return entry['text']
+
+        self.misses += 1
+        side_effects = self.side_effects
+        self.dependencies.append({})
+        try:
+            text = render(arguments, lines, context)
+        finally:
+            uses = self.dependencies.pop()
+        # Expansions that e.g. define templates can not be replaced by their output.
+        if side_effects == self.side_effects:
+            self.store('expansions', key, {'uses': uses, 'text': text, 'id_counter': context.id_counter})
+        uses[tag] = fingerprint
+        self.record(uses)
+        return text
+
+
+class TemplateContext:
+    """ The state of the expansion of a document, that is passed to the tag handlers that
+        ask for it (see Tag): the tags that are handled, including the Templates defined so far,
+        the definitions read from the document (data models, queries, data rules, etc.),
+        the counter for unique ids and the build cache.
+        Handlers can keep state of their own in `values`. Values that must be seen by all
+        documents in a build, also when they are processed in parallel, are kept in `shared`.
+    """
+    # The attributes that are copied for each document.
+    definitions = ['data_models', 'queries', 'url_prefixes', 'source_2_url_prefix', 'table_acm',
+                   'data_rules', 'compartiments', 'values']
+
+    def __init__(self, generators, build_cache=None, shared=None):
+        self.data_models = {}
+        self.queries = {}
+        self.url_prefixes = {}
+        self.source_2_url_prefix = {}
+        self.table_acm = {}
+        self.data_rules = []
+        self.compartiments = {}
+        self.values = {}
+        self.shared = {} if shared is None else shared
+        self.id_counter = 0
+        self.build_cache = build_cache
+        # Digest of the Datamodels and other definitions handled so far, for the build cache.
+        self.cache_state = ''
+        # The name of the document being processed in a build.
+        self.document = None
+        self.set_generators(generators)
+
+    def set_generators(self, generators):
+        """ Called when the collection of generators has changed. """
+        self.generators = generators
+        self.tag_digest = digest(sorted(generators.keys()))
+
+    def copy(self, document=None):
+        """ A context for processing a document, starting with the definitions in this one.
+            The definitions are copied deeply, so the document can not change them for other
+            documents. The build cache and the shared values are not copied.
+        """
+        result = copy.copy(self)
+        for name in self.definitions:
+            setattr(result, name, copy.deepcopy(getattr(self, name)))
+        result.set_generators(self.generators.copy())
+        result.document = document
+        return result
 
 
 @dataclass
@@ -72,7 +227,7 @@ class DataRule:
     actions: Dict[str, str]
 
 
-def handle_DataRules(args, lines):
+def handle_DataRules(args, lines, context):
     root = ET.fromstring('<?xml version="1.0"?><DataRules>\n' + lines + '</DataRules>')
     for rule in root.iter('DataRule'):
         conditions = {}
@@ -81,10 +236,10 @@ def handle_DataRules(args, lines):
             lang = impl.attrib['lang']
             conditions[lang] = impl.find('Condition').text
             actions[lang] = impl.find('Action').text
-        data_rules.append(DataRule(rule.attrib['table'], rule.attrib['field'], conditions, actions))
+        context.data_rules.append(DataRule(rule.attrib['table'], rule.attrib['field'], conditions, actions))
     return ''
 
-def handle_Datamodel(args, lines):
+def handle_Datamodel(args, lines, context):
     """ Analyse and store data model definitions """
     def handle_logic(line_it):
         """ Read the definition of business logic.
@@ -144,10 +299,10 @@ def handle_Datamodel(args, lines):
         
     name = args['name']
     url_prefix = args.get('url_prefix', name)
-    data_models[name] = {}
-    data_model = data_models[name]
-    url_prefixes[url_prefix] = name
-    source_2_url_prefix[name] = url_prefix
+    context.data_models[name] = {}
+    data_model = context.data_models[name]
+    context.url_prefixes[url_prefix] = name
+    context.source_2_url_prefix[name] = url_prefix
     line_it = iter(lines.splitlines())
     l = next(line_it)
     acm_default = args.get('ACM_default', '')
@@ -158,7 +313,7 @@ def handle_Datamodel(args, lines):
         compartment_variable, compartment_table = compartment_on.split(':')
     compartment_exceptions = args.get('compartment_exceptions', '').split(',')
     if compartment_on:
-        compartiments[name] = {
+        context.compartiments[name] = {
             'compartimented_field': compartment_on,
             'compartimented_cookie': compartment_cookie,
             'exceptions': compartment_exceptions}
@@ -184,14 +339,14 @@ def handle_Datamodel(args, lines):
                 if compartment_on and tablename not in compartment_exceptions:
                     tabledef[compartment_variable] = [compartment_table, 'protected']
                     acm += f',compartmented({compartment_variable}={compartment_cookie})'
-                table_acm[tablename] = acm
+                context.table_acm[tablename] = acm
                 data_model[tablename] = tabledef
             elif table_type.strip() == 'enum':
                 l, tabledef = handle_enum(line_it, tablename)
                 data_model[tablename] = tabledef
             elif table_type.strip() == 'view':
                 l, tabledef = handle_view(line_it)
-                queries[tablename] = tabledef
+                context.queries[tablename] = tabledef
     except StopIteration:
         pass
     return ''
@@ -236,67 +391,63 @@ class DataContext:
 
     isdataclass = staticmethod(is_dataclass)
     
+    def __init__(self, context):
+        self.context = context
+
     @property
     def datamodels(self):
-        global data_models
-        return data_models
+        return self.context.data_models
 
-    @staticmethod
-    def isEnum(source, coltype):
+    def isEnum(self, source, coltype):
         """ Check if a type refers to an enum in the datamodel
         """
         if not coltype:
             return False
         if isinstance(coltype, list):
             coltype = coltype[0]
-        if coltype not in data_models.get(source, []):
+        if coltype not in self.context.data_models.get(source, []):
             return False
-        return isinstance(data_models[source][coltype], enum.EnumMeta)
+        return isinstance(self.context.data_models[source][coltype], enum.EnumMeta)
     
-    @staticmethod
-    def isForeignKey(source, coltype):
+    def isForeignKey(self, source, coltype):
         if not coltype:
             return False
         if isinstance(coltype, list):
             coltype = coltype[0]
-        if coltype not in data_models[source]:
+        if coltype not in self.context.data_models[source]:
             return False
-        return not isinstance(data_models[source][coltype], enum.EnumMeta)
+        return not isinstance(self.context.data_models[source][coltype], enum.EnumMeta)
 
-    @staticmethod
-    def getForeignTable(source, table, col):
-        coltype = data_models[source][table][col]
+    def getForeignTable(self, source, table, col):
+        coltype = self.context.data_models[source][table][col]
         if isinstance(coltype, list):
             coltype = coltype[0]
-        if coltype not in data_models[source]:
+        if coltype not in self.context.data_models[source]:
             return False
-        reftable = data_models[source][coltype]
+        reftable = self.context.data_models[source][coltype]
         if isinstance(reftable, enum.EnumMeta):
             return False
         return coltype
 
-    @staticmethod
-    def getColumnType(source, t, column):
-        if source in data_models and column in data_models[source][t]:
-            return data_models[source][t][column]
-        if source in queries:
-            return queries[source][column]
+    def getColumnType(self, source, t, column):
+        if source in self.context.data_models and column in self.context.data_models[source][t]:
+            return self.context.data_models[source][t][column]
+        if source in self.context.queries:
+            return self.context.queries[source][column]
 
-    @staticmethod
-    def firstElementName(source, table):
-        items = list(data_models[source][table].keys())
+    def firstElementName(self, source, table):
+        items = list(self.context.data_models[source][table].keys())
         if items[0] != 'id':
             return items[0]
         return items[1]
 
-    @staticmethod
-    def GetEnumOptions(source, coltype):
+    def GetEnumOptions(self, source, coltype):
         if not coltype:
             return []
         if isinstance(coltype, list):
             coltype = coltype[0]
-        assert DataContext.isEnum(source, coltype)
-        return data_models[source][coltype].__members__.items()
+        assert self.isEnum(source, coltype)
+        return self.context.data_models[source][coltype].__members__.items()
     
     @staticmethod
     def GetRefUrl(url):
@@ -314,16 +465,16 @@ class DataContext:
         return '+'.join(result)
     
     
-    @staticmethod
-    def makeUrl(reference, strip_quotes=True):
+    def makeUrl(self, reference, strip_quotes=True):
         """ Create an URL from a reference. This reference can be either an URL, or a
             reference to a database table.
         """
         db_parts = reference.split('.')
+        data_models = self.context.data_models
         if len(db_parts) >= 2 and db_parts[0] in data_models and db_parts[1] in data_models[
             db_parts[0]]:
             # We have a reference into the data model.
-            for u, db in url_prefixes.items():
+            for u, db in self.context.url_prefixes.items():
                 if db_parts[0] == db:
                     return '/' + '/'.join([u, db_parts[1]])
             raise RuntimeError('Did not find the url base for database %s' % db_parts)
@@ -335,8 +486,7 @@ class DataContext:
         return result
     
     
-    @staticmethod
-    def GetQueryDetails(query, columns=None):
+    def GetQueryDetails(self, query, columns=None):
         """ Pre-parse a query string, as used in the template system.
         The query contains a lot of information that
         needs to be processed to be able to draw the table.
@@ -364,12 +514,12 @@ class DataContext:
             path = urllib.parse.urlparse(query).path
             pathparts = path.split('/')
             table = pathparts[-1]
-            if (pathparts[0] or pathparts[1]) in url_prefixes:
-                source = url_prefixes[pathparts[0] or pathparts[1]]
-                specs = data_models[source][table]
-            elif path in queries:
+            if (pathparts[0] or pathparts[1]) in self.context.url_prefixes:
+                source = self.context.url_prefixes[pathparts[0] or pathparts[1]]
+                specs = self.context.data_models[source][table]
+            elif path in self.context.queries:
                 source = path
-                specs = queries[path]
+                specs = self.context.queries[path]
             else:
                 # This is an unknown data source. Only process parameters
                 source = specs = None
@@ -381,7 +531,7 @@ class DataContext:
                 data_ref, query_part = query, ''
             assert data_ref.count('.') == 1
             source, table = data_ref.split('.')
-            specs = data_models[source][table]
+            specs = self.context.data_models[source][table]
             query = f'/data/{table}?{query_part}'
         
         # Determine the context that needs to be obtained in JS
@@ -416,7 +566,7 @@ class DataContext:
             elif specs:
                 details.column_names = specs.keys()
             else:
-                details.column_names = list(data_models[source][table].keys())
+                details.column_names = list(self.context.data_models[source][table].keys())
             
             def get_col_type(col):
                 # Also get the type of columns from other tables
@@ -426,13 +576,13 @@ class DataContext:
                     # Find the starting object
                     ftable = details.table
                     for fk in fks:
-                        if fk in data_models[source]:
+                        if fk in self.context.data_models[source]:
                             ftable = fk
                         else:
-                            ftable = data_models[source][ftable][fk][0]
-                    return data_models[source][ftable][c]
+                            ftable = self.context.data_models[source][ftable][fk][0]
+                    return self.context.data_models[source][ftable][c]
                 for t in [details.table, *details.join_tables]:
-                    if col_type := DataContext.getColumnType(source, t, col):
+                    if col_type := self.getColumnType(source, t, col):
                         return col_type
                 raise RuntimeError(f"Column {col} not found in tables {details.table} and {details.join_tables}")
         
@@ -474,152 +624,153 @@ class DataContext:
             -1] + '"'
         return the_query
 
-    @staticmethod
-    def getHidden(datasource):
+    def getHidden(self, datasource):
         source, table = datasource.split('.')
-        table_data = data_models[source][table]
+        table_data = self.context.data_models[source][table]
         result = ['id'] + [k for k, v in table_data.items() if any('protected' in i for i in v)]
         return ','.join(result)
 
-    @staticmethod
-    def unique_id():
-        global id_counter
-        id_counter += 1
-        return f'unique{id_counter}'
+    def unique_id(self):
+        self.context.id_counter += 1
+        return f'unique{self.context.id_counter}'
 
-    @staticmethod
-    def get_urlprefix(datasource):
+    def get_urlprefix(self, datasource):
         source, _ = datasource.split('.', maxsplit=1)
-        return '/' + source_2_url_prefix[source].strip('/')
+        return '/' + self.context.source_2_url_prefix[source].strip('/')
 
-    @staticmethod
-    def get_data_rules(table, lang):
+    def get_data_rules(self, table, lang):
         rules: Dict[str, List[str]] = {}
-        for rule in data_rules:
+        for rule in self.context.data_rules:
             if rule.table == table:
                 if lang in rule.conditions and lang in rule.actions:
                     rules.setdefault(rule.field, []).append((rule.conditions[lang], rule.actions[lang]))
         return rules
 
 
-def read_argument_lines(line, istream):
-    """ Read a stream until all arguments in a Tag are read
-        Returns a tuple with 1. the lines inside the tag declaration, 2. the
-        terminator, 3. the remainder of the last line outside the declaration.
-    """
-    lines = []
-    while True:
-        # Check if the TAG definition is ended
-        m = argsend.match(line)
-        if m:
-            # Add the final bit to the lines with arguments
-            ending = m.groups()[-1]
-            before = line[:m.span()[1]-len(ending)]
-            after = line[m.span()[1]:]
-            lines.append(before)
-            return lines, ending, after
-
-        lines.append(line)
-        line = next(istream)
-
-
 argument_re = re.compile(r'\s*(\S*)\s*=\s*"([^"]*)"')
 
-def argument_parser(line, istream):
-    """ Read a stream until all arguments in a TAG are read
-    :param line: Remained of the first line
-    :param istream: File for reading more lines
-    :return: <argdict>, is_closed, remained of line
-    """
-    arg_lines, ending, after = read_argument_lines(line, istream)
-    # Join the lines together and parse them to a dictionary
-    all_lines = ''.join(arg_lines)
-    all_lines.replace('\n', '')
-    arguments = {k:v for k, v in argument_re.findall(all_lines)}
-    # Return to the one who wants the arguments
-    return arguments, (ending == '/>'), after
-    
-
 template_slots = {}
 
 
-def Tag(tag, handler, expand_tags=True):
-    """ Create a function that will read and handle a specific tag, recursively. """
-    start_matcher = re.compile(r'<\s*%s(?=[ />])'%tag)
-    end_matcher = re.compile(r'</\s*%s\s*>'%tag)
-
-    def tag_line_reader(line, istream):
-        """ Collect all lines (if any) that are, send them through the handler,
-            then yield them.
-            Always a tuple is yielded. element 1 is what the handler returned,
-            and element 2 is what was on the line after the close of the tag.
-        """
-        # Read the arguments for this tag
-        arguments, is_closed, line = argument_parser(line, istream)
-        
-        if is_closed:
-            return handler(arguments, ''), line
-        
-        lines = []
-        while True:
-            # Read the lines within the tag (the body)
-
-            # There is a major difference between reading a Template (definition) and
-            # reading regular tags.
-            # When reading a definition, tags inside the template are not expanded.
-            if expand_tags:
-                # Check for new tags that needs handling
-                while len(parts := tag_start.split(line, maxsplit=1)) > 1:
-                    # We found a new tag. Read and handle it.
-                    before, tagname, after = parts[0], parts[3] or parts[2] or parts[1], parts[-1]
-                    lines.append(before)
-                    # If the tag defines a new template, it must not be expanded yet.
-                    if tag == 'Template':
-                        output, line = generators[tagname](after, istream, False)
-                    else:
-                        output, line = generators[tagname](after, istream)
-                    lines.append(output)
-            
-            # No more new tags on the current line
-            # Check if the tag is ended.
-            if line and len(parts:=end_matcher.split(line)) > 1:
-                # The tag is completed: evaluate it!
-                before, after = parts
-                lines.append(before)
-                try:
-                    return handler(arguments, ''.join(lines)), after
-                except:
-                    print("An error occured when handling tag in", handler.__name__,
-                          "with arguments", arguments,
-                          "\nand lines",lines, file=sys.stderr)
-                    traceback.print_exc()
-                    sys.exit(1)
-            lines.append(line)
-            try:
-                line = next(istream)
-            except StopIteration:
-                print('Tag not closed:', tag, file=sys.stderr)
-                sys.exit(1)
-    
-    return tag_line_reader
-
-
-def root_line_reader(istream, ostream):
-    """ Simple reader for the outer level of the file (root) """
-    global generators
-    for line in istream:
-        # If there is a new tag in the line, this split action yields three bits:
-        # The bit before the tag, the tag name, and the xxxx
-        while len(parts := tag_start.split(line, maxsplit=1)) > 1:
-            # We found a new tag. Read and handle it.
-            before, tagname, after = parts[0], parts[1], parts[-1]
-            ostream.write(before)
-            tagname = tagname.strip()
-            output, line = generators[tagname](after, istream)
-            ostream.write(output)
+class Tag:
+    """ Describes how a tag is handled.
+        The handler is called with the arguments and the body of the tag, and returns
+        the text that replaces the tag in the document. Normally, the tags inside the body
+        are expanded before the handler is called. If expand_tags is False (e.g. for a
+        Template definition), the body is passed as it is.
+        With with_context, the TemplateContext of the document is passed as third argument.
+    """
+    def __init__(self, tag, handler, expand_tags=True, with_context=False):
+        self.tag = tag
+        self.handler = handler
+        self.expand_tags = expand_tags
+        self.with_context = with_context
+        self.end_matcher = re.compile(r'</\s*%s\s*>' % tag)
+        self.fingerprint = getattr(handler, 'fingerprint', None)
+
+    def __call__(self, context, arguments, lines):
+        if context.build_cache and not getattr(self.handler, 'pure', False):
+            context.build_cache.handled(context, self.tag, arguments, lines, self.handler is not handle_Template)
+        try:
+            if self.with_context:
+                return self.handler(arguments, lines, context)
+            return self.handler(arguments, lines)
+        except Exception:
+            print("An error occured when handling tag in", self.handler.__name__,
+                  "with arguments", arguments,
+                  "\nand lines", lines, file=sys.stderr)
+            traceback.print_exc()
+            sys.exit(1)
+
+
+# Texts that are inserted in a template expansion, and that were expanded already,
+# are replaced by a mark. The mark consists of the index of the text between two MARKs.
+MARK = '\x00'
+tag_name = re.compile(r'[^\s/>]*')
+tag_open = re.compile('<')
+tag_open_or_mark = re.compile('[<%s]' % MARK)
+
+
+def unmark(text, marked):
+    """ Replace the marks in a text with the texts they stand for. """
+    if not marked or MARK not in text:
+        return text
+    parts = text.split(MARK)
+    parts[1::2] = [marked[int(i)] for i in parts[1::2]]
+    return ''.join(parts)
+
+
+def tag_not_closed(tag):
+    print('Tag not closed:', tag, file=sys.stderr)
+    sys.exit(1)
+
+
+def expand_text(context, text, marked=None, ostream=None):
+    """ Expand all the tags in a text that have a generator, in a single pass.
+
+        Tags are recognized by looking up their name in the generators of the context. Tags that
+        are being read are kept on a stack, together with the parts of their body
+        that were read so far. When a tag is closed, its handler is called and the
+        result is added to the body of the enclosing tag.
+        Marked texts (see `unmark`) are copied to the output without scanning them again.
+        If an ostream is given, the expanded text is written to it as it becomes available.
+    """
+    out = []
+    stack = []
+    pos = 0
+    finder = tag_open_or_mark if marked else tag_open
+    while True:
+        if ostream and not stack:
+            ostream.writelines(out)
+            out.clear()
+        m = finder.search(text, pos)
+        if m is None:
+            if stack:
+                tag_not_closed(stack[-1][0].tag)
+            out.append(text[pos:])
+            break
+        i = m.start()
+        out.append(text[pos:i])
+        if text[i] == MARK:
+            end = text.index(MARK, i + 1)
+            out.append(marked[int(text[i + 1:end])])
+            pos = end + 1
+            continue
+        if stack and (end := stack[-1][0].end_matcher.match(text, i)):
+            tag, arguments, parent = stack.pop()
+            parent.append(tag(context, arguments, ''.join(out)))
+            out, pos = parent, end.end()
+            continue
 
-        # Write the remainder to the output file
-        ostream.write(line)
+        name = tag_name.match(text, i + 1)
+        tag = context.generators.get(name.group())
+        if tag is None or name.end() == len(text):
+            # Not a tag that needs handling.
+            out.append('<')
+            pos = i + 1
+            continue
+        # Read the arguments. XML tags can have two endings: "/>" or ">".
+        args = argsend.match(text, name.end())
+        if args is None:
+            tag_not_closed(tag.tag)
+        ending = args.groups()[-1]
+        arguments = dict(argument_re.findall(unmark(text[name.end():args.end() - len(ending)], marked)))
+        pos = args.end()
+        if ending == '/>':
+            out.append(tag(context, arguments, ''))
+        elif not tag.expand_tags:
+            end = tag.end_matcher.search(text, pos)
+            if end is None:
+                tag_not_closed(tag.tag)
+            out.append(tag(context, arguments, unmark(text[pos:end.start()], marked)))
+            pos = end.end()
+        else:
+            stack.append((tag, arguments, out))
+            out = []
+    if ostream:
+        ostream.writelines(out)
+        return ''
+    return ''.join(out)
 
 
 def filterComment(instream, outstream):
@@ -650,10 +801,11 @@ def filterComment(instream, outstream):
             line = instream.readline()
 
 
-def preProcessor(instream, outstream):
+def preProcessor(instream, outstream, build_cache=None):
     """ Parse the input file, remove comments, and replace any instances of the
        <include file="name" /> tag with the contents of that file.
-       Files are included by recursively calling the preprocessor on the included file.
+       Files are included by recursively calling the preprocessor on the included file,
+       or retrieved from the build cache.
     """
     include_tag = re.compile(r'<include\s*file="(.+?)"\s*/>')
     tmp_file = io.StringIO()
@@ -665,27 +817,17 @@ def preProcessor(instream, outstream):
         if m:=include_tag.match(line):
             # Found an include directive. Execute it, writing to the output stream.
             file = m.groups()[0]
-            preProcessor(open(file), outstream)
+            if build_cache:
+                outstream.write(build_cache.include(file))
+            else:
+                with open(file) as f:
+                    preProcessor(f, outstream)
         else:
             outstream.write(line)
     
     
-tag_start = None
 # XML tags can have two endings: "/>" or ">".
 argsend = re.compile(r'([^"/>]|("[^"]*?"))*(/?>)')
-template_end = re.compile(r'</\s*Template\s*>')
-
-
-def update_res(generators):
-    global tag_start, tag_end
-    # We need to ensure long tags are matched before short tags,
-    # to prevent 'PageContextValue' to be matched to 'Page'.
-    # The simplest way is to reverse-sort the tags.
-    tags = sorted(generators.keys(), reverse=True)
-    # Prepare a RE to find all custom tags
-    # We use the tag name and a lookahead check for a space or tag end character
-    wrapped_tags = '|'.join(r'(%s)(?=[\s/>])' % t for t in tags)
-    tag_start = re.compile(r'<(%s)' % wrapped_tags)
 
 def template_module_writer(source, outputpath):
     (dest, name) = tempfile.mkstemp(
@@ -710,7 +852,7 @@ def debug_render(template, lines=None, render_context=None):
         # Try to re-create the error using a proper file template
         # This will give a clearer error message.
         with open('failed_template.py', 'w') as out:
-            out.write(template._code)
+            out.write(template.code)
         import failed_template
         data = dict(callable=failed_template.render_body,
                     lines=lines,
@@ -721,7 +863,7 @@ def debug_render(template, lines=None, render_context=None):
                 data)
 
 
-def handle_Template(args, template_lines):
+def handle_Template(args, template_lines, context):
     tag = args['tag']
     kwargsdef = {}
     gather_all = None
@@ -770,14 +912,24 @@ def handle_Template(args, template_lines):
     template_lines_2.insert(0, argline)
     template_lines_2 = '\n'.join(template_lines_2)
     try:
-        template = Template(template_lines_2)
+        template = context.build_cache.template(template_lines_2) if context.build_cache \
+            else Template(template_lines_2)
     except exceptions.SyntaxException as e:
         print("Syntax error in template:", file=sys.stderr)
         print(template_lines_2, file=sys.stderr)
         raise
-
-
-    def expand_template(args, lines):
+    # Slots that are only inserted as they are, can be passed as marks (see expand_text), so that
+    # the text inserted there is not scanned again.
+    markable = {name for name in slots
+                if len(re.findall(r'\b%s\b' % name, template_lines_2)) == slots.count(name)}
+
+    def expand_template(args, lines, context):
+        if context.build_cache:
+            return context.build_cache.expand(context, tag, expand_template.fingerprint, args, lines,
+                                              render_template)
+        return render_template(args, lines, context)
+
+    def render_template(args, lines, context):
         expand_self = None
         arguments = kwargsdef.copy()
         catch_all_args = {}
@@ -815,18 +967,25 @@ def handle_Template(args, template_lines):
         else:
             default_lines = lines
         
+        marked = []
+        def mark(name, text):
+            if not text or name not in markable:
+                return text
+            marked.append(text)
+            return f'{MARK}{len(marked) - 1}{MARK}'
+
         try:
             # Render the template, replacing slots with the relevant texts
             rendered_slots = {name: slots_lines.get(name, '') for name in slots}
             if slots and not rendered_slots[slots[-1]]:
                 rendered_slots[slots[-1]] = default_lines
-            render_context = dict(nspace=DataContext(),
+            rendered_slots = {name: mark(name, text) for name, text in rendered_slots.items()}
+            render_context = dict(nspace=DataContext(context),
                                 **rendered_slots,
                                 **arguments)
             if gather_all:
                 render_context[gather_all] = catch_all_args
-            expand_self = io.StringIO(
-                debug_render(template, lines, render_context))
+            expand_self = debug_render(template, lines, render_context)
         except:
             msg = '<An error occurred when rendering template for %s(%s)>\n'%(tag, args)
             msg += '\n'.join(lines)
@@ -835,68 +994,82 @@ def handle_Template(args, template_lines):
             raise
 
         # Process the resulting text, so as to expand any inner templates.
-        expand_others = io.StringIO()
-        # Use the standard line_reader because it expands templates.
-        root_line_reader(istream=expand_self, ostream=expand_others)
-        return expand_others.getvalue()
+        return expand_text(context, expand_self, marked)
     # End of expand_template
+    expand_template.pure = True
+    expand_template.fingerprint = digest(tag, argdetails, template_lines)
 
-    generators[tag] = Tag(tag, expand_template)
-    update_res(generators)
+    context.generators[tag] = Tag(tag, expand_template, with_context=True)
+    context.set_generators(context.generators)
     return ''
 # End of handle_template
 
 
-def handle_Context(args, lines):
+def handle_Context(args, lines, context):
     """ Handle the Context tag. A context allows custom Templates that do not interfere
         with templates used elsewhere.
     """
-    global generators
     # Make a copy of the current generators and replace the generators list with it.
-    new_context = generators.copy()
-    old_context, generators = generators, new_context
+    old_generators = context.generators
+    context.set_generators(old_generators.copy())
     # Process the text inside the context.
-    expand_others = io.StringIO()
-    root_line_reader(istream=io.StringIO(lines), ostream=expand_others)
+    result = expand_text(context, lines)
     # Restore the old collection of generators
-    generators = old_context
+    context.set_generators(old_generators)
     # Return the expanded text for insertion in the document.
-    return expand_others.getvalue()
+    return result
+handle_Context.pure = True
 
 
 # Note: There is no tag handler for the TemplateSlots, these are hard-coded.
 default_generators = {
-    'Datamodel': Tag('Datamodel', handle_Datamodel),
-    'Template': Tag('Template', handle_Template, expand_tags=False),
-    'Context': Tag('Context', handle_Context, expand_tags=False),
-    'DataRules': Tag('DataRules', handle_DataRules)
+    'Datamodel': Tag('Datamodel', handle_Datamodel, with_context=True),
+    'Template': Tag('Template', handle_Template, expand_tags=False, with_context=True),
+    'Context': Tag('Context', handle_Context, expand_tags=False, with_context=True),
+    'DataRules': Tag('DataRules', handle_DataRules, with_context=True)
 }
 
 generators = default_generators.copy()
 
+# The context of the documents processed with `processor`. Its definitions are also available
+# as module attributes, for the scripts that generate code from them.
+default_context = TemplateContext(generators)
+data_models = default_context.data_models
+queries = default_context.queries
+url_prefixes = default_context.url_prefixes
+source_2_url_prefix = default_context.source_2_url_prefix
+table_acm = default_context.table_acm
+data_rules = default_context.data_rules
+compartiments = default_context.compartiments
+
+
 def processor(ingenerators=generators, istream=sys.stdin, ostream=sys.stdout, preprocess_only=False,
-              expand_templates=True):
+              expand_templates=True, cache_dir=None):
     """ Parses the server definition file.
 
         Scans the file for XML tags that we handle, and
         executes the associated actions.
+        The definitions are stored in the default context, and its generators are set to ingenerators.
+        If a cache_dir is given, compiled templates, included files and template expansions
+        are cached there and re-used in the next run.
     """
-    global generators
-    if ingenerators != generators:
-        generators = ingenerators
-
     if not expand_templates:
-        del generators['Template']
-    
-    istream = open(istream) if isinstance(istream, str) else istream
+        del ingenerators['Template']
+    default_context.set_generators(ingenerators)
+    default_context.build_cache = BuildCache(cache_dir) if cache_dir else None
+    return process_stream(default_context, istream, ostream, preprocess_only)
 
-    update_res(generators)
+
+def process_stream(context, istream, ostream, preprocess_only=False):
+    """ Pre-process and expand one document in a context. """
+    istream = open(istream) if isinstance(istream, str) else istream
+    ostream = open(ostream, 'w') if isinstance(ostream, str) else ostream
 
     ###########################################################################
     ## PRE-PROCESSING
     
     pre_processed = io.StringIO()
-    preProcessor(istream, pre_processed)
+    preProcessor(istream, pre_processed, context.build_cache)
     pre_processed.seek(0)        # Make the stream readable
     
     if preprocess_only:
@@ -905,9 +1078,87 @@ def processor(ingenerators=generators, istream=sys.stdin, ostream=sys.stdout, pr
 
     ###########################################################################
     ## TEMPLATE EXPANSION
-    root_line_reader(pre_processed, ostream)
+    expand_text(context, pre_processed.getvalue(), ostream=ostream)
     return
 
+
+def build_document(context, task):
+    """ Process one document in a build, in its own copy of the context of the build.
+        Returns the input name and an exit code.
+    """
+    istream, ostream = task
+    context = context.copy(istream)
+    try:
+        if ostream:
+            os.makedirs(os.path.dirname(ostream) or '.', exist_ok=True)
+            with open(ostream, 'w') as out:
+                process_stream(context, istream, out)
+        else:
+            process_stream(context, istream, io.StringIO())
+    except SystemExit as e:
+        return istream, e.code or 0
+    except Exception:
+        traceback.print_exc()
+        return istream, 1
+    return istream, 0
+
+
+# The context of the build, in the worker processes of a parallel build.
+worker_context = None
+
+
+def start_worker(context):
+    global worker_context
+    worker_context = context
+
+
+def build_in_worker(task):
+    return build_document(worker_context, task)
+
+
+def build(tasks, ingenerators=generators, preludes=(), jobs=1, cache_dir=None, shared=None):
+    """ Process several documents, each given as an (input, output) tuple. If the output
+        is None, the output is discarded (for generators that e.g. write files).
+
+        The preludes are read first, and the definitions in them are shared by all documents.
+        Each document is processed in its own copy of the context, so the documents can be
+        processed in parallel in `jobs` worker processes. The workers are forked after reading
+        the preludes, so they do not need to parse the shared definitions again.
+        The `shared` dictionary is available to all documents as `context.shared`.
+        Returns the number of documents that could not be processed.
+    """
+    context = TemplateContext(ingenerators.copy(), BuildCache(cache_dir) if cache_dir else None, shared)
+    for prelude in preludes:
+        process_stream(context, prelude, io.StringIO())
+
+    if jobs > 1 and len(tasks) > 1:
+        mp = multiprocessing.get_context('fork')
+        with mp.Manager() as manager:
+            # The shared values are kept by the manager process, so all workers see the same values.
+            context.shared = manager.dict(context.shared)
+            with mp.Pool(jobs, initializer=start_worker, initargs=(context,)) as pool:
+                results = list(pool.imap_unordered(build_in_worker, tasks))
+            if shared is not None:
+                shared.update(context.shared.copy())
+    else:
+        results = [build_document(context, task) for task in tasks]
+
+    failed = [name for name, code in results if code]
+    for name in failed:
+        print('Failed to process', name, file=sys.stderr)
+    return len(failed)
+
+
+def read_manifest(fname):
+    """ Read a file with a document on each line: the input file and, optionally, the output file. """
+    tasks = []
+    with open(fname) as f:
+        for line in f:
+            parts = line.split('#', maxsplit=1)[0].split()
+            if parts:
+                tasks.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return tasks
+
 def run():
     """ This is the normal entry point when the package has been properly installed. """
     import sys
@@ -921,16 +1172,36 @@ def run():
     parser.add_argument('--input', '-i', default=sys.stdin)
     parser.add_argument('--preprocess', '-p', action="store_true")
     parser.add_argument('--print_datamodel', action="store_true")
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory for caching compiled templates and expansions between runs')
+    parser.add_argument('inputs', nargs='*', help='Documents to process in a build')
+    parser.add_argument('--manifest', '-m', default=None,
+                        help='File listing the documents to process, and optionally their output files')
+    parser.add_argument('--output-dir', default=None,
+                        help='Directory for the output of the documents in a build')
+    parser.add_argument('--prelude', action='append', default=[],
+                        help='File with definitions that are shared by all documents in a build')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of documents in a build that are processed in parallel')
 
     args = parser.parse_args()
 
-    result = processor(istream=args.input, ostream=args.output, preprocess_only=args.preprocess)
+    if args.inputs or args.manifest:
+        tasks = read_manifest(args.manifest) if args.manifest else []
+        tasks += [(i, None) for i in args.inputs]
+        if any(o is None for _, o in tasks):
+            if not args.output_dir:
+                parser.error('The output directory is needed for documents without an output file')
+            tasks = [(i, o or os.path.join(args.output_dir, os.path.basename(i))) for i, o in tasks]
+        result = build(tasks, preludes=args.prelude, jobs=args.jobs, cache_dir=args.cache_dir)
+    else:
+        result = processor(istream=args.input, ostream=args.output, preprocess_only=args.preprocess,
+                           cache_dir=args.cache_dir)
     if result:
         sys.exit(result)
 
 if __name__ == '__main__':
     # Normally, this file is executed through a different script in the `bin` directory.
     # This is only executed when debugging.
-    import os
-    result = processor(istream=open('webinterface.xml'))
+    run()
 
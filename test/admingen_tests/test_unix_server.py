@@ -0,0 +1,140 @@
+""" Test dispatching messages in the unix socket servers """
+
+from unittest import TestCase
+import os, os.path
+import time
+import asyncio
+import tempfile
+import threading
+
+from admingen.unix_server import expose, mkUnixServer, async_unixproxy, RemoteError, ServerError, msgpack
+
+
+class UnixServerTests(TestCase):
+    def serve(self, worker, test):
+        """ Run the coroutine function test with a proxy for a server for worker. """
+        async def run(path):
+            server = await mkUnixServer(worker, path)
+            proxy = async_unixproxy(type(worker), path)
+            try:
+                await test(proxy)
+            finally:
+                await proxy.close()
+                server.close()
+                await server.wait_closed()
+                # Let the server finish the connections and calls, before the loop is stopped.
+                await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()}, return_exceptions=True)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            asyncio.run(run(os.path.join(tmpdir, 'testsock')))
+
+    def testAsyncProxy(self):
+        class Worker:
+            @expose
+            def add(self, a, b):
+                return a + b
+            @expose
+            def error(self):
+                raise RuntimeError('Dit gaat fout!')
+
+        async def test(proxy):
+            # Many calls can be in flight at the same time.
+            results = await asyncio.gather(*[proxy.add(i, 1) for i in range(100)])
+            self.assertEqual(results, list(range(1, 101)))
+            self.assertEqual(await proxy.batch([('add', (1, 2), {}), ('add', ('a', 'b'), {})]), [3, 'ab'])
+            with self.assertRaises(ServerError):
+                await proxy.error()
+            results = await proxy.batch([('add', (1, 2), {}), ('error', (), {})], return_exceptions=True)
+            self.assertEqual(results[0], 3)
+            self.assertIsInstance(results[1], ServerError)
+
+            pool = async_unixproxy(Worker, proxy.path, connections=3)
+            results = await asyncio.gather(*[pool.add(i, 1) for i in range(100)])
+            self.assertEqual(results, list(range(1, 101)))
+            self.assertTrue(all(p.writer is not None for p in pool.proxies))
+            await pool.close()
+
+        self.serve(Worker(), test)
+
+    def testNonBlockingDispatch(self):
+        class Worker:
+            @expose(concurrency=1)
+            def slow(self, t):
+                time.sleep(t)
+                return t
+            @expose
+            async def aslow(self, t):
+                await asyncio.sleep(t)
+                return t
+            @expose(timeout=0.2)
+            def too_slow(self):
+                time.sleep(1)
+            @expose(inline=True)
+            def status(self):
+                return 'ok'
+
+        async def test(proxy):
+            start = time.time()
+            slow = asyncio.ensure_future(asyncio.gather(proxy.slow(0.3), proxy.slow(0.3)))
+            aslow = asyncio.ensure_future(proxy.aslow(0.3))
+            await asyncio.sleep(0.05)
+            # The server keeps answering while slow calls are handled.
+            self.assertEqual(await proxy.status(), 'ok')
+            self.assertLess(time.time() - start, 0.2)
+            self.assertEqual(await aslow, 0.3)
+            self.assertLess(time.time() - start, 0.5)
+            # Only one call to slow is handled at a time.
+            self.assertEqual(await slow, [0.3, 0.3])
+            self.assertGreater(time.time() - start, 0.55)
+            with self.assertRaises(RemoteError):
+                await proxy.too_slow()
+
+        self.serve(Worker(), test)
+
+    def testConcurrencyAfterTimeout(self):
+        class Worker:
+            active = 0
+            most = 0
+            lock = threading.Lock()
+            @expose(concurrency=1, timeout=0.1)
+            def slow(self):
+                with self.lock:
+                    Worker.active += 1
+                    Worker.most = max(Worker.most, Worker.active)
+                time.sleep(0.3)
+                with self.lock:
+                    Worker.active -= 1
+
+        async def test(proxy):
+            first = asyncio.ensure_future(proxy.slow())
+            await asyncio.sleep(0.15)
+            # The first call timed out, but is still running.
+            with self.assertRaises(RemoteError):
+                await first
+            with self.assertRaises(RemoteError):
+                await proxy.slow()
+            await asyncio.sleep(0.4)
+            # The slot of a call that timed out is only free once the function has returned.
+            self.assertEqual(Worker.most, 1)
+
+        self.serve(Worker(), test)
+
+    def testBinaryProtocol(self):
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+
+        class Worker:
+            @expose
+            def echo(self, data):
+                return data
+
+        async def test(proxy):
+            # The binary protocol is chosen by the client.
+            proxy = async_unixproxy(Worker, proxy.path, binary=True)
+            blob = os.urandom(100000) + b'\n'
+            self.assertEqual(await proxy.echo(blob), blob)
+            self.assertEqual(await proxy.batch([('echo', ('text',), {}), ('echo', ([1, 2],), {})]), ['text', [1, 2]])
+            self.assertTrue(proxy.framed)
+            await proxy.close()
+
+        self.serve(Worker(), test)
@@ -0,0 +1,123 @@
+""" Test the scheduling of repetitive tasks """
+
+import asyncio
+import threading
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from admingen.cron import CronSchedule, Scheduler
+
+
+class Clock:
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+def almost_whole_minute():
+    """ Return a clock that reaches a whole minute shortly after starting the test. """
+    now = datetime.now()
+    offset = timedelta(seconds=59.8 - now.second - now.microsecond / 1e6)
+    return lambda: datetime.now() + offset
+
+
+class test(unittest.TestCase):
+    def testNextAction(self):
+        schedule = CronSchedule.parse('0 */8 1,15')
+        self.assertEqual(schedule.next_n(datetime(2020, 1, 1), 4),
+                         [datetime(2020, 1, 1, 8), datetime(2020, 1, 1, 16), datetime(2020, 1, 15), datetime(2020, 1, 15, 8)])
+        # Ranges with an end and a step, on working days only.
+        schedule = CronSchedule.parse('*/20 9-17/4 * * 0-4')
+        self.assertEqual(schedule.next_n(datetime(2024, 1, 5, 17, 30), 3),
+                         [datetime(2024, 1, 5, 17, 40), datetime(2024, 1, 8, 9), datetime(2024, 1, 8, 9, 20)])
+        # Steps for the days start at the first day, and skip to the next month.
+        self.assertEqual(CronSchedule.parse('0 0 */2').next_n(datetime(2024, 1, 30), 2),
+                         [datetime(2024, 1, 31), datetime(2024, 2, 1)])
+        # Leap days that are on a Monday are rare.
+        self.assertEqual(CronSchedule.parse('0 0 29 2 0').next_n(datetime(2020, 1, 1), 3),
+                         [datetime(2044, 2, 29), datetime(2072, 2, 29), datetime(2112, 2, 29)])
+        # The second week of the month.
+        self.assertEqual(CronSchedule.parse('30 6 * 3 * 1').next_action(datetime(2021, 2, 1)), datetime(2021, 3, 7, 6, 30))
+        with self.assertRaises(ValueError):
+            CronSchedule.parse('0 0 30 2').next_action()
+        for invalid in ['60', '0 0 0', '0 0 * 13', '5/2', '* * * * * * *']:
+            with self.assertRaises(ValueError):
+                CronSchedule.parse(invalid)
+
+    def testNextActionExhaustive(self):
+        # Compare the jumps against checking every minute.
+        cases = [('*/7 3,5 */3 * 1-3', lambda t: t.minute % 7 == 0 and t.hour in (3, 5) and t.day % 3 == 1
+                  and t.weekday() in (1, 2, 3)),
+                 ('59 23 31', lambda t: (t.minute, t.hour, t.day) == (59, 23, 31)),
+                 ('0 12 * * 6 4', lambda t: (t.minute, t.hour) == (0, 12)
+                  and t.weekday() == 6 and t.day // 7 == 4)]
+        for text, matches in cases:
+            t = start = datetime(2023, 12, 25)
+            expected = []
+            while len(expected) < 5:
+                t += timedelta(minutes=1)
+                if matches(t):
+                    expected.append(t)
+            self.assertEqual(CronSchedule.parse(text).next_n(start, 5), expected)
+
+    def testDue(self):
+        clock = Clock(datetime(2020, 1, 1, 10, 0, 0))
+        scheduler = Scheduler(now=clock)
+        job = scheduler.add('*/5', lambda: None, 'every five minutes')
+        scheduler.add('0 12', lambda: None, 'at noon')
+        self.assertEqual(scheduler.due(), ([], 60))
+        self.assertEqual([j.name for j in scheduler.jobs()], ['every five minutes', 'at noon'])
+
+        clock.t = datetime(2020, 1, 1, 10, 5, 0)
+        self.assertEqual(scheduler.due(), ([job], 60))
+        self.assertEqual(job.deadline, datetime(2020, 1, 1, 10, 10))
+
+        # When the scheduler is late, runs are missed.
+        clock.t = datetime(2020, 1, 1, 10, 21, 0)
+        self.assertEqual(scheduler.due()[0], [job])
+        self.assertEqual((job.missed, job.deadline), (2, datetime(2020, 1, 1, 10, 25)))
+        # A job that is still running is not started again.
+        job.running = Future()
+        clock.t = datetime(2020, 1, 1, 10, 25, 0)
+        self.assertEqual(scheduler.due()[0], [])
+        self.assertEqual(job.missed, 3)
+
+        scheduler.remove(job)
+        clock.t = datetime(2020, 1, 1, 11, 59, 0)
+        self.assertEqual(scheduler.due(), ([], 60))
+        self.assertEqual([s['name'] for s in scheduler.status()], ['at noon'])
+
+    def testRun(self):
+        done = threading.Event()
+        scheduler = Scheduler(now=almost_whole_minute())
+        job = scheduler.add('*', done.set)
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        scheduler.stop()
+        scheduler.thread.join(1)
+        self.assertEqual((job.runs, job.failures), (1, 0))
+
+    def testRunAsync(self):
+        async def run():
+            scheduler = Scheduler(now=almost_whole_minute())
+            done = asyncio.Event()
+            async def action():
+                done.set()
+            def failing():
+                raise RuntimeError('Oops')
+            job = scheduler.add('*', action)
+            failing_job = scheduler.add('*', failing)
+            task = asyncio.ensure_future(scheduler.run_async())
+            await asyncio.wait_for(done.wait(), 5)
+            await asyncio.wait_for(failing_job.running, 5)
+            scheduler.stop()
+            await asyncio.wait_for(task, 1)
+            self.assertEqual((job.runs, job.failures), (1, 0))
+            self.assertEqual((failing_job.runs, failing_job.failures), (1, 1))
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+""" Test the CSV database """
+
+from decimal import Decimal
+import os
+import tempfile
+import unittest
+from unittest import mock
+from dataclasses import dataclass
+import admingen.data
+from admingen.data import CsvDb
+
+
+@dataclass
+class Klant:
+    id: int
+    naam: str
+    saldo: Decimal
+
+
+@dataclass
+class Order:
+    id: int
+    klant: Klant
+    bedrag: Decimal
+
+
+database = '''Klant
+id:int,naam:str,saldo:Decimal
+1,Jansen,10.5
+2,Pietersen,  0
+
+Land
+code,naam
+nl,Nederland
+# Comments and spacing in tables that are not changed are kept.
+be,  Belgie
+'''
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'db.csv')
+        with open(self.path, 'w') as out:
+            out.write(database)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def testLazyLoading(self):
+        with mock.patch.object(admingen.data, 'CsvReader', wraps=admingen.data.CsvReader) as reader:
+            db = CsvDb(self.path)
+            self.assertEqual(list(db.sections), ['Klant', 'Land'])
+            self.assertEqual(reader.call_count, 0)
+            self.assertEqual(db.get(Klant, 2), Klant(2, 'Pietersen', Decimal(0)))
+            self.assertEqual([k.naam for k in db.get_many(Klant)], ['Jansen', 'Pietersen'])
+            # Only the table that is used is read, and only once.
+            self.assertEqual(reader.call_count, 1)
+            self.assertEqual(list(db.data), ['Klant'])
+        with self.assertRaises(KeyError):
+            db.get(Order, 1)
+
+    def testSave(self):
+        db = CsvDb(self.path)
+        self.assertEqual(db.add(Klant(None, 'Nieuw', Decimal('2.5'))).id, 3)
+        text = self.read()
+        self.assertTrue(text.startswith('Klant\nid:int,naam:str,saldo:Decimal\n1,Jansen,10.5\n2,Pietersen,0\n3,Nieuw,2.5\n\n'))
+        self.assertTrue(text.endswith('\nLand\ncode,naam\nnl,Nederland\n'
+                                      '# Comments and spacing in tables that are not changed are kept.\nbe,  Belgie\n\n'))
+
+        # Tables are created when needed, and unchanged tables are copied.
+        db = CsvDb(self.path)
+        db.add(Order(None, 3, Decimal(12)))
+        db.update(Order, {'id': 1, 'bedrag': '13'})
+        self.assertEqual(self.read(), text + 'Order\nid:int,klant:Klant,bedrag:Decimal\n1,3,13\n\n')
+        self.assertEqual(list(db.data), ['Order'])
+
+        db = CsvDb(self.path)
+        db.delete(Klant, 1)
+        db.set(Klant(2, 'Pieters', Decimal(1)))
+        db.save()
+        self.assertEqual([k.naam for k in CsvDb(self.path).get_many(Klant)], ['Pieters', 'Nieuw'])
+        self.assertEqual(CsvDb(self.path).get(Order, 1), Order(1, 3, Decimal(13)))
+        self.assertEqual(os.listdir(self.tmpdir.name), ['db.csv'])
+
+    def testFailedSave(self):
+        db = CsvDb(self.path)
+        db.set(Klant(1, 'Janssen', Decimal(1)))
+        with mock.patch.object(admingen.data, 'CsvWriter', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                db.save()
+        # The file is not changed, and no temporary file is left behind.
+        self.assertEqual(self.read(), database)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['db.csv'])
+        db.save()
+        self.assertEqual(CsvDb(self.path).get(Klant, 1).naam, 'Janssen')
+
+    def testTwoInstances(self):
+        first = CsvDb(self.path)
+        second = CsvDb(self.path)
+        second.add(Order(None, 1, Decimal(3)))
+        second.set(Klant(2, 'Pieters', Decimal(1)))
+        second.save()
+        # The replaced file is indexed again before a table is read from it.
+        self.assertEqual([k.naam for k in first.get_many(Klant)], ['Jansen', 'Pieters'])
+
+        # Saving copies the current versions of the tables that were not changed, or added by others.
+        first.set(Klant(1, 'Janssen', Decimal(1)))
+        first.save()
+        db = CsvDb(self.path)
+        self.assertEqual([k.naam for k in db.get_many(Klant)], ['Janssen', 'Pieters'])
+        self.assertEqual(db.get(Order, 1), Order(1, 1, Decimal(3)))
+        self.assertIn('\nLand\ncode,naam\nnl,Nederland\n', self.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,12 @@
 
 from dataclasses import dataclass
 from decimal import Decimal
+from datetime import date, datetime
 import io
-from admingen.data import CsvTableReader, CsvTableWriter, enum_type, formatted_date
+import array
+import copy
+from admingen.data import CsvTableReader, CsvTableWriter, CsvBatchReader, CsvReader, CsvWriter, enum_type, formatted_date
+from admingen.data import dataset, row_class
 import unittest
 
 example_csv_1 = r'''nummer:int,beschrijving:str,type_cd:CreditDebit,type_balans:BalansWinstVerlies
@@ -52,6 +56,33 @@ class Transaction:
     omschrijving: str
     reference: str
 
+example_csv_3 = r'''id:int,naam:str,bedrag:float
+# A comment
+1,"Jansen, J.",1.5
+2,Pietersen\d P.,2.25
+3,Klaassen,3
+'''
+
+example_multi = r'''Klant
+id:int;naam:str;actief:bool;saldo:Decimal
+1; Jansen ;true;10.5
+2;"Pietersen";false;0
+3;De\dVries\n;y;-1
+
+Land
+code;naam
+nl;Nederland
+be;Belgie
+'''
+
+
+@dataclass
+class Line:
+    id: int
+    naam: str
+    bedrag: float
+
+
 class test(unittest.TestCase):
     def testReadWrite(self):
         for data, target in [(example_csv_1, Grootboek),
@@ -76,4 +107,113 @@ class test(unittest.TestCase):
         stream = io.StringIO(example_csv_2)
         records = list(CsvTableReader(stream, Transaction))
         self.assertEqual(records[0].omschrijving,
-                         'Factuur 2017001121, 11012018\nescape \\ test\tja')
\ No newline at end of file
+                         'Factuur 2017001121, 11012018\nescape \\ test\tja')
+    def testBatches(self):
+        """ Test reading in batches, with quotes, escapes and comments. """
+        batches = list(CsvBatchReader(io.StringIO(example_csv_3), batch_size=2))
+        self.assertEqual(batches, [[(1, 'Jansen, J.', 1.5), (2, 'Pietersen, P.', 2.25)], [(3, 'Klaassen', 3.0)]])
+        columns = next(CsvBatchReader(io.StringIO(example_csv_3), columns=True))
+        self.assertEqual(columns['id'], array.array('q', [1, 2, 3]))
+        self.assertEqual(columns['bedrag'], array.array('d', [1.5, 2.25, 3.0]))
+        self.assertEqual(columns['naam'], ['Jansen, J.', 'Pietersen, P.', 'Klaassen'])
+        # The same values are read into objects.
+        records = list(CsvTableReader(io.StringIO(example_csv_3), Line))
+        self.assertEqual([tuple(r.__dict__.values()) for r in records], batches[0] + batches[1])
+        # Lines that can not be converted are skipped.
+        with self.assertLogs(level='ERROR'):
+            records = list(CsvTableReader(io.StringIO(example_csv_3 + '4,Bad,x\n5,Short\n6,Good,6\n'), Line))
+        self.assertEqual([r.id for r in records], [1, 2, 3, 6])
+
+    def testMultiTable(self):
+        """ Test reading a file with several tables. """
+        data = CsvReader(io.StringIO(example_multi))
+        self.assertEqual(list(data), ['Klant', 'Land'])
+        self.assertEqual({k: dict(v) for k, v in data['Klant'].items()},
+                         {1: {'id': 1, 'naam': 'Jansen', 'actief': True, 'saldo': Decimal('10.5')},
+                          2: {'id': 2, 'naam': 'Pietersen', 'actief': False, 'saldo': Decimal(0)},
+                          3: {'id': 3, 'naam': 'De;Vries', 'actief': True, 'saldo': Decimal(-1)}})
+        self.assertEqual([d.naam for d in data['Land']], ['Nederland', 'Belgie'])
+        with self.assertLogs(level='ERROR'), self.assertRaises(RuntimeError):
+            CsvReader(io.StringIO('Klant\nid:int;naam\nx;Jansen\n'))
+
+    def testDateColumns(self):
+        """ Test converting columns of dates and times, in ISO and other formats. """
+        text = 'Boeking\nid:int;datum:date;tijd:datetime\n1;2024-01-05;2024-01-05 10:30:00\n%s\n'
+        data = CsvReader(io.StringIO(text % '2;2024-02-29;2024-02-29 23:59:59'))
+        self.assertEqual([(r.datum, r.tijd) for r in data['Boeking'].values()],
+                         [(date(2024, 1, 5), datetime(2024, 1, 5, 10, 30)),
+                          (date(2024, 2, 29), datetime(2024, 2, 29, 23, 59, 59))])
+        # A column with other formats is converted a value at a time.
+        data = CsvReader(io.StringIO(text % '2;2024-2-9;20240209'))
+        self.assertEqual([(r.datum, r.tijd) for r in data['Boeking'].values()],
+                         [(date(2024, 1, 5), datetime(2024, 1, 5, 10, 30)), (date(2024, 2, 9), datetime(2024, 2, 9))])
+        with self.assertLogs(level='ERROR'), self.assertRaises(RuntimeError):
+            CsvReader(io.StringIO(text % '2;2024-02-30;2024-02-28 10:00:00'))
+
+    def testRows(self):
+        """ Test the rows of tables read from multi-table files. """
+        data = CsvReader(io.StringIO(example_multi))
+        row = data['Klant'][1]
+        self.assertIs(type(row), row_class(('id', 'naam', 'actief', 'saldo')))
+        # The fields are stored in slots, the dictionary of the row is only used for other attributes.
+        self.assertEqual(row.__dict__, {})
+        row.naam = 'Jansen'
+        self.assertEqual((row.naam, row['saldo'], len(row)), ('Jansen', Decimal('10.5'), 4))
+        # Other attributes can be added, and are part of the mapping.
+        row.naam = 'Janssen'
+        row['korting'] = 5
+        self.assertEqual(list(row.items())[1:], [('naam', 'Janssen'), ('actief', True), ('saldo', Decimal('10.5')),
+                                                 ('korting', 5)])
+        self.assertEqual(dict(copy.copy(row)), dict(row))
+        with self.assertRaises(KeyError):
+            row['onbekend']
+        # Fields that are not identifiers are stored in the dictionary.
+        odd = row_class(('id', 'naam', 'eerste naam'))(1, 2, 'x')
+        self.assertEqual(dict(odd), {'id': 1, 'naam': 2, 'eerste naam': 'x'})
+        self.assertEqual(odd.__dict__, {'eerste naam': 'x'})
+        self.assertEqual(list(odd.values()), [1, 2, 'x'])
+        # Fields with the name of a method hide it.
+        names = ('values', 'items', 'get', 'update', 'extra')
+        odd = row_class(names)(*range(5))
+        self.assertEqual([getattr(odd, n) for n in names], [0, 1, 2, 3, 4])
+        self.assertEqual([odd[n] for n in names], [0, 1, 2, 3, 4])
+        odd.__dict__.update(korting=5)
+        self.assertEqual((odd['korting'], len(odd), str(odd)),
+                         (5, 6, "{'values': 0, 'items': 1, 'get': 2, 'update': 3, 'extra': 4, 'korting': 5}"))
+
+        # The rows can be used in the scripts and written again.
+        selected = dataset(data['Klant'].values()).select('not actief or saldo > 5')
+        self.assertEqual([r.id for r in selected], [1, 2])
+        out = io.StringIO()
+        CsvWriter(out, data)
+        self.assertIn('1;Janssen;True;10.5;5\n', out.getvalue())
+
+        # Rows that are converted one at a time, e.g. in a batch with a short line, are the same.
+        rows = CsvReader(io.StringIO('Land\ncode;naam\nnl;Nederland\nbe\n'))['Land']
+        self.assertEqual({type(r) for r in rows}, {row_class(('code', 'naam'))})
+        self.assertEqual([dict(r) for r in rows], [{'code': 'nl', 'naam': 'Nederland'}, {'code': 'be', 'naam': None}])
+
+    def testStreamingWriters(self):
+        """ Test the writers with generators, which are consumed while writing. """
+        def lines():
+            for i in range(5):
+                yield Line(i, f'regel {i}; met\ttab', i / 2)
+        ostream = io.StringIO()
+        CsvTableWriter(ostream, lines(), formatters={'bedrag': lambda v: f'{v:.2f}'})
+        self.assertEqual(ostream.getvalue().splitlines()[:3],
+                         ['id:int,naam:str,bedrag:float', r'0,regel 0; met\ttab,0.00', r'1,regel 1; met\ttab,0.50'])
+        records = list(CsvTableReader(io.StringIO(ostream.getvalue()), Line))
+        self.assertEqual([r.naam for r in records], [f'regel {i}; met\ttab' for i in range(5)])
+        # The records are not changed while writing them.
+        record = Line('7', 'x', 1)
+        CsvTableWriter(io.StringIO(), [record])
+        self.assertEqual(record.id, '7')
+
+        ostream = io.StringIO()
+        CsvWriter(ostream, {'Regels': lines(), 'Leeg': [], 'Tuples': (t for t in [(1, 'a'), (2, 'b;c')])})
+        text = ostream.getvalue()
+        self.assertTrue(text.startswith('Regels\nid:int;naam:str;bedrag:float\n0;regel 0\\d met\ttab;0.0\n'))
+        self.assertTrue(text.endswith('Tuples\n1:str;2:str\n1;a\n2;b\\dc\n\n'))
+        data = CsvReader(io.StringIO(text))
+        self.assertEqual(list(data), ['Regels', 'Tuples'])
+        self.assertEqual(data['Regels'][4]['naam'], 'regel 4; met\ttab')
@@ -0,0 +1,57 @@
+""" Test the compiler for filter and join conditions """
+
+from decimal import Decimal
+import unittest
+from admingen.data.data_type_base import mydataclass
+from admingen.data.db_api import Record
+from admingen.data.expressions import compile_condition, ExpressionError
+
+
+@mydataclass
+class Customer(Record):
+    id: int
+    name: str
+    balance: Decimal
+
+
+@mydataclass
+class Order(Record):
+    id: int
+    customer: int
+
+
+class test(unittest.TestCase):
+    def testFilter(self):
+        c = Customer(id=3, name='Jansen', balance=Decimal('12.5'))
+        self.assertTrue(compile_condition('eq(id, 3)')(c))
+        self.assertTrue(compile_condition("name == 'Jansen' and balance > 10")(c))
+        self.assertFalse(compile_condition('balance is None or id in (1, 2)')(c))
+        self.assertTrue(compile_condition("isIn(name, 'ans') and not name[0] == 'X'")(c))
+        # Dictionaries work just as well as records.
+        self.assertTrue(compile_condition('eq(id, 3)')({'id': 3}))
+        # Conditions are compiled only once.
+        self.assertIs(compile_condition('eq(id, 3)'), compile_condition('eq(id, 3)'))
+
+    def testJoin(self):
+        c = Customer(id=3, name='Jansen', balance=Decimal('12.5'))
+        o = Order(id=7, customer=3)
+        cond = compile_condition("eq(int(customer), Customer['id'])", ('Order', 'Customer'))
+        self.assertTrue(cond(o, c))
+        # Fields are looked up in the first table first.
+        self.assertTrue(compile_condition('id == 7', ('Order', 'Customer'))(o, c))
+        self.assertTrue(compile_condition('name == "Jansen"', ('Order', 'Customer'))(o, c))
+
+    def testUnsafe(self):
+        for text in ['__import__("os")', 'id.__class__', 'open("x")', 'lambda: 1', 'eq(id,']:
+            with self.assertRaises(ExpressionError):
+                compile_condition(text)
+        # Subscripts on records are checked when they are evaluated.
+        c = Customer(id=3, name='Jansen', balance=Decimal('12.5'))
+        for text in ["Customer['__class__']", "Customer['_' + '_class__'] is None"]:
+            with self.assertRaises(ExpressionError):
+                compile_condition(text, ('Customer',))(c)
+        self.assertTrue(compile_condition("Customer['name'] == 'Jansen'", ('Customer',))(c))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+""" Test the file database """
+
+from decimal import Decimal
+import os
+import json
+import multiprocessing
+import tempfile
+import unittest
+from unittest import mock
+from admingen.data.data_type_base import mydataclass
+from admingen.data.db_api import Record, multi_sort
+from admingen.data import file_db
+from admingen.data.file_db import FileDatabase
+from admingen.data.expressions import compile_condition
+import admingen.data
+from admingen.data import serialiseDataclass, serialiseDataclasses, deserialiseDataclass
+
+
+def add_customers(path, count):
+    db = FileDatabase(path, [Customer])
+    for i in range(count):
+        db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+
+
+@mydataclass
+class Customer(Record):
+    id: int
+    name: str
+    balance: Decimal
+
+
+@mydataclass
+class Invoice(Record):
+    id: int
+    customer: int
+    amount: Decimal
+
+
+@mydataclass
+class Account(Record):
+    id: int
+    customer: Customer
+
+
+@mydataclass
+class Payment(Record):
+    id: int
+    account: Account
+    amount: Decimal
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testCachedReadWrite(self):
+        db = FileDatabase(self.path, [Customer], cached=True)
+        for i in range(5):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        self.assertEqual(len(db.get_many(Customer)), 5)
+
+        # Changes are written through to disk.
+        db.update(Customer, {'id': 2, 'balance': '12.5'})
+        other = FileDatabase(self.path, [Customer])
+        self.assertEqual(other.get(Customer, 2).balance, Decimal('12.5'))
+        db.delete(Customer, 3)
+        self.assertEqual(sorted(r.id for r in other.get_many(Customer)), [1, 2, 4, 5])
+        # Archived records can still be retrieved.
+        self.assertEqual(db.get(Customer, 3).name, 'customer 2')
+
+        # Records handed out are copies: changing them does not change the cache.
+        c = db.get(Customer, 1)
+        c.name = 'changed'
+        self.assertEqual(db.get(Customer, 1).name, 'customer 0')
+
+    def testCachedExternalChange(self):
+        db = FileDatabase(self.path, [Customer], cached=True)
+        db.add(Customer(name='first', balance=Decimal(1)))
+        self.assertEqual(len(db.get_many(Customer)), 1)
+
+        # Another process adds a record to the table.
+        other = FileDatabase(self.path, [Customer])
+        other.add(Customer(name='second', balance=Decimal(2)))
+        self.assertEqual(sorted(r.name for r in db.get_many(Customer)), ['first', 'second'])
+        other.set(Customer(id=1, name='changed', balance=Decimal(1)))
+        self.assertEqual(db.get(Customer, 1).name, 'changed')
+
+    def testCachedConcurrentWrite(self):
+        db = FileDatabase(self.path, [Customer], cached=True)
+        db.add(Customer(name='first', balance=Decimal(0)))
+        db.add(Customer(name='second', balance=Decimal(0)))
+        self.assertEqual(len(db.get_many(Customer)), 2)
+        write_file = file_db.write_file
+        def coarse_write(fullpath, *args, **kwargs):
+            # A write within the resolution of the time stamp leaves the stamp unchanged.
+            dirname = os.path.dirname(fullpath)
+            st = os.stat(dirname)
+            write_file(fullpath, *args, **kwargs)
+            os.utime(dirname, ns=(st.st_atime_ns, st.st_mtime_ns))
+        other = FileDatabase(self.path, [Customer])
+        with mock.patch.object(file_db, 'write_file', coarse_write):
+            other.set(Customer(id=1, name='other', balance=Decimal(1)))
+        self.assertEqual(sorted((c.id, c.name) for c in db.get_many(Customer)), [(1, 'other'), (2, 'second')])
+
+    def testCachedOwnWrites(self):
+        db = FileDatabase(self.path, [Customer], cached=True)
+        for i in range(20):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        with mock.patch.object(file_db, 'deserialiseDataclass', wraps=file_db.deserialiseDataclass) as loads:
+            for i in range(1, 6):
+                db.get(Customer, i)
+                db.update(Customer, {'id': i, 'balance': '1.5'})
+                db.delete(Customer, i + 10)
+                self.assertEqual(len(db.get_many(Customer)), 20 - i)
+        # The table is never reloaded because of the changes made through the cache.
+        self.assertEqual(loads.call_count, 0)
+        self.assertEqual(FileDatabase(self.path, [Customer]).get(Customer, 3).balance, Decimal('1.5'))
+
+    def testIdAllocation(self):
+        db = FileDatabase(self.path, [Customer])
+        for i in range(3):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        # IDs of archived records are not re-used.
+        db.delete(Customer, 3)
+        self.assertEqual(db.add(Customer(name='new', balance=Decimal(0))).id, 4)
+        # Explicitly chosen IDs are skipped by the sequence.
+        db.add(Customer(id=10, name='explicit', balance=Decimal(0)))
+        self.assertEqual(db.add(Customer(name='new', balance=Decimal(0))).id, 11)
+        # Records written without using the sequence are noticed.
+        with open(f'{self.path}/Customer/12', 'w') as out:
+            out.write(serialiseDataclass(Customer(id=12, name='external', balance=Decimal(0))))
+        self.assertEqual(db.add(Customer(name='new', balance=Decimal(0))).id, 13)
+
+    def testConcurrentAdd(self):
+        FileDatabase(self.path, [Customer])
+        workers = [multiprocessing.Process(target=add_customers, args=(self.path, 25)) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        ids = [r.id for r in FileDatabase(self.path, [Customer]).get_many(Customer)]
+        self.assertEqual(sorted(ids), list(range(1, 101)))
+
+    def testQuery(self):
+        db = FileDatabase(self.path, [Customer])
+        for i in range(250):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i % 7)))
+        page = db.query(Customer, limit=10, offset=20)
+        self.assertEqual([r.id for r in page], list(range(21, 31)))
+        page = db.query(Customer, sort='id:desc', limit=3)
+        self.assertEqual([r.id for r in page], [250, 249, 248])
+        page = db.query(Customer, filter=lambda r: r.balance == 3, limit=5, offset=1)
+        self.assertEqual([r.id for r in page], [11, 18, 25, 32, 39])
+        page = db.query(Customer, sort='balance:desc,id', limit=4)
+        self.assertEqual([(r.balance, r.id) for r in page], [(6, 7), (6, 14), (6, 21), (6, 28)])
+        self.assertEqual(len(db.query(Customer)), 250)
+
+    def testJoin(self):
+        db = FileDatabase(self.path, [Customer, Invoice])
+        for i in range(5):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        for i in range(20):
+            db.add(Invoice(customer=i % 6 + 1, amount=Decimal(i)))
+        for condition in ["customer == Customer['id']", "eq(Customer['id'], int(customer)) and amount >= 0"]:
+            join = (Customer, compile_condition(condition, ('Invoice', 'Customer')))
+            invoices = db.query(Invoice, join=join)
+            self.assertEqual([i.Customer and i.Customer.id for i in invoices[:6]], [1, 2, 3, 4, 5, None])
+        # Arbitrary predicates still work.
+        invoices = db.query(Invoice, join=(Customer, lambda a, b: b.id > a.customer))
+        self.assertEqual([i.Customer and i.Customer.id for i in invoices[:6]], [2, 3, 4, 5, None, None])
+
+        # The joined records are serialised with the records they were joined to.
+        self.assertEqual(serialiseDataclasses(invoices[3:5]),
+                         '[{"id": 4, "customer": 4, "amount": "3", "Customer": {"id": 5, "name": "customer 4", '
+                         '"balance": "4"}}, {"id": 5, "customer": 5, "amount": "4"}]')
+        self.assertEqual(serialiseDataclass(invoices[0]), json.dumps(invoices[0], cls=admingen.data.ExtendibleJsonEncoder))
+
+    def testUnitOfWork(self):
+        db = FileDatabase(self.path, [Customer, Account, Payment])
+        for i in range(3):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+            db.add(Account(customer=i + 1))
+        for i in range(12):
+            db.add(Payment(account=i % 3 + 1, amount=Decimal(i)))
+
+        with mock.patch.object(file_db, 'deserialiseDataclass', wraps=file_db.deserialiseDataclass) as reader:
+            with db.unit_of_work():
+                payments = db.query(Payment, resolve_fk=2)
+                self.assertEqual(reader.call_count, 12 + 3 + 3)
+                self.assertEqual([p.account.customer.name for p in payments[:4]],
+                                 ['customer 0', 'customer 1', 'customer 2', 'customer 0'])
+                # Records are read only once, but each caller gets its own copy.
+                payments = db.query(Payment, resolve_fk=True)
+                self.assertEqual(reader.call_count, 12 + 3 + 3)
+                self.assertEqual(payments[0].account.customer, 1)
+                # Changed records are read again.
+                db.update(Customer, {'id': 1, 'name': 'changed'})
+                self.assertEqual(db.get(Customer, 1).name, 'changed')
+            # Outside the unit of work, records are read each time.
+            db.get(Customer, 2)
+            db.get(Customer, 2)
+            self.assertEqual(reader.call_count, 12 + 3 + 3 + 2 + 2)
+
+    def testMultiSort(self):
+        d = [{'a': 1, 'b': 5}, {'a': 2, 'b': 4}, {'a': 3, 'b': 3}, {'a': 3, 'b': 4},
+             {'a': None, 'b': 2}, {'a': 4, 'b': 2}, {'a': 5, 'b': 1}]
+        self.assertEqual([(r['a'], r['b']) for r in multi_sort('a:desc,b', d)],
+                         [(5, 1), (4, 2), (3, 3), (3, 4), (2, 4), (1, 5), (None, 2)])
+        self.assertEqual([(r['a'], r['b']) for r in multi_sort('b,a:desc', d, limit=3)],
+                         [(5, 1), (4, 2), (None, 2)])
+        # None is the smallest value, in both directions.
+        self.assertEqual([r['a'] for r in multi_sort('a', d)], [None, 1, 2, 3, 3, 4, 5])
+        self.assertEqual([r['a'] for r in multi_sort('a:desc', d)], [5, 4, 3, 3, 2, 1, None])
+        self.assertEqual([r['a'] for r in multi_sort('a', d, limit=1)], [None])
+        self.assertEqual([r['a'] for r in multi_sort('a:desc', d, limit=1)], [5])
+        customers = [Customer(id=i, name=f'customer {i % 3}', balance=Decimal(i % 2)) for i in range(1, 41)]
+        self.assertEqual([c.id for c in multi_sort('balance:desc,name:desc', customers, limit=3)], [5, 11, 17])
+
+    def testJournaledTransaction(self):
+        db = FileDatabase(self.path, [Customer], journaled=True)
+        db.add(Customer(name='existing', balance=Decimal(0)))
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            with db.transaction():
+                for i in range(1000):
+                    db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+                db.update(Customer, {'id': 1, 'name': 'changed'})
+                db.delete(Customer, 2)
+                # Changes are visible within the transaction, but not outside it.
+                self.assertEqual(db.get(Customer, 1).name, 'changed')
+                self.assertEqual(len(db.get_many(Customer)), 1000)
+                other = FileDatabase(self.path, [Customer])
+                self.assertEqual([c.name for c in other.get_many(Customer)], ['existing'])
+            # The journal, each staged record and the changed directories are synced
+            # before the journal is removed.
+            self.assertEqual(fsync.call_count, 1 + 1001 + 3)
+        self.assertEqual(len(other.get_many(Customer)), 1000)
+        self.assertEqual(other.get(Customer, 1).name, 'changed')
+        self.assertEqual(other.get(Customer, 2).name, 'customer 0')
+        self.assertFalse(os.path.exists(f'{self.path}/.journal'))
+
+        # A transaction that fails leaves no trace.
+        with self.assertRaises(RuntimeError):
+            with db.transaction():
+                db.add(Customer(name='new', balance=Decimal(0)))
+                db.delete(Customer, 1)
+                raise RuntimeError()
+        self.assertEqual(len(db.get_many(Customer)), 1000)
+        self.assertEqual(db.get(Customer, 1).name, 'changed')
+        self.assertEqual([f for f in os.listdir(f'{self.path}/Customer') if f.startswith('.')], ['.lock', '.sequence'])
+
+    def testJournalRecovery(self):
+        db = FileDatabase(self.path, [Customer], journaled=True)
+        db.add(Customer(name='first', balance=Decimal(0)))
+        # Simulate a commit that was interrupted after the journal was written.
+        with open(f'{self.path}/.journal', 'w') as journal:
+            journal.write(json.dumps({'op': 'write', 'path': 'Customer/2',
+                                      'data': serialiseDataclass(Customer(id=2, name='second', balance=Decimal(2)))}) + '\n')
+            journal.write(json.dumps({'op': 'archive', 'path': 'Customer/1', 'target': 'Customer/archived/1'}) + '\n')
+            journal.write('COMMIT\n')
+        # And a record staged by a process that no longer exists.
+        with open(f'{self.path}/Customer/.3.999999999.0.stage', 'w') as stage:
+            stage.write('{}')
+        db = FileDatabase(self.path, [Customer], journaled=True)
+        self.assertEqual([c.name for c in db.get_many(Customer)], ['second'])
+        self.assertEqual(db.get(Customer, 1).name, 'first')
+        self.assertEqual(sorted(os.listdir(f'{self.path}/Customer')), ['.lock', '.sequence', '2', 'archived'])
+        self.assertFalse(os.path.exists(f'{self.path}/.journal'))
+
+        # A journal without a commit is discarded.
+        with open(f'{self.path}/.journal', 'w') as journal:
+            journal.write(json.dumps({'op': 'archive', 'path': 'Customer/2', 'target': 'Customer/archived/2'}) + '\n')
+        db = FileDatabase(self.path, [Customer], journaled=True)
+        self.assertEqual([c.name for c in db.get_many(Customer)], ['second'])
+
+    def testSerialisation(self):
+        records = [Customer(id=1, name='first', balance=Decimal('1.50')), Customer(id=2, name=None, balance=None),
+                   Payment(id=3, account=2, amount=Decimal(5))]
+        expected = '[{"id": 1, "name": "first", "balance": "1.50"}, {"id": 2, "name": null, "balance": null}, ' \
+                   '{"id": 3, "account": 2, "amount": "5"}]'
+        self.assertEqual(serialiseDataclasses(records), expected)
+        self.assertEqual(serialiseDataclasses(records), json.dumps(records, cls=admingen.data.ExtendibleJsonEncoder))
+        self.assertEqual(serialiseDataclass(records[0]), '{"id": 1, "name": "first", "balance": "1.50"}')
+
+        # Values are converted to the annotated types, empty values and missing fields become None.
+        c = deserialiseDataclass(Customer, '{"id": "4", "name": 12, "balance": "2.5"}')
+        self.assertEqual(vars(c), {'id': 4, 'name': '12', 'balance': Decimal('2.5')})
+        c = deserialiseDataclass(Customer, '{"name": "", "balance": "None"}')
+        self.assertEqual(vars(c), {'name': None, 'balance': None})
+        for r in records:
+            self.assertEqual(deserialiseDataclass(type(r), serialiseDataclass(r)), r)
+        # The backend does not replace the converter for 'json' columns in CSV files.
+        self.assertIs(admingen.data.supported_types['json'], admingen.data.json_loads)
+
+    @unittest.skipIf(admingen.data.orjson is None, 'orjson is not installed')
+    def testOrjsonBackend(self):
+        admingen.data.set_json_backend('orjson')
+        try:
+            record = Payment(id=3, account=2, amount=Decimal('5.25'))
+            self.assertEqual(serialiseDataclass(record), '{"id":3,"account":2,"amount":"5.25"}')
+            self.assertEqual(deserialiseDataclass(Payment, serialiseDataclass(record)), record)
+        finally:
+            admingen.data.set_json_backend('json')
+        with self.assertRaises(ValueError):
+            admingen.data.set_json_backend('yaml')
+
+
+if __name__ == '__main__':
+    unittest.main()
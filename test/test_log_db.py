@@ -0,0 +1,118 @@
+""" Test the log database """
+
+from decimal import Decimal
+import os
+import multiprocessing
+import tempfile
+import unittest
+from unittest import mock
+from admingen.data import log_db, data_server
+from admingen.data.log_db import LogDatabase, migrate_file_db
+from admingen.data.file_db import FileDatabase, UnknownRecord
+from test.test_file_db import Customer
+
+
+def update_customers(path, count):
+    db = LogDatabase(path, [Customer])
+    for i in range(count):
+        db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        db.update(Customer, {'id': 1, 'balance': str(i)})
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testReadWrite(self):
+        db = LogDatabase(self.path, [Customer])
+        for i in range(5):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        db.update(Customer, {'id': 2, 'balance': '12.5'})
+        db.delete(Customer, 3)
+        self.assertEqual([r.id for r in db.get_many(Customer)], [1, 2, 4, 5])
+        # Archived records can still be retrieved, and their IDs are not re-used.
+        self.assertEqual(db.get(Customer, 3).name, 'customer 2')
+        self.assertEqual(db.add(Customer(name='new', balance=Decimal(0))).id, 6)
+        with self.assertRaises(RuntimeError):
+            db.add(Customer(id=2, name='duplicate', balance=Decimal(0)))
+
+        # Changes are seen by other instances, e.g. in other processes.
+        other = LogDatabase(self.path, [Customer])
+        self.assertEqual(other.get(Customer, 2).balance, Decimal('12.5'))
+        db.set(Customer(id=1, name='changed', balance=Decimal(1)))
+        self.assertEqual(other.get(Customer, 1).name, 'changed')
+        self.assertEqual([r.id for r in other.query(Customer, sort='id:desc', limit=2)], [6, 5])
+
+        # Compaction keeps only the latest versions, including those of archived records.
+        db.compact(Customer)
+        with open(f'{self.path}/Customer.jsonl') as log:
+            self.assertEqual(len(log.readlines()), 7)
+        self.assertEqual(other.get(Customer, 1).name, 'changed')
+        self.assertEqual(other.get(Customer, 3).name, 'customer 2')
+        self.assertEqual(len(other.get_many(Customer)), 5)
+
+    def testInterruptedWrite(self):
+        db = LogDatabase(self.path, [Customer])
+        db.add(Customer(name='first', balance=Decimal(1)))
+        # A process was killed while appending a line.
+        with open(f'{self.path}/Customer.jsonl', 'a') as log:
+            log.write('S 2 {"id": 2, "na')
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            db.add(Customer(name='second', balance=Decimal(2)))
+        # The change is on disk when add returns.
+        self.assertEqual(fsync.call_count, 1)
+        other = LogDatabase(self.path, [Customer])
+        self.assertEqual([(r.id, r.name) for r in other.get_many(Customer)], [(1, 'first'), (2, 'second')])
+
+    def testConcurrentWrites(self):
+        log_db.COMPACT_MIN_SIZE = 2000
+        try:
+            LogDatabase(self.path, [Customer]).add(Customer(name='first', balance=Decimal(0)))
+            workers = [multiprocessing.Process(target=update_customers, args=(self.path, 50)) for _ in range(4)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        finally:
+            log_db.COMPACT_MIN_SIZE = 1 << 20
+        ids = [r.id for r in LogDatabase(self.path, [Customer]).get_many(Customer)]
+        self.assertEqual(sorted(ids), list(range(1, 202)))
+        # The log was compacted along the way: without compaction, it would have 401 lines.
+        with open(f'{self.path}/Customer.jsonl') as log:
+            self.assertLess(len(log.readlines()), 401)
+
+    def testMigration(self):
+        source = os.path.join(self.tmpdir.name, 'files')
+        db = FileDatabase(source, [Customer])
+        for i in range(5):
+            db.add(Customer(name=f'customer {i}', balance=Decimal(i)))
+        db.delete(Customer, 2)
+        self.assertEqual(migrate_file_db(source, self.path), {'Customer': 5})
+        migrated = LogDatabase(self.path, [Customer])
+        self.assertEqual([r.id for r in migrated.get_many(Customer)], [1, 3, 4, 5])
+        self.assertEqual(migrated.get(Customer, 2).name, 'customer 1')
+        self.assertEqual(migrated.add(Customer(name='new', balance=Decimal(0))).id, 6)
+
+    def testDataServerHelpers(self):
+        db = LogDatabase(self.path, [Customer])
+        data_server.set_databases({'test': db}, {'test': [Customer]})
+        try:
+            data_server.add_record('Customer', Customer, {'name': 'first', 'balance': '1.5'}, mk_response=False)
+            self.assertEqual(db.get(Customer, 1).balance, Decimal('1.5'))
+            self.assertEqual([c.name for c in data_server.read_records('data/Customer', Customer)], ['first'])
+            self.assertEqual(data_server.read_records('data/Customer')[0]['name'], 'first')
+            self.assertFalse(os.path.exists(f'{self.path}/Customer'))
+        finally:
+            data_server.table_dbs.clear()
+            data_server.table_types.clear()
+        # The log database raises the same exception as the file database.
+        with self.assertRaises(UnknownRecord):
+            db.get(Customer, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+""" Test the SQLite database in production mode """
+
+from dataclasses import dataclass, field
+import os
+import tempfile
+import unittest
+import sqlalchemy as sq
+from sqlalchemy.orm import registry
+from admingen.data.sqlite_db import SqliteDatabase
+from admingen.data.expressions import compile_condition
+
+
+my_registry = registry()
+
+
+@my_registry.mapped
+@dataclass
+class Product:
+    __tablename__ = 'Product'
+    __sa_dataclass_metadata_key__ = 'sa'
+    id: int = field(default=None, metadata={'sa': sq.Column(sq.Integer, primary_key=True)})
+    name: str = field(default='', metadata={'sa': sq.Column(sq.String)})
+    stock: int = field(default=0, metadata={'sa': sq.Column(sq.Integer)})
+
+    @classmethod
+    def get_fks(cls):
+        return {}
+
+    @classmethod
+    def convert_field(cls, key, value):
+        return int(value) if key == 'stock' else value
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, 'db'), [Product], my_registry, production=True)
+
+    def tearDown(self):
+        self.db.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def testProductionMode(self):
+        self.assertFalse(self.db.engine.echo)
+        with self.db.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+
+    def testBulk(self):
+        products = self.db.add_many(Product, [Product(name=f'product {i}', stock=i) for i in range(100)]
+                                    + [Product(id=500, name='explicit')])
+        self.assertEqual([p.id for p in products[:3]], [1, 2, 3])
+        self.assertEqual(self.db.add(Product(name='next')).id, 501)
+        # New and existing records can be mixed; all columns are written.
+        products = self.db.add_many(Product, [Product(name='a', stock=7), Product(id=600, name='b', stock=8),
+                                              {'name': 'c', 'stock': 9}])
+        self.assertEqual([p.id for p in products], [502, 600, 601])
+        self.assertEqual([(self.db.get(Product, i).name, self.db.get(Product, i).stock) for i in [502, 600, 601]],
+                         [('a', 7), ('b', 8), ('c', 9)])
+        # The IDs are handed out in order, so an explicit ID is not taken by an earlier new record.
+        products = self.db.add_many(Product, [Product(id=602, name='d'), Product(name='e')])
+        self.assertEqual([p.id for p in products], [602, 603])
+        self.db.update_many(Product, [{'id': 2, 'stock': '12'}, {'id': 3, 'name': 'changed'}])
+        self.assertEqual(self.db.get(Product, 2).stock, 12)
+        self.assertEqual(self.db.get(Product, 3).name, 'changed')
+        self.assertEqual(self.db.get(Product, 3).stock, 2)
+        self.assertEqual(len(self.db.query(Product, filter=lambda p: p.stock > 50)), 49)
+
+    def testSqlFilter(self):
+        self.db.add_many(Product, [Product(name='a', stock=1), Product(name=None, stock=2),
+                                   Product(name='b', stock=None), Product(name=None, stock=None)])
+        # Only conditions that select the same records in SQL as in Python are translated:
+        # comparisons of columns that can not be NULL, and NULL tests.
+        columns = sq.inspect(Product).columns
+        translated = ["id > 2", "eq(id, 3)", "id in (1, 3)", "id not in (1, 3)", "2 <= id",
+                      "name is None", "stock is not None and id != 1", "and_(id < 4, name is None)"]
+        python = ["name != 'a'", "neq(name, 'a')", "stock in (1, 2)", "stock < 2", "name", "id",
+                  "id == 1 or id == 4", "not id == 1", "lt(id, None)", "id == '1'", "id in (1, '2')",
+                  "id < stock", "id > 2 and name"]
+        for text in translated + python:
+            condition = compile_condition(text)
+            self.assertEqual(condition.to_sql(columns.get) is None, text in python, text)
+            try:
+                expected = [p.id for p in self.db.get_many(Product) if condition(p)]
+            except TypeError:
+                # Comparing None raises in Python, so it must not silently select nothing in SQL.
+                with self.assertRaises(TypeError):
+                    self.db.query(Product, filter=condition)
+                continue
+            self.assertEqual([p.id for p in self.db.query(Product, filter=condition)], expected, text)
+
+    def testUnitOfWork(self):
+        self.db.add(Product(name='first', stock=1))
+        with self.db.unit_of_work():
+            p = self.db.get(Product, 1)
+            # Changes to the records handed out are not written by later commits.
+            p.name = 'changed'
+            self.db.add(Product(name='second', stock=2))
+            self.assertEqual(self.db.get(Product, 1).name, 'first')
+        self.assertEqual(len(self.db.get_many(Product)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+""" Test serving static files with webfs """
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+import flask
+from admingen import webfs
+from admingen.data import filecache
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        webfs.set_root(self.tmpdir.name)
+        app = flask.Flask(__name__)
+        webfs.add_handlers(app)
+        self.client = app.test_client()
+        self.content = bytes(range(256)) * 4096
+        self.write('big.bin', self.content)
+        filecache.info_cache.clear()
+        filecache.open_files.clear()
+
+    def tearDown(self):
+        filecache.open_files.clear()
+        self.tmpdir.cleanup()
+
+    def write(self, fname, data, mtime=1600000000):
+        path = os.path.join(self.tmpdir.name, fname)
+        with open(path, 'wb') as out:
+            out.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def testGet(self):
+        with mock.patch.object(webfs, 'my_get_mime', wraps=webfs.my_get_mime) as get_mime:
+            res = self.client.get('/big.bin')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, self.content)
+            self.assertEqual(res.headers['Content-Length'], str(len(self.content)))
+            etag = res.headers['ETag']
+            self.assertEqual(res.headers['Last-Modified'], 'Sun, 13 Sep 2020 12:26:40 GMT')
+
+            # The MIME type is determined only once.
+            self.assertEqual(self.client.get('/big.bin').data, self.content)
+            self.assertEqual(get_mime.call_count, 1)
+
+            # Clients with a valid copy get a 304.
+            res = self.client.get('/big.bin', headers={'If-None-Match': etag})
+            self.assertEqual((res.status_code, res.data), (304, b''))
+            self.assertEqual(res.headers['ETag'], etag)
+            res = self.client.get('/big.bin', headers={'If-Modified-Since': 'Sun, 13 Sep 2020 12:26:40 GMT'})
+            self.assertEqual(res.status_code, 304)
+
+            # A changed file is noticed.
+            self.write('big.bin', b'changed', mtime=1600000001)
+            res = self.client.get('/big.bin', headers={'If-None-Match': etag})
+            self.assertEqual((res.status_code, res.data), (200, b'changed'))
+            self.assertNotEqual(res.headers['ETag'], etag)
+            self.assertEqual(get_mime.call_count, 2)
+
+    def testRanges(self):
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=1000-1999'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, self.content[1000:2000])
+        self.assertEqual(res.headers['Content-Range'], f'bytes 1000-1999/{len(self.content)}')
+        self.assertEqual(res.headers['Content-Length'], '1000')
+        # Open ended ranges and suffixes.
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=1000000-'})
+        self.assertEqual(res.data, self.content[1000000:])
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=-10'})
+        self.assertEqual(res.data, self.content[-10:])
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=10-2000000'})
+        self.assertEqual(res.data, self.content[10:])
+
+        # Several ranges are returned as multipart/byteranges.
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=0-9, 500000-800000,-5'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.mimetype, 'multipart/byteranges')
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        boundary = res.mimetype_params['boundary'].encode()
+        parts = res.data.split(b'\r\n--' + boundary)
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        expected = [(0, 9), (500000, 800000), (len(self.content) - 5, len(self.content) - 1)]
+        for part, (start, end) in zip(parts[1:-1], expected):
+            headers, body = part.split(b'\r\n\r\n', 1)
+            self.assertIn(f'Content-Range: bytes {start}-{end}/{len(self.content)}'.encode(), headers)
+            self.assertEqual(body, self.content[start:end + 1])
+
+        # Ranges beyond the end of the file can not be satisfied.
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=2000000-'})
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res.headers['Content-Range'], f'bytes */{len(self.content)}')
+        # Invalid ranges, and ranges for a file that changed, are ignored.
+        for headers in [{'Range': 'bytes=10-5'}, {'Range': 'lines=1-2'},
+                        {'Range': 'bytes=0-9', 'If-Range': '"other"'}]:
+            res = self.client.get('/big.bin', headers=headers)
+            self.assertEqual((res.status_code, len(res.data)), (200, len(self.content)))
+        etag = res.headers['ETag']
+        res = self.client.get('/big.bin', headers={'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual((res.status_code, res.data), (206, self.content[:10]))
+
+    def testDataFiles(self):
+        os.makedirs(os.path.join(self.tmpdir.name, 'data', 'exports'))
+        self.write('data/exports/export.csv', b'a,b\n1,2\n')
+        self.write('data/exports/1', b'{"a": 1}')
+        res = self.client.get('/data/exports/export.csv', headers={'Range': 'bytes=4-'})
+        self.assertEqual((res.status_code, res.data), (206, b'1,2\n'))
+        res = self.client.get('/data/exports/1')
+        self.assertEqual((res.mimetype, res.data), ('application/json', b'{"a": 1}'))
+
+    def testFileWrapper(self):
+        wrapped = []
+        def file_wrapper(f, size):
+            wrapped.append(f)
+            return iter(lambda: f.read(size), b'')
+        res = self.client.get('/big.bin', environ_overrides={'wsgi.file_wrapper': file_wrapper})
+        self.assertEqual(res.data, self.content)
+        self.assertEqual(len(wrapped), 1)
+
+    def testOpenFiles(self):
+        files = filecache.OpenFiles(size=2)
+        infos = []
+        for i in range(3):
+            self.write(f'{i}.txt', f'file {i}'.encode())
+            infos.append(filecache.file_info(os.path.join(self.tmpdir.name, f'{i}.txt'), lambda p: 'text/plain'))
+        first = files.acquire(infos[0])
+        self.assertIs(files.acquire(infos[0]), first)
+        files.release(first)
+        files.acquire(infos[1])
+        files.acquire(infos[2])
+        # The evicted file is still in use, so it is not closed yet.
+        self.assertTrue(first.evicted)
+        self.assertEqual(os.pread(first.fd, 6, 0), b'file 0')
+        files.release(first)
+        with self.assertRaises(OSError):
+            os.fstat(first.fd)
+        files.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
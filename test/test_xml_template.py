@@ -0,0 +1,155 @@
+""" Test the xml_template processor """
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from admingen import xml_template
+
+
+templates = """<Template tag="Greeting" args="name">
+<p id="${nspace.unique_id()}">Hello ${name}</p>
+</Template>
+<Template tag="Card" args="title">
+<div><h1>${title}</h1>
+<Greeting name="${title}" />
+<TemplateSlot name="body" />
+</div>
+</Template>
+<Template tag="Footer" args="text">
+<footer>${text}</footer>
+</Template>
+"""
+
+document = """<?xml version="1.0"?>
+<!-- The templates are included -->
+<include file="templates.xml" />
+<Card title="Alice">
+    <p>Welcome</p>
+</Card>
+<Footer text="The end" />
+<Greeting name="Bob" />
+"""
+
+
+class test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        self.write('templates.xml', templates)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def write(self, fname, text):
+        with open(fname, 'w') as out:
+            out.write(text)
+        # Ensure the stamp of the file changes, even on file systems with a coarse resolution.
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def expand(self, text, cache_dir=None):
+        xml_template.default_context.id_counter = 0
+        out = io.StringIO()
+        xml_template.processor(xml_template.default_generators.copy(), io.StringIO(text), out,
+                               cache_dir=cache_dir)
+        return out.getvalue()
+
+    def testExpand(self):
+        result = self.expand(document)
+        self.assertIn('<div><h1>Alice</h1>', result)
+        self.assertIn('<p id="unique1">Hello Alice</p>', result)
+        self.assertIn('<p>Welcome</p>', result)
+        self.assertIn('<footer>The end</footer>', result)
+        self.assertIn('<p id="unique2">Hello Bob</p>', result)
+        self.assertNotIn('Greeting', result)
+
+    def testTokenizer(self):
+        # Several tags on one line, and tags that are not handled.
+        result = self.expand(templates + '<Footer text="a"></Footer><b><Footer text="b" /><Unknown/></b>')
+        self.assertEqual(result.strip(), '<footer>a</footer><b>\n\n<footer>b</footer><Unknown/></b>')
+        # Arguments can be spread over several lines.
+        result = self.expand(templates + '<Footer\n   text="a"\n/>')
+        self.assertEqual(result.strip(), '<footer>a</footer>')
+
+    def testNesting(self):
+        wrap = '<Template tag="Wrap" args="level">\n<div>\n<TemplateSlot name="body" />\n</div>\n</Template>\n'
+        depth = 200
+        text = ''.join(f'<Wrap level="{i}">\n' for i in range(depth)) + '<Footer text="inner" />\n' + \
+            '</Wrap>\n' * depth
+        result = self.expand(templates + wrap + text)
+        self.assertEqual(result.count('<div>'), depth)
+        self.assertEqual(result.count('<footer>inner</footer>'), 1)
+        self.assertNotIn(xml_template.MARK, result)
+
+    def testBuildCache(self):
+        expected = self.expand(document)
+        self.assertEqual(self.expand(document, 'cache'), expected)
+        self.assertEqual(xml_template.default_context.build_cache.misses, 4)
+        # In the next build, only the outer expansions are retrieved from the cache.
+        self.assertEqual(self.expand(document, 'cache'), expected)
+        self.assertEqual((xml_template.default_context.build_cache.hits, xml_template.default_context.build_cache.misses), (3, 0))
+
+        # Changing a template only renders the expansions that use it again.
+        self.write('templates.xml', templates.replace('Hello', 'Hi'))
+        expected = self.expand(document)
+        self.assertEqual(self.expand(document, 'cache'), expected)
+        self.assertEqual((xml_template.default_context.build_cache.hits, xml_template.default_context.build_cache.misses), (1, 3))
+        self.assertIn('Hi Alice', expected)
+
+        # The same holds for the arguments of an expansion.
+        changed = document.replace('Bob', 'Carol')
+        expected = self.expand(changed)
+        self.assertEqual(self.expand(changed, 'cache'), expected)
+        self.assertEqual((xml_template.default_context.build_cache.hits, xml_template.default_context.build_cache.misses), (2, 1))
+
+    def testBuild(self):
+        self.write('first.xml', '<Template tag="Local" args="">\n<i>local</i>\n</Template>\n<Local /><Card title="first" />')
+        self.write('second.xml', '<Local /><Footer text="second" />')
+        self.write('manifest', '# Documents to build\nfirst.xml out/first.xml\nsecond.xml out/second.xml\n')
+        tasks = xml_template.read_manifest('manifest')
+        self.assertEqual(tasks, [('first.xml', 'out/first.xml'), ('second.xml', 'out/second.xml')])
+        for jobs in [1, 2]:
+            failed = xml_template.build(tasks, xml_template.default_generators, preludes=['templates.xml'], jobs=jobs)
+            self.assertEqual(failed, 0)
+            with open('out/first.xml') as f:
+                first = f.read()
+            with open('out/second.xml') as f:
+                second = f.read()
+            self.assertIn('<i>local</i>', first)
+            self.assertIn('<p id="unique1">Hello first</p>', first)
+            # Templates defined in one document are not used in another.
+            self.assertIn('<Local />', second)
+            self.assertIn('<footer>second</footer>', second)
+        self.assertNotIn('Local', xml_template.generators)
+
+    def testBuildShared(self):
+        def handle_Page(args, lines, context):
+            # Each page can only be created by one document in the build.
+            if context.shared.setdefault(args['url'], context.document) != context.document:
+                raise RuntimeError(f'Page {args["url"]} created twice')
+            context.values['pages'] = context.values.get('pages', 0) + 1
+            return f'{context.values["pages"]}'
+        generators = dict(xml_template.default_generators,
+                          Page=xml_template.Tag('Page', handle_Page, with_context=True))
+        self.write('a.xml', '<Page url="a" /><Page url="b" />')
+        self.write('b.xml', '<Page url="c" />')
+        self.write('c.xml', '<Page url="b" />')
+        tasks = [(f, f'out/{f}') for f in ['a.xml', 'b.xml', 'c.xml']]
+        for jobs in [1, 2]:
+            shared = {}
+            with contextlib.redirect_stderr(io.StringIO()):
+                failed = xml_template.build(tasks, generators, jobs=jobs, shared=shared)
+            # The values of a document start anew, the shared values are seen by all documents.
+            self.assertEqual(failed, 1)
+            self.assertEqual(sorted(shared), ['a', 'b', 'c'])
+            self.assertEqual(shared['c'], 'b.xml')
+            with open('out/b.xml') as f:
+                self.assertEqual(f.read(), '1')
+        self.assertEqual(xml_template.default_context.values, {})
+
+if __name__ == '__main__':
+    unittest.main()